@@ -0,0 +1,397 @@
+"""In-process caches for hot read paths (scanner, dashboard).
+
+Handlers run in FastAPI's threadpool, so every cache here is guarded by a lock.
+Callers own invalidation: the crud function that writes the data invalidates
+the matching entries right after its commit.
+
+The caches live in this process, so writes made by another server process on
+the same database (a second branch on PostgreSQL, seed_data.py, a second
+uvicorn worker) never reach them through those calls. SharedVersions covers
+that: every commit that touches a cached table bumps a counter in the
+cache_versions table, and the readers compare the counters before using a cache
+(one small SELECT) and drop what another process changed. Writes that bypass
+the ORM session (hand-written SQL, an older release still running) don't bump
+anything; they show up at the latest after the TTL (CACHE_TTL seconds, 300 by
+default), when everything is dropped anyway.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import event, select, update
+
+
+class StudentCardCache:
+    """Bounded LRU of the scanner's student card data, keyed by Student.uuid.
+
+    Only found students are cached, so a newly enrolled card is never hidden
+    behind a cached miss.
+
+    Every invalidation bumps a generation counter: a loader takes it with
+    begin_load() before its SELECT and put() drops the card if a write
+    invalidated anything in between (the same guard as TreasuryCache).
+    """
+
+    def __init__(self, maxsize: int = 5000):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._uuid_by_id = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.stale_puts = 0
+
+    def get(self, uuid_code: str):
+        with self._lock:
+            card = self._items.get(uuid_code)
+            if card is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(uuid_code)
+            self.hits += 1
+            return card
+
+    def begin_load(self) -> int:
+        with self._lock:
+            return self._generation
+
+    def put(self, uuid_code: str, card: dict, generation: int):
+        with self._lock:
+            if generation != self._generation:
+                self.stale_puts += 1
+                return
+            self._items[uuid_code] = card
+            self._items.move_to_end(uuid_code)
+            self._uuid_by_id[card["id"]] = uuid_code
+            while len(self._items) > self.maxsize:
+                _, old = self._items.popitem(last=False)
+                self._uuid_by_id.pop(old["id"], None)
+
+    def invalidate(self, uuid_code: str):
+        with self._lock:
+            self._generation += 1
+            card = self._items.pop(uuid_code, None)
+            if card is not None:
+                self._uuid_by_id.pop(card["id"], None)
+                self.invalidations += 1
+
+    def invalidate_student(self, student_id: int):
+        with self._lock:
+            # bumped even if the card isn't cached: a loader may be reading it right now
+            self._generation += 1
+            uuid_code = self._uuid_by_id.pop(student_id, None)
+            if uuid_code is not None and self._items.pop(uuid_code, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self.invalidations += len(self._items)
+            self._items.clear()
+            self._uuid_by_id.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._items),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+                "invalidations": self.invalidations,
+                "stale_puts": self.stale_puts,
+            }
+
+
+class TreasuryCache:
+    """Running treasury totals kept in sync by the writers instead of recomputed.
+
+    Holds raw (unrounded) sums: payments, book_sales, expenses and income per
+    (class_id, group_id). Writers apply their delta after commit; anything that
+    can't be expressed as a delta (deleting a student, moving them to another
+    group) calls invalidate() and the next read recomputes from SQL.
+
+    Every write bumps a generation counter, so a reader that computed totals
+    while a write was in flight can't store a stale snapshot (see begin_load/store).
+    """
+
+    def __init__(self):
+        self._totals = None
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self):
+        with self._lock:
+            if self._totals is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return {
+                "payments": self._totals["payments"],
+                "book_sales": self._totals["book_sales"],
+                "expenses": self._totals["expenses"],
+                "by_group": dict(self._totals["by_group"]),
+            }
+
+    def begin_load(self) -> int:
+        with self._lock:
+            return self._generation
+
+    def store(self, totals: dict, generation: int):
+        with self._lock:
+            if generation == self._generation:
+                self._totals = totals
+
+    def add_income(self, kind: str, amount: float, group_key=None):
+        """kind is "payments" or "book_sales"; group_key is (class_id, group_id) or None."""
+        with self._lock:
+            self._generation += 1
+            if self._totals is None:
+                return
+            self._totals[kind] += amount or 0.0
+            if group_key is not None:
+                by_group = self._totals["by_group"]
+                by_group[group_key] = by_group.get(group_key, 0.0) + (amount or 0.0)
+
+    def add_expense(self, amount: float):
+        with self._lock:
+            self._generation += 1
+            if self._totals is not None:
+                self._totals["expenses"] += amount or 0.0
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._totals = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "loaded": self._totals is not None,
+                "groups": len(self._totals["by_group"]) if self._totals else 0,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+class MonthlyRollupCache:
+    """Per-day treasury sums for closed months, keyed by (year, month).
+
+    Closed months only change when history is deleted (delete_student), which
+    calls clear() (SharedVersions does for other processes' money writes); the
+    current month is always read from SQL. Bounded LRU:
+    a report covers at most a few years (crud.REPORT_MAX_DAYS), older months
+    are dropped.
+    """
+
+    def __init__(self, maxsize: int = 120):
+        self.maxsize = maxsize
+        self._months = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, month_key):
+        with self._lock:
+            days = self._months.get(month_key)
+            if days is None:
+                self.misses += 1
+            else:
+                self._months.move_to_end(month_key)
+                self.hits += 1
+            return days
+
+    def put(self, month_key, days: dict):
+        with self._lock:
+            self._months[month_key] = days
+            self._months.move_to_end(month_key)
+            while len(self._months) > self.maxsize:
+                self._months.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._months.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"months": len(self._months), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+
+class ImageBytesCache:
+    """LRU of small files (card PNGs) by name, bounded by total bytes."""
+
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name: str):
+        with self._lock:
+            data = self._items.get(name)
+            if data is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(name)
+            self.hits += 1
+            return data
+
+    def put(self, name: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(name, None)
+            if old is not None:
+                self._size -= len(old)
+            self._items[name] = data
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self._size -= len(evicted)
+
+    def invalidate(self, name: str):
+        with self._lock:
+            old = self._items.pop(name, None)
+            if old is not None:
+                self._size -= len(old)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._items),
+                "bytes": self._size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+            }
+
+
+class SharedVersions:
+    """Cross-process invalidation for the caches above, through the cache_versions table.
+
+    `tables` maps a table name to the kind of cached data it feeds ("students",
+    "money"); on_change() registers what to drop when a kind changes. Once
+    listen() is called, every Session commit that inserted, updated or deleted
+    rows of those tables bumps the kind's counter in the same transaction.
+
+    sync(db), called before a cache is read, drops the kinds whose counter moved
+    since this process last looked. A process's own bumps don't count: its crud
+    writers already invalidated exactly what they changed, so a payment keeps
+    the treasury delta instead of forcing a recompute.
+    """
+
+    def __init__(self, table, tables: dict, ttl: float = 300.0):
+        self.table = table
+        self.tables = tables
+        self.ttl = ttl
+        self._handlers = {}
+        self._seen = {}  # kind -> last counter value this process's caches reflect
+        self._expires = time.monotonic() + ttl
+        self._lock = threading.Lock()
+        self.checks = 0
+        self.remote_changes = 0
+        self.expirations = 0
+
+    def on_change(self, kind: str, *callbacks):
+        self._handlers.setdefault(kind, []).extend(callbacks)
+
+    def sync(self, db):
+        rows = db.execute(select(self.table.c.name, self.table.c.version)).all()
+        with self._lock:
+            self.checks += 1
+            now = time.monotonic()
+            if now >= self._expires:
+                self._expires = now + self.ttl
+                self.expirations += 1
+                changed = set(self._handlers)
+            else:
+                changed = set()
+            for kind, version in rows:
+                # counters only grow: an older reading from a slower thread changes nothing
+                if version > self._seen.get(kind, -1):
+                    if kind in self._seen:
+                        self.remote_changes += 1
+                    self._seen[kind] = version
+                    changed.add(kind)
+            # dropped under the lock, so no thread reads a cache this sync already knows is stale
+            done = set()
+            for kind in changed:
+                for callback in self._handlers.get(kind, ()):
+                    if callback not in done:
+                        done.add(callback)
+                        callback()
+
+    def reset(self):
+        """Forgets the counters seen (the process now talks to another database)."""
+        with self._lock:
+            self._seen.clear()
+            self._expires = time.monotonic() + self.ttl
+
+    def listen(self, session_class):
+        event.listen(session_class, "after_flush", self._after_flush)
+        event.listen(session_class, "do_orm_execute", self._orm_execute)
+        event.listen(session_class, "before_commit", self._before_commit)
+        event.listen(session_class, "after_commit", self._after_commit)
+        event.listen(session_class, "after_rollback", self._after_rollback)
+
+    def _touch(self, session, table_name: str):
+        kind = self.tables.get(table_name)
+        if kind is not None:
+            session.info.setdefault("cache_kinds", set()).add(kind)
+
+    def _after_flush(self, session, flush_context):
+        for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+            self._touch(session, obj.__table__.name)
+
+    def _orm_execute(self, state):
+        # bulk statements: Query.update/delete, session.execute(insert(Model), rows)
+        if state.is_insert or state.is_update or state.is_delete:
+            self._touch(state.session, state.statement.table.name)
+
+    def _before_commit(self, session):
+        session.flush()  # objects still pending are written by this commit too
+        kinds = session.info.pop("cache_kinds", None)
+        if not kinds:
+            return
+        bumped = {}
+        for kind in sorted(kinds):  # same row order in every process: no deadlocks on PostgreSQL
+            session.execute(update(self.table).where(self.table.c.name == kind)
+                            .values(version=self.table.c.version + 1))
+            # the row stays locked until commit, so this is our own increment
+            version = session.execute(select(self.table.c.version).where(self.table.c.name == kind)).scalar()
+            if version is not None:
+                bumped[kind] = version
+        session.info["cache_bumped"] = bumped
+
+    def _after_commit(self, session):
+        bumped = session.info.pop("cache_bumped", None)
+        if not bumped:
+            return
+        with self._lock:
+            for kind, version in bumped.items():
+                # only when no other process bumped in between; otherwise the next sync drops the kind
+                if self._seen.get(kind) == version - 1:
+                    self._seen[kind] = version
+
+    def _after_rollback(self, session):
+        session.info.pop("cache_kinds", None)
+        session.info.pop("cache_bumped", None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "versions": dict(self._seen),
+                "ttl": self.ttl,
+                "checks": self.checks,
+                "remote_changes": self.remote_changes,
+                "expirations": self.expirations,
+            }
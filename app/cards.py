@@ -0,0 +1,188 @@
+"""Printable ID-card sheets: a class/group's cards laid out on A4 pages.
+
+Pages are composed one at a time from the barcode/QR PNGs already in
+utils.BARCODES_DIR (through images.renderer, so missing ones are rendered and
+the bytes are cached), and each page is released once written out. The PDF is
+produced as a stream: every page is a JPEG image object, and the page tree,
+xref and trailer are written at the end, so hundreds of students never sit in
+memory at once.
+
+Arabic names need shaping: Pillow built with libraqm does it itself, otherwise
+the optional arabic_reshaper + python-bidi packages are used when installed.
+Set CARD_FONT to a TTF with Arabic glyphs if none of the defaults exist.
+"""
+import io
+import os
+
+from PIL import Image, ImageDraw, ImageFont, features
+
+from .images import renderer
+from .utils import card_image_paths
+
+# A4 at 150 dpi, 2 x 5 cards of about 95 x 56 mm
+DPI = 150
+PAGE_SIZE = (1240, 1754)
+PAGE_POINTS = (595, 842)
+CARD_SIZE = (560, 330)
+COLUMNS, ROWS = 2, 5
+CARDS_PER_PAGE = COLUMNS * ROWS
+GAP = (40, 16)
+JPEG_QUALITY = 90
+
+FONT_CANDIDATES = [
+    os.environ.get("CARD_FONT"),
+    "C:/Windows/Fonts/tahoma.ttf",
+    "C:/Windows/Fonts/arial.ttf",
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+    "/Library/Fonts/Arial.ttf",
+]
+_HAS_RAQM = features.check("raqm")
+_fonts = {}
+
+
+def _font(size: int):
+    font = _fonts.get(size)
+    if font is None:
+        for path in FONT_CANDIDATES:
+            if path and os.path.exists(path):
+                layout = ImageFont.Layout.RAQM if _HAS_RAQM else ImageFont.Layout.BASIC
+                font = ImageFont.truetype(path, size, layout_engine=layout)
+                break
+        else:
+            font = ImageFont.load_default(size)
+        _fonts[size] = font
+    return font
+
+
+def _shape(text: str) -> str:
+    if _HAS_RAQM or not text:
+        return text
+    try:
+        import arabic_reshaper
+        from bidi.algorithm import get_display
+    except ImportError:
+        return text
+    return get_display(arabic_reshaper.reshape(text))
+
+
+def _card_image(filename: str):
+    data = renderer.get(filename, lambda uuid_code: True)
+    return Image.open(io.BytesIO(data)) if data else None
+
+
+def _fit(img, box):
+    """Resize keeping the aspect ratio; NEAREST keeps barcode bars sharp."""
+    scale = min(box[0] / img.width, box[1] / img.height)
+    return img.resize((max(1, int(img.width * scale)), max(1, int(img.height * scale))), Image.NEAREST)
+
+
+def _draw_card(page, draw, x, y, card):
+    w, h = CARD_SIZE
+    draw.rounded_rectangle([x, y, x + w - 1, y + h - 1], radius=14, outline=(90, 90, 90), width=2)
+
+    qr = _card_image(f"qr_{card['uuid']}.png")
+    if qr is not None:
+        qr_img = _fit(qr.convert("RGB"), (160, 160))
+        page.paste(qr_img, (x + 16, y + 16))
+        qr.close()
+
+    # name and class/group right-aligned (RTL card)
+    right = x + w - 20
+    name_font, info_font = _font(34), _font(24)
+    lines = [(_shape(card["name"]), name_font, y + 24)]
+    info = " - ".join(part for part in (card.get("class_name"), card.get("group_name")) if part)
+    if info:
+        lines.append((_shape(info), info_font, y + 80))
+    lines.append((card["uuid"], info_font, y + 126))
+    for text, font, ty in lines:
+        width = draw.textlength(text, font=font)
+        draw.text((right - width, ty), text, font=font, fill=(0, 0, 0))
+
+    barcode = _card_image(f"{card['uuid']}.png")
+    if barcode is not None:
+        bar_img = _fit(barcode.convert("RGB"), (w - 40, h - 200))
+        page.paste(bar_img, (x + (w - bar_img.width) // 2, y + 190))
+        barcode.close()
+
+
+def render_pages(cards: list):
+    """Yields one PIL page per CARDS_PER_PAGE cards (each dict: name, uuid, class_name, group_name)."""
+    for start in range(0, len(cards), CARDS_PER_PAGE):
+        chunk = cards[start:start + CARDS_PER_PAGE]
+        # queue the missing images of the whole page before waiting on the first one
+        for card in chunk:
+            if not all(os.path.exists(p) for p in card_image_paths(card["uuid"])):
+                renderer.submit(card["uuid"])
+        page = Image.new("RGB", PAGE_SIZE, "white")
+        draw = ImageDraw.Draw(page)
+        left = (PAGE_SIZE[0] - COLUMNS * CARD_SIZE[0] - (COLUMNS - 1) * GAP[0]) // 2
+        top = (PAGE_SIZE[1] - ROWS * CARD_SIZE[1] - (ROWS - 1) * GAP[1]) // 2
+        for i, card in enumerate(chunk):
+            col, row = i % COLUMNS, i // COLUMNS
+            _draw_card(page, draw,
+                       left + col * (CARD_SIZE[0] + GAP[0]),
+                       top + row * (CARD_SIZE[1] + GAP[1]), card)
+        yield page
+
+
+def page_count(cards: list) -> int:
+    return max(1, -(-len(cards) // CARDS_PER_PAGE))
+
+
+def png_page(cards: list, page: int) -> bytes:
+    start = (page - 1) * CARDS_PER_PAGE
+    img = next(render_pages(cards[start:start + CARDS_PER_PAGE]), None) or Image.new("RGB", PAGE_SIZE, "white")
+    buf = io.BytesIO()
+    img.save(buf, format="PNG", dpi=(DPI, DPI))
+    return buf.getvalue()
+
+
+def pdf_stream(cards: list):
+    """Yields a PDF (one JPEG image per A4 page) chunk by chunk."""
+    pos = 0
+    offsets = {}  # object number -> byte offset, for the xref table
+
+    def obj(num: int, body: bytes) -> bytes:
+        nonlocal pos
+        offsets[num] = pos
+        data = f"{num} 0 obj\n".encode() + body + b"\nendobj\n"
+        pos += len(data)
+        return data
+
+    header = b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n"
+    pos += len(header)
+    yield header
+
+    # 1 = catalog, 2 = page tree: written last, once every page is known
+    page_ids = []
+    next_id = 3
+    pw, ph = PAGE_POINTS
+    for page in render_pages(cards):
+        buf = io.BytesIO()
+        page.save(buf, format="JPEG", quality=JPEG_QUALITY)
+        jpeg = buf.getvalue()
+        width, height = page.size
+        page.close()
+        image_id, content_id, page_id = next_id, next_id + 1, next_id + 2
+        next_id += 3
+        content = f"q {pw} 0 0 {ph} 0 0 cm /Im0 Do Q".encode()
+        yield obj(image_id, (
+            f"<< /Type /XObject /Subtype /Image /Width {width} /Height {height} "
+            f"/ColorSpace /DeviceRGB /BitsPerComponent 8 /Filter /DCTDecode /Length {len(jpeg)} >>\nstream\n"
+        ).encode() + jpeg + b"\nendstream")
+        yield obj(content_id, f"<< /Length {len(content)} >>\nstream\n".encode() + content + b"\nendstream")
+        yield obj(page_id, (
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {pw} {ph}] "
+            f"/Resources << /XObject << /Im0 {image_id} 0 R >> >> /Contents {content_id} 0 R >>"
+        ).encode())
+        page_ids.append(page_id)
+
+    kids = " ".join(f"{i} 0 R" for i in page_ids)
+    yield obj(2, f"<< /Type /Pages /Kids [{kids}] /Count {len(page_ids)} >>".encode())
+    yield obj(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+
+    size = next_id
+    xref = [f"xref\n0 {size}\n", "0000000000 65535 f \n"]
+    xref += [f"{offsets[i]:010d} 00000 n \n" for i in range(1, size)]
+    xref.append(f"trailer\n<< /Size {size} /Root 1 0 R >>\nstartxref\n{pos}\n%%EOF\n")
+    yield "".join(xref).encode()
@@ -1,7 +1,33 @@
+from sqlalchemy import and_, case, insert, literal, or_, select
 from sqlalchemy.orm import Session
 from sqlalchemy.sql import func
-from . import models, utils
-from datetime import date, datetime
+from . import events, images, messages, models, wa_cloud
+from .cache import StudentCardCache, TreasuryCache, MonthlyRollupCache, SharedVersions
+from .search import StudentSearchIndex, normalize
+from datetime import date, datetime, time, timedelta
+import base64
+import hashlib
+import json
+import os
+import re
+
+# uuid -> scanner card (see get_student_card); invalidated by every write that changes a card
+student_cards = StudentCardCache()
+# running treasury totals (see get_treasury_summary); payments/expenses/book sales apply deltas
+treasury_cache = TreasuryCache()
+# per-day sums of closed months for get_treasury_report
+treasury_rollups = MonthlyRollupCache()
+# name/uuid search (see search_students); kept in sync by create_student / delete_student
+search_index = StudentSearchIndex()
+# writes by other processes on the same database (see app/cache.py); checked by every cached read
+cache_versions = SharedVersions(models.CacheVersion.__table__, {
+    "students": "students", "classes": "students", "groups": "students",
+    "payments": "money", "student_books": "money", "books": "money", "expenses": "money",
+}, ttl=float(os.environ.get("CACHE_TTL", "300")))
+# a student's class/group moves their income to another treasury group; closed months only change with money
+cache_versions.on_change("students", student_cards.clear, search_index.reset, treasury_cache.invalidate)
+cache_versions.on_change("money", student_cards.clear, treasury_cache.invalidate, treasury_rollups.clear)
+cache_versions.listen(Session)
 
 def create_student(db: Session, uuid_code: str, first_name: str, last_name: str=None, parent_name: str=None, parent_phone: str=None, class_id: int=None, group_id: int=None):
     # The uuid_code is now passed from the RFID card reader instead of being generated.
@@ -18,10 +44,165 @@ def create_student(db: Session, uuid_code: str, first_name: str, last_name: str=
     db.add(student)
     db.commit()
     db.refresh(student)
-    utils.generate_code128_image(student.uuid)
-    utils.generate_qr_image(student.uuid)
+    student_cards.invalidate(student.uuid)
+    search_index.add(student.id, student.first_name, student.last_name, student.uuid)
+    # barcode/QR are rendered in the background (and on first request if still missing)
+    images.renderer.submit(student.uuid)
     return student
 
+# ---------------------- Bulk import (POST /api/students/import) ----------------------
+IMPORT_BATCH_SIZE = 500
+_PHONE = re.compile(r"^\+?\d{6,15}$")
+
+
+def import_students(db: Session, rows, dry_run: bool = False, batch_size: int = IMPORT_BATCH_SIZE) -> dict:
+    """
+    Validates and inserts students from (row_number, fields) pairs (see app/importer.py).
+    Class/group names are matched like the search box does (Arabic normalization).
+    Valid rows are inserted in batches, one executemany INSERT and commit per batch;
+    card images are rendered afterwards as one background job.
+    Returns a report with the errors of every rejected row.
+    """
+    classes = {normalize(name): cid for cid, name in db.query(models.Class.id, models.Class.name)}
+    class_ids = set(classes.values())
+    group_class = {}      # group id -> class id
+    groups_by_key = {}    # (class id, normalized name) -> group id
+    groups_by_name = {}   # normalized name -> [group ids]
+    for gid, name, cid in db.query(models.Group.id, models.Group.name, models.Group.class_id):
+        group_class[gid] = cid
+        groups_by_key[(cid, normalize(name))] = gid
+        groups_by_name.setdefault(normalize(name), []).append(gid)
+
+    report = {"total": 0, "inserted": 0, "failed": 0, "errors": []}
+    inserted_uuids = []
+    seen = set()
+    batch = []
+
+    def reject(row_number, uuid_code, errors):
+        report["failed"] += 1
+        report["errors"].append({"row": row_number, "uuid": uuid_code, "errors": errors})
+
+    def flush():
+        uuids = [r["uuid"] for _, r in batch]
+        existing = {u for (u,) in db.query(models.Student.uuid).filter(models.Student.uuid.in_(uuids))}
+        good = []
+        for row_number, r in batch:
+            if r["uuid"] in existing:
+                reject(row_number, r["uuid"], ["duplicate_uuid"])
+            else:
+                good.append(r)
+        batch.clear()
+        if not good:
+            return
+        report["inserted"] += len(good)
+        if dry_run:
+            return
+        db.execute(insert(models.Student), good)
+        db.commit()
+        good_uuids = [r["uuid"] for r in good]
+        for sid, first_name, last_name, uuid_code in db.query(
+                models.Student.id, models.Student.first_name, models.Student.last_name, models.Student.uuid)\
+                .filter(models.Student.uuid.in_(good_uuids)):
+            student_cards.invalidate(uuid_code)
+            search_index.add(sid, first_name, last_name, uuid_code)
+        inserted_uuids.extend(good_uuids)
+
+    for row_number, fields in rows:
+        report["total"] += 1
+        errors = []
+        uuid_code = fields.get("uuid")
+        if not uuid_code:
+            errors.append("missing_uuid")
+        elif len(uuid_code) > 64:
+            errors.append("uuid_too_long")
+        elif uuid_code in seen:
+            errors.append("duplicate_uuid_in_file")
+        if not fields.get("first_name"):
+            errors.append("missing_first_name")
+        phone = (fields.get("parent_phone") or "").replace(" ", "").replace("-", "")
+        if phone and not _PHONE.match(phone):
+            errors.append("invalid_phone")
+
+        class_id = None
+        if "class_id" in fields:
+            class_id = int(fields["class_id"]) if fields["class_id"].isdigit() else None
+            if class_id not in class_ids:
+                errors.append("unknown_class")
+        elif "class_name" in fields:
+            class_id = classes.get(normalize(fields["class_name"]))
+            if class_id is None:
+                errors.append("unknown_class")
+
+        group_id = None
+        if "group_id" in fields:
+            group_id = int(fields["group_id"]) if fields["group_id"].isdigit() else None
+            if group_id not in group_class:
+                errors.append("unknown_group")
+                group_id = None
+        elif "group_name" in fields:
+            key = normalize(fields["group_name"])
+            if class_id is not None:
+                group_id = groups_by_key.get((class_id, key))
+            else:
+                candidates = groups_by_name.get(key, [])
+                group_id = candidates[0] if len(candidates) == 1 else None
+                if len(candidates) > 1:
+                    errors.append("ambiguous_group")
+            if group_id is None and "ambiguous_group" not in errors:
+                errors.append("unknown_group")
+        if group_id is not None:
+            if class_id is None and "unknown_class" not in errors:
+                class_id = group_class[group_id]
+            elif class_id is not None and group_class[group_id] != class_id:
+                errors.append("group_not_in_class")
+
+        if errors:
+            reject(row_number, uuid_code, errors)
+            continue
+        seen.add(uuid_code)
+        batch.append((row_number, {
+            "uuid": uuid_code,
+            "first_name": fields["first_name"][:100],
+            "last_name": fields.get("last_name"),
+            "parent_name": fields.get("parent_name"),
+            "parent_phone": phone or None,
+            "class_id": class_id,
+            "group_id": group_id,
+        }))
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+
+    report["errors"].sort(key=lambda e: e["row"])
+    report["image_job_id"] = images.renderer.render_batch(inserted_uuids)["id"] if inserted_uuids else None
+    return report
+
+def list_student_uuids(db: Session, class_id: int = None, group_id: int = None):
+    q = db.query(models.Student.uuid)
+    if class_id is not None:
+        q = q.filter(models.Student.class_id == class_id)
+    if group_id is not None:
+        q = q.filter(models.Student.group_id == group_id)
+    return [u for (u,) in q.order_by(models.Student.id.asc()) if u]
+
+def list_card_students(db: Session, class_id: int = None, group_id: int = None):
+    """Rows for printing ID cards: name, uuid, class_name, group_name (one joined query)."""
+    q = db.query(models.Student.first_name, models.Student.last_name, models.Student.uuid,
+                 models.Class.name, models.Group.name)\
+        .outerjoin(models.Class, models.Student.class_id == models.Class.id)\
+        .outerjoin(models.Group, models.Student.group_id == models.Group.id)
+    if class_id is not None:
+        q = q.filter(models.Student.class_id == class_id)
+    if group_id is not None:
+        q = q.filter(models.Student.group_id == group_id)
+    return [{
+        "name": f"{first_name} {last_name or ''}".strip(),
+        "uuid": uuid_code,
+        "class_name": class_name,
+        "group_name": group_name,
+    } for first_name, last_name, uuid_code, class_name, group_name in q.order_by(models.Student.id.asc()) if uuid_code]
+
 # جلب كل الصفوف
 def get_all_classes(db: Session):
     return db.query(models.Class).order_by(models.Class.id.asc()).all()
@@ -33,12 +214,195 @@ def get_all_groups(db: Session, class_id: int = None):
         q = q.filter(models.Group.class_id == class_id)
     return q.order_by(models.Group.id.asc()).all()
 
+def get_group_roster(db: Session, class_id: int = None, include_members: bool = False):
+    """
+    Groups with their class name, price and member count (one LEFT JOIN on a
+    COUNT ... GROUP BY group_id over ix_students_group_id); with include_members,
+    every group's students come from one more column-only query.
+    """
+    counts = db.query(models.Student.group_id.label("group_id"), func.count(models.Student.id).label("n"))\
+        .filter(models.Student.group_id.isnot(None))\
+        .group_by(models.Student.group_id)\
+        .subquery()
+    q = db.query(models.Group.id, models.Group.name, models.Group.class_id, models.Class.name,
+                 models.Group.subscription_price, func.coalesce(counts.c.n, 0))\
+        .outerjoin(models.Class, models.Group.class_id == models.Class.id)\
+        .outerjoin(counts, counts.c.group_id == models.Group.id)
+    if class_id:
+        q = q.filter(models.Group.class_id == class_id)
+    roster = [{
+        "id": gid,
+        "name": name,
+        "class_id": cid,
+        "class_name": class_name,
+        "subscription_price": price,
+        "student_count": n,
+    } for gid, name, cid, class_name, price, n in q.order_by(models.Group.id.asc())]
+
+    if include_members:
+        by_group = {g["id"]: g for g in roster}
+        for g in roster:
+            g["students"] = []
+        mq = db.query(models.Student.id, models.Student.uuid, models.Student.first_name,
+                      models.Student.last_name, models.Student.group_id)\
+            .filter(models.Student.group_id.isnot(None))
+        if class_id:
+            mq = mq.join(models.Group, models.Student.group_id == models.Group.id)\
+                .filter(models.Group.class_id == class_id)
+        for sid, uuid_code, first_name, last_name, gid in mq.order_by(models.Student.first_name, models.Student.id):
+            group = by_group.get(gid)
+            if group is not None:
+                group["students"].append({"id": sid, "uuid": uuid_code, "first_name": first_name, "last_name": last_name})
+    return roster
+
 def get_student_by_uuid(db: Session, uuid_code: str):
     return db.query(models.Student).filter(models.Student.uuid == uuid_code).first()
 
+def get_student_card(db: Session, uuid_code: str):
+    """
+    Scanner view of a student (identity, class/group, parent phone, last payment date)
+    as a plain dict, served from `student_cards` and loaded with one joined query on a miss.
+    Returns None for unknown cards. Do not mutate the returned dict.
+    """
+    cache_versions.sync(db)
+    card = student_cards.get(uuid_code)
+    if card is not None:
+        return card
+    # taken before the SELECT: a payment/group change committed meanwhile makes put() a no-op
+    generation = student_cards.begin_load()
+    last_paid_q = select(func.max(models.Payment.payment_date))\
+        .where(models.Payment.student_id == models.Student.id)\
+        .scalar_subquery()
+    row = db.query(models.Student, models.Class.name, models.Group.name, models.Group.subscription_price, last_paid_q)\
+        .outerjoin(models.Class, models.Student.class_id == models.Class.id)\
+        .outerjoin(models.Group, models.Student.group_id == models.Group.id)\
+        .filter(models.Student.uuid == uuid_code)\
+        .first()
+    if not row:
+        return None
+    s, class_name, group_name, group_price, last_paid_date = row
+    card = {
+        "id": s.id,
+        "uuid": s.uuid,
+        "first_name": s.first_name,
+        "last_name": s.last_name,
+        "parent_name": s.parent_name,
+        "parent_phone": s.parent_phone,
+        "class_id": s.class_id,
+        "class_name": class_name,
+        "group_id": s.group_id,
+        "group_name": group_name,
+        "group_price": group_price,
+        "last_paid_date": last_paid_date,
+    }
+    student_cards.put(uuid_code, card, generation)
+    return card
+
+
+PROFILE_RESULTS_LIMIT = 20
+PROFILE_BOOKS_LIMIT = 50
+
+
+def _profile_head(db: Session, student_id: int):
+    """
+    Identity row of a profile plus everything its ETag depends on, in one SELECT:
+    class/group joins and correlated MAX/COUNT subqueries over the per-student
+    indexes (last attendance, last payment, results and purchases).
+    """
+    Att, ST, SB = models.SessionAttendance, models.StudentTest, models.StudentBook
+    last_att_q = select(func.max(Att.session_date))\
+        .where(Att.student_id == models.Student.id, Att.status != 'absent').scalar_subquery()
+    last_paid_q = select(func.max(models.Payment.payment_date))\
+        .where(models.Payment.student_id == models.Student.id).scalar_subquery()
+    return db.query(
+        models.Student, models.Class.name, models.Group.name, models.Group.subscription_price,
+        last_att_q, last_paid_q,
+        # count + max id: changes on every insert (results/purchases are never edited in place)
+        select(func.count(ST.id)).where(ST.student_id == models.Student.id).scalar_subquery(),
+        select(func.max(ST.id)).where(ST.student_id == models.Student.id).scalar_subquery(),
+        select(func.count(SB.id)).where(SB.student_id == models.Student.id).scalar_subquery(),
+        select(func.max(SB.id)).where(SB.student_id == models.Student.id).scalar_subquery(),
+    ).outerjoin(models.Class, models.Student.class_id == models.Class.id)\
+        .outerjoin(models.Group, models.Student.group_id == models.Group.id)\
+        .filter(models.Student.id == student_id)\
+        .first()
+
+
+def get_student_profile(db: Session, student_id: int, if_none_match: str = None):
+    """
+    Everything the dashboard / student card show about one student: identity,
+    class/group and price, last attendance, payment status, recent results and
+    book purchases, from three queries (head, results, purchases).
+
+    Returns None for an unknown student, else (etag, profile); profile is None
+    when `if_none_match` (the client's ETag) still matches, and only the head
+    query has run. The ETag includes today's date since payment_status counts days.
+    """
+    head = _profile_head(db, student_id)
+    if head is None:
+        return None
+    s, class_name, group_name, group_price, last_att, last_paid = head[:6]
+    fingerprint = (s.uuid, s.first_name, s.last_name, s.parent_name, s.parent_phone, s.class_id, s.group_id,
+                   class_name, group_name, group_price, last_att, last_paid, *head[6:], date.today())
+    etag = '"' + hashlib.sha1(repr(fingerprint).encode("utf-8")).hexdigest()[:20] + '"'
+    if if_none_match and (if_none_match.strip() == "*" or etag in [t.strip().removeprefix("W/") for t in if_none_match.split(",")]):
+        return etag, None
+
+    ST, SB = models.StudentTest, models.StudentBook
+    results = db.query(ST.score, ST.recorded_at, models.Test.id, models.Test.name, models.Test.max_score)\
+        .join(models.Test, ST.test_id == models.Test.id)\
+        .filter(ST.student_id == student_id)\
+        .order_by(ST.recorded_at.desc(), ST.id.desc())\
+        .limit(PROFILE_RESULTS_LIMIT).all()
+    books = db.query(SB.buy_date, models.Book.id, models.Book.name, models.Book.price, models.Book.type)\
+        .join(models.Book, SB.book_id == models.Book.id)\
+        .filter(SB.student_id == student_id)\
+        .order_by(SB.buy_date.desc(), SB.id.desc())\
+        .limit(PROFILE_BOOKS_LIMIT).all()
+
+    profile = {
+        "student": {
+            "id": s.id,
+            "uuid": s.uuid,
+            "first_name": s.first_name,
+            "last_name": s.last_name,
+            "parent_name": s.parent_name,
+            "parent_phone": s.parent_phone,
+            "class_id": s.class_id,
+            "class_name": class_name,
+            "group_id": s.group_id,
+            "group_name": group_name,
+            "group_price": group_price,
+        },
+        "last_attendance": str(last_att) if last_att else None,
+        "payment_status": payment_status_from_date(last_paid),
+        "results": [{
+            "test_id": test_id, "test_name": test_name, "score": score, "max_score": max_score,
+            "recorded_at": recorded_at.isoformat() if recorded_at else None,
+        } for score, recorded_at, test_id, test_name, max_score in results],
+        "books": [{
+            "id": book_id, "name": name, "price": price, "type": book_type,
+            "buy_date": buy_date.isoformat() if buy_date else None,
+        } for buy_date, book_id, name, price, book_type in books],
+    }
+    return etag, profile
+
+def change_student_group(db: Session, student_id: int, group_id: int) -> bool:
+    student = db.query(models.Student).filter(models.Student.id == student_id).first()
+    if not student:
+        return False
+    student.group_id = group_id
+    db.commit()
+    student_cards.invalidate_student(student_id)
+    treasury_cache.invalidate()
+    _publish_treasury("reset")
+    return True
+
 def get_last_attendance(db: Session, student_id: int):
+    # "absent" rows (bulk marking / fill_absent) are not attendance
     return db.query(models.SessionAttendance)\
-        .filter(models.SessionAttendance.student_id == student_id)\
+        .filter(models.SessionAttendance.student_id == student_id,
+                models.SessionAttendance.status != 'absent')\
         .order_by(models.SessionAttendance.session_date.desc())\
         .first()
 
@@ -53,8 +417,49 @@ def mark_attendance(db: Session, student_id: int, status="present", score=None,
     db.add(att)
     db.commit()
     db.refresh(att)
+    s = db.query(models.Student.first_name, models.Student.last_name, models.Student.uuid,
+                 models.Student.class_id, models.Student.group_id).filter(models.Student.id == student_id).first()
+    if s:
+        events.hub.publish("checkin", {
+            "student_id": student_id, "name": _full_name(s.first_name, s.last_name), "uuid": s.uuid,
+            "class_id": s.class_id, "group_id": s.group_id,
+            "status": status, "at": att.session_date, "recorded_by": recorded_by,
+        })
     return att
 
+def _full_name(first_name, last_name):
+    return f"{first_name or ''} {last_name or ''}".strip()
+
+
+def _publish_checkin(payload: dict, recorded_by: str):
+    """Tells the dashboards about an attendance check_in_student just recorded (after commit)."""
+    student = payload["student"]
+    events.hub.publish("checkin", {
+        "student_id": student["id"],
+        "name": _full_name(student["first_name"], student["last_name"]),
+        "uuid": student["uuid"],
+        "class_id": student["class_id"],
+        "group_id": student["group_id"],
+        "status": payload["attendance_status"],
+        "at": payload["auto_marked_attendance"],
+        "recorded_by": recorded_by,
+    })
+
+
+def _publish_treasury(kind: str, amount: float = None, group_key=None):
+    """Treasury delta for the dashboards, mirroring what treasury_cache just applied.
+
+    kind is "payments", "book_sales", "expenses", or "reset" when the cache was
+    invalidated and screens should re-read /api/treasury/summary.
+    """
+    data = {"kind": kind}
+    if amount is not None:
+        data["amount"] = amount
+    if group_key is not None:
+        data["class_id"], data["group_id"] = group_key
+    events.hub.publish("treasury", data)
+
+
 def add_payment(db: Session, student_id: int, amount: float, method="cash", note=None):
     p = models.Payment(
         student_id=student_id,
@@ -66,19 +471,251 @@ def add_payment(db: Session, student_id: int, amount: float, method="cash", note
     db.add(p)
     db.commit()
     db.refresh(p)
+    student_cards.invalidate_student(student_id)
+    s = db.query(models.Student.first_name, models.Student.last_name, models.Student.uuid,
+                 models.Student.class_id, models.Student.group_id).filter(models.Student.id == student_id).first()
+    group_key = (s.class_id or 0, s.group_id or 0) if s else None
+    treasury_cache.add_income("payments", amount, group_key)
+    if s:
+        events.hub.publish("payment", {
+            "student_id": student_id, "name": _full_name(s.first_name, s.last_name), "uuid": s.uuid,
+            "class_id": s.class_id, "group_id": s.group_id,
+            "amount": amount, "method": method, "payment_date": p.payment_date,
+            "payment_status": payment_status_from_date(p.payment_date),
+        })
+    _publish_treasury("payments", amount, group_key)
     return p
 
+def payment_status_from_date(last_paid_date):
+    if not last_paid_date:
+        return {"status": "no_payment", "days_since": None}
+    days = (date.today() - last_paid_date).days
+    state = "green" if days < 25 else ("yellow" if days <= 30 else "red")
+    return {"status": state, "days_since": days, "last_paid_date": str(last_paid_date)}
+
 def get_payment_status(db: Session, student_id: int):
     # بسيط: نجيب اخر دفعة ونحسب الفرق بالأيام
     last = db.query(models.Payment)\
         .filter(models.Payment.student_id == student_id)\
         .order_by(models.Payment.payment_date.desc())\
         .first()
-    if not last:
-        return {"status": "no_payment", "days_since": None}
-    days = (date.today() - last.payment_date).days
-    state = "green" if days < 25 else ("yellow" if days <= 30 else "red")
-    return {"status": state, "days_since": days, "last_paid_date": str(last.payment_date)}
+    return payment_status_from_date(last.payment_date if last else None)
+
+
+def day_bounds(day: date):
+    """Half-open [start, end) datetime range for a calendar day (index friendly, unlike func.date())."""
+    start = datetime.combine(day, time.min)
+    return start, start + timedelta(days=1)
+
+
+# scans replayed from an offline buffer keep their tap time (corrected by the sender's clock
+# skew, see check_in_batch); times ahead of the server are clamped
+SCAN_CLOCK_SKEW = timedelta(minutes=5)
+# replayed taps older than this are not recorded (a forgotten queue, a clock far off)
+SCAN_MAX_AGE = timedelta(hours=float(os.environ.get("SCAN_MAX_AGE_HOURS", "72")))
+
+
+def parse_client_time(value):
+    """ISO timestamp from a scanner (UTC 'Z' or with offset) -> naive local datetime; None if missing/invalid."""
+    if not value:
+        return None
+    try:
+        dt = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if dt.tzinfo is not None:
+        dt = dt.astimezone().replace(tzinfo=None)
+    return dt
+
+
+def parse_scan_time(value, skew: timedelta = None):
+    """Tap time of a buffered scan on the server's clock: the client time shifted by `skew`, clamped to now."""
+    dt = parse_client_time(value)
+    if dt is None:
+        return None
+    if skew:
+        dt += skew
+    return datetime.now() if dt > datetime.now() + SCAN_CLOCK_SKEW else dt
+
+
+def _lock_student(db: Session, student_id: int):
+    """Serializes check-ins of one student on server databases until commit.
+
+    SQLite runs one writer at a time, so its conditional INSERT is enough; under
+    PostgreSQL's read committed two transactions could both pass NOT EXISTS.
+    """
+    if db.get_bind().dialect.name != "sqlite":
+        db.query(models.Student.id).filter(models.Student.id == student_id).with_for_update().one()
+
+
+def check_in_student(db: Session, uuid_code: str, recorded_by: str = "RFID_scan", scanned_at: datetime = None, commit: bool = True):
+    """
+    Fast path for /api/scan: the student card comes from `student_cards` (one joined
+    query on a miss), then today's and the last attendance are read in one SELECT
+    (MAX over the (student_id, session_date) index, today = half-open range)
+    and today's attendance is inserted if missing; a student already filled in as
+    absent today is switched to late instead. Returns the scan payload, or None
+    if the card is unknown.
+
+    `scanned_at` (replayed offline scans) sets both the recorded time and the day
+    checked, so replaying the same tap again is a no-op, also while the live POST
+    of that tap is still running: the row is inserted with INSERT ... WHERE NOT
+    EXISTS (and the student row locked on PostgreSQL). With commit=False nothing
+    is committed (check_in_batch commits once and publishes the check-ins).
+    """
+    card = get_student_card(db, uuid_code)
+    if card is None:
+        return None
+
+    Att = models.SessionAttendance
+    tap_time = scanned_at or datetime.now()
+    day_start, day_end = day_bounds(tap_time.date())
+    in_today = and_(Att.session_date >= day_start, Att.session_date < day_end)
+    attended = Att.status != 'absent'
+    last_att_date, today_att_date, absent_today_id = db.query(
+        func.max(case((attended, Att.session_date))),
+        func.max(case((and_(in_today, attended), Att.session_date))),
+        func.max(case((and_(in_today, Att.status == 'absent'), Att.id))),
+    ).filter(Att.student_id == card["id"]).one()
+
+    payload = {
+        "student": {
+            "id": card["id"],
+            "first_name": card["first_name"],
+            "last_name": card["last_name"],
+            "uuid": card["uuid"],
+            "parent_phone": card["parent_phone"],
+            "class_id": card["class_id"],
+            "group_id": card["group_id"],
+        },
+        "payment_status": payment_status_from_date(card["last_paid_date"]),
+        "auto_marked_attendance": None,
+        "attendance_status": None,
+    }
+
+    if today_att_date is None:
+        # the read above can race with a second tap of the same card (live POST + replay):
+        # the write re-checks in the same statement and reports whether it changed anything
+        _lock_student(db, card["id"])
+        if absent_today_id is not None:
+            marked = db.query(Att).filter(Att.id == absent_today_id, Att.status == 'absent')\
+                .update({"status": "late", "session_date": tap_time, "recorded_by": recorded_by}, synchronize_session=False)
+        else:
+            marked_today = select(Att.id).where(Att.student_id == card["id"], in_today, attended).exists()
+            marked = db.execute(insert(Att).from_select(
+                ["student_id", "session_date", "status", "recorded_by"],
+                select(literal(card["id"]), literal(tap_time, Att.session_date.type),
+                       literal("present"), literal(recorded_by)).where(~marked_today),
+            ).returning(Att.id)).first() is not None
+        if marked:
+            last_att_date = max(last_att_date, tap_time) if last_att_date else tap_time
+            payload["auto_marked_attendance"] = str(tap_time)
+            payload["attendance_status"] = "late" if absent_today_id is not None else "present"
+        if commit:
+            db.commit()
+            if marked:
+                _publish_checkin(payload, recorded_by)
+
+    payload["last_attendance"] = str(last_att_date) if last_att_date else None
+    return payload
+
+def check_in_batch(db: Session, scans: list, recorded_by: str = "RFID_scan", sent_at: datetime = None) -> list:
+    """
+    Replays buffered scans ({id, code, scanned_at}) in tap order within one transaction.
+    Idempotent: a tap for a day the student is already marked changes nothing.
+
+    `sent_at` is the sender's clock when it posted the batch; its difference to the
+    server clock is added to every scanned_at, so a desk whose clock is set to the
+    wrong day still records the right one. Taps older than SCAN_MAX_AGE are dropped.
+    Returns [{id, status}] with status marked / already_marked / not_found / too_old / invalid.
+    """
+    now = datetime.now()
+    skew = now - sent_at if sent_at else None
+    parsed = []
+    results = {}
+    for i, scan in enumerate(scans):
+        scan_id = scan.get("id", i) if isinstance(scan, dict) else i
+        code = (scan.get("code") or "").strip() if isinstance(scan, dict) else ""
+        if not code:
+            results[i] = {"id": scan_id, "status": "invalid"}
+            continue
+        tap_time = parse_scan_time(scan.get("scanned_at"), skew) or now
+        if tap_time < now - SCAN_MAX_AGE:
+            results[i] = {"id": scan_id, "status": "too_old"}
+            continue
+        parsed.append((tap_time, i, scan_id, code))
+    marked = []
+    for tap_time, i, scan_id, code in sorted(parsed):
+        payload = check_in_student(db, code, recorded_by=recorded_by, scanned_at=tap_time, commit=False)
+        if payload is None:
+            status = "not_found"
+        elif payload["auto_marked_attendance"]:
+            status = "marked"
+            marked.append(payload)
+        else:
+            status = "already_marked"
+        results[i] = {"id": scan_id, "status": status}
+    db.commit()
+    for payload in marked:
+        _publish_checkin(payload, recorded_by)
+    return [results[i] for i in sorted(results)]
+
+
+ATTENDANCE_STATUSES = ("present", "absent", "late")
+
+
+def mark_group_attendance(db: Session, group_id: int, entries: list, day: date = None,
+                          fill_absent: bool = False, recorded_by: str = "manual") -> dict:
+    """
+    Marks a whole group for one session day in a single transaction.
+    `entries` is a list of {student_id, status}; students already marked that day
+    (scan or earlier bulk call) are skipped, and with fill_absent every other member
+    without a record gets an "absent" row. Returns counts plus per-entry errors.
+    """
+    day = day or date.today()
+    day_start, day_end = day_bounds(day)
+    session_time = datetime.now() if day == date.today() else datetime.combine(day, time(12, 0))
+
+    members = {sid for (sid,) in db.query(models.Student.id).filter(models.Student.group_id == group_id)}
+    Att = models.SessionAttendance
+    already = {sid for (sid,) in db.query(Att.student_id).distinct()
+               .join(models.Student, models.Student.id == Att.student_id)
+               .filter(models.Student.group_id == group_id,
+                       Att.session_date >= day_start, Att.session_date < day_end)}
+
+    errors = []
+    wanted = {}  # student id -> status (last entry wins)
+    for entry in entries:
+        if not isinstance(entry, dict):
+            errors.append({"student_id": None, "error": "invalid_entry"})
+            continue
+        sid, status = entry.get("student_id"), entry.get("status") or "present"
+        if isinstance(sid, str) and sid.isdigit():
+            sid = int(sid)
+        if sid not in members:
+            errors.append({"student_id": sid, "error": "not_in_group"})
+        elif status not in ATTENDANCE_STATUSES:
+            errors.append({"student_id": sid, "error": "invalid_status"})
+        else:
+            wanted[sid] = status
+    if fill_absent:
+        for sid in members - already - wanted.keys():
+            wanted[sid] = "absent"
+
+    skipped = sorted(wanted.keys() & already)
+    rows = [{"student_id": sid, "session_date": session_time, "status": status, "recorded_by": recorded_by}
+            for sid, status in sorted(wanted.items()) if sid not in already]
+    if rows:
+        db.execute(insert(Att), rows)
+    db.commit()
+
+    counts = dict.fromkeys(ATTENDANCE_STATUSES, 0)
+    for r in rows:
+        counts[r["status"]] += 1
+    if rows:
+        events.hub.publish("attendance_bulk", {"group_id": group_id, "session_date": str(day), **counts})
+    return {"session_date": str(day), "inserted": len(rows), **counts,
+            "skipped_already_marked": skipped, "errors": errors}
 
 # ---------------------- NEW FUNCTION ----------------------
 def get_all_students(db: Session):
@@ -88,18 +725,77 @@ def get_all_students(db: Session):
     return db.query(models.Student).order_by(models.Student.id.asc()).all()
 
 
-def search_students(db: Session, q: str):
+STUDENT_PAGE_ORDERS = ("id", "name")
+
+
+def encode_student_cursor(student, order: str = "id") -> str:
+    if order == "name":
+        raw = json.dumps([student.first_name, student.id], ensure_ascii=False)
+        return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+    return str(student.id)
+
+
+def decode_student_cursor(cursor: str, order: str = "id"):
+    """Returns the last seen id (order="id") or [first_name, id] (order="name"); raises ValueError if malformed."""
+    try:
+        if order == "name":
+            name, sid = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+            return name, int(sid)
+        return int(cursor)
+    except Exception as e:
+        raise ValueError(f"invalid cursor: {cursor!r}") from e
+
+
+def list_students_page(db: Session, after: str = None, limit: int = 50, order: str = "id", class_id: int = None, group_id: int = None):
+    """
+    Keyset (seek) pagination over students ordered by id or by (first_name, id).
+    Returns (students, next_cursor); next_cursor is None on the last page.
+    """
+    q = db.query(models.Student)
+    if class_id:
+        q = q.filter(models.Student.class_id == class_id)
+    if group_id:
+        q = q.filter(models.Student.group_id == group_id)
+
+    if order == "name":
+        if after:
+            name, last_id = decode_student_cursor(after, order)
+            q = q.filter(or_(
+                models.Student.first_name > name,
+                and_(models.Student.first_name == name, models.Student.id > last_id),
+            ))
+        q = q.order_by(models.Student.first_name.asc(), models.Student.id.asc())
+    else:
+        if after:
+            q = q.filter(models.Student.id > decode_student_cursor(after, order))
+        q = q.order_by(models.Student.id.asc())
+
+    # fetch one extra row to know whether another page exists
+    rows = q.limit(limit + 1).all()
+    students = rows[:limit]
+    next_cursor = encode_student_cursor(students[-1], order) if len(rows) > limit else None
+    return students, next_cursor
+
+
+def search_students(db: Session, q: str, limit: int = 50):
     """
-    Search students by first name, last name, or uuid (case-insensitive, partial match).
+    Search students by first name, last name, or uuid (Arabic-normalized exact/prefix/substring
+    match via `search_index`), best matches first.
+    Returns (student, class_name, group_name) rows from a single joined query.
     """
     if not q:
         return []
-    pattern = f"%{q}%"
-    return db.query(models.Student).filter(
-        (models.Student.first_name.ilike(pattern)) |
-        (models.Student.last_name.ilike(pattern)) |
-        (models.Student.uuid.ilike(pattern))
-    ).order_by(models.Student.id.asc()).all()
+    cache_versions.sync(db)
+    ids = search_index.search(db, q, limit=limit)
+    if not ids:
+        return []
+    rows = db.query(models.Student, models.Class.name, models.Group.name)\
+        .outerjoin(models.Class, models.Student.class_id == models.Class.id)\
+        .outerjoin(models.Group, models.Student.group_id == models.Group.id)\
+        .filter(models.Student.id.in_(ids))\
+        .all()
+    by_id = {row[0].id: row for row in rows}
+    return [by_id[i] for i in ids if i in by_id]
 
 def delete_student(db: Session, student_id: int) -> bool:
     """
@@ -119,68 +815,255 @@ def delete_student(db: Session, student_id: int) -> bool:
     db.query(models.MessageLog).filter(models.MessageLog.student_id == student_id).update({"student_id": None})
 
     # Now delete the student
+    uuid_code = student.uuid
     db.delete(student)
     db.commit()
+    student_cards.invalidate(uuid_code)
+    search_index.remove(student_id)
+    treasury_cache.invalidate()
+    treasury_rollups.clear()
+    _publish_treasury("reset")
     return True
 
 
+def _load_treasury_totals(db: Session):
+    """Raw treasury sums straight from SQL: three scalar SUMs and two GROUP BYs over (class_id, group_id)."""
+    total_payments = db.query(func.coalesce(func.sum(models.Payment.amount), 0.0)).scalar() or 0.0
+    total_book_sales = db.query(func.coalesce(func.sum(models.Book.price), 0.0))\
+        .select_from(models.StudentBook)\
+        .join(models.Book, models.StudentBook.book_id == models.Book.id)\
+        .scalar() or 0.0
+    total_expenses = db.query(func.coalesce(func.sum(models.Expense.amount), 0.0)).scalar() or 0.0
+
+    # income per (class, group) of the paying student; students without a class/group count under 0
+    by_group = {}
+    payment_rows = db.query(models.Student.class_id, models.Student.group_id, func.sum(models.Payment.amount))\
+        .join(models.Student, models.Payment.student_id == models.Student.id)\
+        .group_by(models.Student.class_id, models.Student.group_id)\
+        .all()
+    book_rows = db.query(models.Student.class_id, models.Student.group_id, func.sum(models.Book.price))\
+        .select_from(models.StudentBook)\
+        .join(models.Book, models.StudentBook.book_id == models.Book.id)\
+        .join(models.Student, models.StudentBook.student_id == models.Student.id)\
+        .group_by(models.Student.class_id, models.Student.group_id)\
+        .all()
+    for cls, grp, amt in list(payment_rows) + list(book_rows):
+        key = (cls or 0, grp or 0)
+        by_group[key] = by_group.get(key, 0.0) + (amt or 0.0)
+
+    return {
+        "payments": total_payments,
+        "book_sales": total_book_sales,
+        "expenses": total_expenses,
+        "by_group": by_group,
+    }
+
+
 def get_treasury_summary(db: Session):
     """
     Returns a summary of incomes (payments + book sales) grouped by class and group,
     and total incomes, total expenses, and balance.
+    Served from `treasury_cache` (kept current by the writers); computed with SQL aggregates on a miss.
     """
-    # إجمالي الدفعات
-    total_payments = db.query(models.Payment).with_entities(func.coalesce(func.sum(models.Payment.amount), 0.0)).scalar() or 0.0
-    # إجمالي مبيعات الكتب (join student_books -> books)
-    total_book_sales = 0.0
-    sb_q = db.query(models.StudentBook, models.Book).join(models.Book, models.StudentBook.book_id == models.Book.id).all()
-    for sb, b in sb_q:
-        total_book_sales += (b.price or 0.0)
-
-    total_income = (total_payments or 0.0) + (total_book_sales or 0.0)
-
-    # إجمالي المصروفات
-    total_expenses = db.query(models.Expense).with_entities(func.coalesce(func.sum(models.Expense.amount), 0.0)).scalar() or 0.0
-
-    # تجميع حسب صف ومجموعة: نحتاج مجموع الدفعات لكل طالب ثم جمعها حسب الصف/المجموعة
-    class_group_income = {}
-    payments = db.query(models.Payment, models.Student).join(models.Student, models.Payment.student_id == models.Student.id).all()
-    for p, s in payments:
-        cls = s.class_id or 0
-        grp = s.group_id or 0
-        key = (cls, grp)
-        class_group_income.setdefault(key, 0.0)
-        class_group_income[key] += (p.amount or 0.0)
-
-    # include book sales per student's class/group (approximate by student association)
-    sb_items = db.query(models.StudentBook, models.Book, models.Student).join(models.Book, models.StudentBook.book_id == models.Book.id).join(models.Student, models.StudentBook.student_id == models.Student.id).all()
-    for sb, b, s in sb_items:
-        cls = s.class_id or 0
-        grp = s.group_id or 0
-        key = (cls, grp)
-        class_group_income.setdefault(key, 0.0)
-        class_group_income[key] += (b.price or 0.0)
+    cache_versions.sync(db)
+    totals = treasury_cache.get()
+    if totals is None:
+        generation = treasury_cache.begin_load()
+        totals = _load_treasury_totals(db)
+        treasury_cache.store(totals, generation)
 
+    total_income = totals["payments"] + totals["book_sales"]
     # convert grouping into nested dict {class_id: {group_id: amount}}
     by_class = {}
-    for (cls, grp), amt in class_group_income.items():
+    for (cls, grp), amt in totals["by_group"].items():
         by_class.setdefault(cls, {})[grp] = round(amt, 2)
 
     return {
         "total_income": round(total_income, 2),
-        "total_payments": round(total_payments, 2),
-        "total_book_sales": round(total_book_sales, 2),
-        "total_expenses": round(total_expenses, 2),
-        "balance": round((total_income or 0.0) - (total_expenses or 0.0), 2),
+        "total_payments": round(totals["payments"], 2),
+        "total_book_sales": round(totals["book_sales"], 2),
+        "total_expenses": round(totals["expenses"], 2),
+        "balance": round(total_income - totals["expenses"], 2),
         "by_class": by_class
     }
 
 
+REPORT_BUCKETS = ("day", "week", "month")
+# longest from..to span per bucket, in days (the report has one row per bucket)
+REPORT_MAX_DAYS = {"day": 366, "week": 2 * 366, "month": 5 * 366}
+
+
+def _as_date(value):
+    # func.date() comes back as 'YYYY-MM-DD' text on SQLite
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value)[:10])
+
+
+def _next_month(day: date) -> date:
+    return (day.replace(day=1) + timedelta(days=32)).replace(day=1)
+
+
+def _daily_treasury_sums(db: Session, start: date, end: date):
+    """{day: {"payments", "book_sales", "expenses"}} for start..end (inclusive), one GROUP BY range scan per table."""
+    days = {}
+
+    def add(day, kind, amount):
+        sums = days.setdefault(_as_date(day), {"payments": 0.0, "book_sales": 0.0, "expenses": 0.0})
+        sums[kind] += amount or 0.0
+
+    payment_rows = db.query(models.Payment.payment_date, func.sum(models.Payment.amount))\
+        .filter(models.Payment.payment_date >= start, models.Payment.payment_date <= end)\
+        .group_by(models.Payment.payment_date)\
+        .all()
+    for day, amount in payment_rows:
+        add(day, "payments", amount)
+
+    range_start, _ = day_bounds(start)
+    _, range_end = day_bounds(end)
+    buy_day = func.date(models.StudentBook.buy_date)
+    book_rows = db.query(buy_day, func.sum(models.Book.price))\
+        .select_from(models.StudentBook)\
+        .join(models.Book, models.StudentBook.book_id == models.Book.id)\
+        .filter(models.StudentBook.buy_date >= range_start, models.StudentBook.buy_date < range_end)\
+        .group_by(buy_day)\
+        .all()
+    for day, amount in book_rows:
+        add(day, "book_sales", amount)
+
+    expense_rows = db.query(models.Expense.expense_date, func.sum(models.Expense.amount))\
+        .filter(models.Expense.expense_date >= start, models.Expense.expense_date <= end)\
+        .group_by(models.Expense.expense_date)\
+        .all()
+    for day, amount in expense_rows:
+        add(day, "expenses", amount)
+    return days
+
+
+def _collect_daily_sums(db: Session, start: date, end: date):
+    """Per-day sums for start..end: closed months from `treasury_rollups`, the rest from SQL."""
+    # server defaults stamp dates in UTC, so a month only counts as closed one day after it ends
+    open_from = (date.today() - timedelta(days=1)).replace(day=1)
+    cache_versions.sync(db)
+    daily = {}
+    missing = []
+    month = start.replace(day=1)
+    while month <= end and month < open_from:
+        cached = treasury_rollups.get((month.year, month.month))
+        if cached is None:
+            missing.append(month)
+        else:
+            daily.update(cached)
+        month = _next_month(month)
+
+    if missing:
+        loaded = _daily_treasury_sums(db, missing[0], _next_month(missing[-1]) - timedelta(days=1))
+        for m in missing:
+            month_days = {d: sums for d, sums in loaded.items() if d.year == m.year and d.month == m.month}
+            treasury_rollups.put((m.year, m.month), month_days)
+            daily.update(month_days)
+
+    if month <= end:
+        daily.update(_daily_treasury_sums(db, max(start, month), end))
+    return daily
+
+
+def get_treasury_report(db: Session, date_from: date, date_to: date, bucket: str = "day"):
+    """
+    Income (payments + book sales) and expenses for date_from..date_to (inclusive),
+    bucketed per day, ISO week or month. Empty buckets are included with zeros.
+    """
+    daily = _collect_daily_sums(db, date_from, date_to)
+    zero = {"payments": 0.0, "book_sales": 0.0, "expenses": 0.0}
+
+    if bucket == "week":
+        start = date_from - timedelta(days=date_from.weekday())
+    elif bucket == "month":
+        start = date_from.replace(day=1)
+    else:
+        start = date_from
+
+    rows = []
+    totals = dict(zero)
+    while start <= date_to:
+        if bucket == "week":
+            nxt = start + timedelta(days=7)
+            year, week, _ = start.isocalendar()
+            period = f"{year}-W{week:02d}"
+        elif bucket == "month":
+            nxt = _next_month(start)
+            period = start.strftime("%Y-%m")
+        else:
+            nxt = start + timedelta(days=1)
+            period = start.isoformat()
+
+        sums = dict(zero)
+        day = max(start, date_from)
+        last = min(nxt - timedelta(days=1), date_to)
+        while day <= last:
+            for kind, amount in daily.get(day, zero).items():
+                sums[kind] += amount
+            day += timedelta(days=1)
+        for kind in totals:
+            totals[kind] += sums[kind]
+
+        income = sums["payments"] + sums["book_sales"]
+        rows.append({
+            "period": period,
+            "start": str(max(start, date_from)),
+            "end": str(last),
+            "payments": round(sums["payments"], 2),
+            "book_sales": round(sums["book_sales"], 2),
+            "income": round(income, 2),
+            "expenses": round(sums["expenses"], 2),
+            "balance": round(income - sums["expenses"], 2),
+        })
+        start = nxt
+
+    total_income = totals["payments"] + totals["book_sales"]
+    return {
+        "from": str(date_from),
+        "to": str(date_to),
+        "bucket": bucket,
+        "rows": rows,
+        "totals": {
+            "payments": round(totals["payments"], 2),
+            "book_sales": round(totals["book_sales"], 2),
+            "income": round(total_income, 2),
+            "expenses": round(totals["expenses"], 2),
+            "balance": round(total_income - totals["expenses"], 2),
+        },
+    }
+
+
+def _student_group_key(db: Session, student_id: int):
+    row = db.query(models.Student.class_id, models.Student.group_id).filter(models.Student.id == student_id).first()
+    if not row:
+        return None
+    return (row[0] or 0, row[1] or 0)
+
+
+def buy_book(db: Session, student_id: int, book_id: int):
+    sb = models.StudentBook(student_id=student_id, book_id=book_id)
+    db.add(sb)
+    db.commit()
+    price = db.query(models.Book.price).filter(models.Book.id == book_id).scalar()
+    if price is not None:
+        group_key = _student_group_key(db, student_id)
+        treasury_cache.add_income("book_sales", price, group_key)
+        _publish_treasury("book_sales", price, group_key)
+    return sb
+
+
 def add_expense(db: Session, title: str, amount: float, note: str = None):
     e = models.Expense(title=title, amount=amount, note=note)
     db.add(e)
     db.commit()
     db.refresh(e)
+    treasury_cache.add_expense(amount)
+    _publish_treasury("expenses", amount)
     return e
 
 
@@ -189,53 +1072,183 @@ def list_expenses(db: Session, limit: int = 100):
 
 
 
-def generate_student_report(db: Session, student_id: int) -> str:
-    from datetime import timedelta
+def report_context(student, last_attendance_date, tests, last_paid_date) -> dict:
+    """
+    Template variables of one student's report. `tests` is a list of (test_name, score, max_score),
+    newest first (at most 2 are shown); dates may be None.
+    """
+    return {
+        "name": f"{student.first_name} {student.last_name or ''}".strip(),
+        "last_attendance": last_attendance_date,
+        "tests": list(tests or []),
+        "last_paid": last_paid_date,
+        "next_payment": last_paid_date + timedelta(days=30) if last_paid_date else None,
+    }
+
+
+def format_student_report(student, last_attendance_date, tests, last_paid_date) -> str:
+    """Builds the Arabic report text (templates/messages/student_report.txt)."""
+    return messages.render("student_report.txt", **report_context(student, last_attendance_date, tests, last_paid_date))
 
+
+def format_family_report(contexts: list) -> str:
+    """One message covering several children of the same parent (list of report_context dicts)."""
+    if len(contexts) == 1:
+        return messages.render("student_report.txt", **contexts[0])
+    return messages.render("family_report.txt", reports=contexts)
+
+
+def generate_student_report(db: Session, student_id: int) -> str:
     student = db.query(models.Student).filter(models.Student.id == student_id).first()
     if not student:
         return "لم يتم العثور على الطالب."
 
-    # 1. Student name
-    student_name = f"{student.first_name} {student.last_name or ''}".strip()
-
-    # 2. Last attendance date and time
     last_attendance = get_last_attendance(db, student_id)
-    last_attendance_str = str(last_attendance.session_date) if last_attendance else "لا يوجد تسجيل حضور"
-
-    # 3. Last 2 test scores
-    last_2_tests = db.query(models.StudentTest, models.Test)\
+    last_2_tests = db.query(models.Test.name, models.StudentTest.score, models.Test.max_score)\
         .join(models.Test, models.StudentTest.test_id == models.Test.id)\
         .filter(models.StudentTest.student_id == student_id)\
         .order_by(models.StudentTest.recorded_at.desc())\
         .limit(2).all()
-    
-    tests_scores_str = ""
-    if last_2_tests:
-        for st, t in last_2_tests:
-            tests_scores_str += f'{t.name}: {st.score}/{t.max_score}\n'
-    else:
-        tests_scores_str = "لا توجد درجات مسجلة"
-
-    # 4. Payment status and next payment date
-    payment_info = get_payment_status(db, student_id)
-    last_payment_date_str = ""
-    next_payment_date_str = ""
-    if payment_info['status'] == 'no_payment':
-        last_payment_date_str = "لا توجد دفعات مسجلة"
-        next_payment_date_str = "غير محدد"
-    else:
-        last_payment_date = datetime.strptime(payment_info['last_paid_date'], '%Y-%m-%d').date()
-        last_payment_date_str = str(last_payment_date)
-        next_payment_date = last_payment_date + timedelta(days=30)
-        next_payment_date_str = str(next_payment_date)
-
-    # Construct the report message
-    report = f"""السلام عليكم، هذا بخصوص {student_name}. آخر حضور: {last_attendance_str}. درجات التسميع والاختبارات
-{tests_scores_str}
-حالة الدفع: {last_payment_date_str}. موعد الدفع القادم: {next_payment_date_str}
-"""
-    return report
+    last_paid_date = db.query(func.max(models.Payment.payment_date))\
+        .filter(models.Payment.student_id == student_id)\
+        .scalar()
+    return format_student_report(
+        student,
+        last_attendance.session_date if last_attendance else None,
+        list(last_2_tests),
+        last_paid_date,
+    )
+
+
+def _group_report_contexts(db: Session, group_id: int = None, class_id: int = None):
+    """
+    Report data for every student of a group (or a whole class) in four set-based queries:
+    the students, MAX(session_date) and MAX(payment_date) per student, and the last two
+    test results per student via ROW_NUMBER() OVER (PARTITION BY student_id).
+    Returns [(student, report_context)] ordered by student id.
+    """
+    if group_id is None and class_id is None:
+        return []
+    q = db.query(models.Student)
+    if group_id is not None:
+        q = q.filter(models.Student.group_id == group_id)
+    if class_id is not None:
+        q = q.filter(models.Student.class_id == class_id)
+    students = q.order_by(models.Student.id.asc()).all()
+    if not students:
+        return []
+    member_ids = q.with_entities(models.Student.id).subquery()
+
+    Att = models.SessionAttendance
+    last_att = dict(db.query(Att.student_id, func.max(Att.session_date))
+                    .filter(Att.student_id.in_(select(member_ids.c.id)), Att.status != 'absent')
+                    .group_by(Att.student_id)
+                    .all())
+    last_paid = dict(db.query(models.Payment.student_id, func.max(models.Payment.payment_date))
+                     .filter(models.Payment.student_id.in_(select(member_ids.c.id)))
+                     .group_by(models.Payment.student_id)
+                     .all())
+
+    ranked = db.query(
+        models.StudentTest.student_id.label("student_id"),
+        models.Test.name.label("name"),
+        models.StudentTest.score.label("score"),
+        models.Test.max_score.label("max_score"),
+        func.row_number().over(
+            partition_by=models.StudentTest.student_id,
+            order_by=(models.StudentTest.recorded_at.desc(), models.StudentTest.id.desc()),
+        ).label("rn"),
+    ).join(models.Test, models.StudentTest.test_id == models.Test.id)\
+        .filter(models.StudentTest.student_id.in_(select(member_ids.c.id)))\
+        .subquery()
+    tests = {}
+    test_rows = db.query(ranked.c.student_id, ranked.c.name, ranked.c.score, ranked.c.max_score)\
+        .filter(ranked.c.rn <= 2)\
+        .order_by(ranked.c.student_id, ranked.c.rn)\
+        .all()
+    for sid, name, score, max_score in test_rows:
+        tests.setdefault(sid, []).append((name, score, max_score))
+
+    return [
+        (s, report_context(s, last_att.get(s.id), tests.get(s.id), last_paid.get(s.id)))
+        for s in students
+    ]
+
+
+def generate_group_reports(db: Session, group_id: int = None, class_id: int = None):
+    """Returns [(student, report_text)] for every student of a group (or a whole class), ordered by id."""
+    return [
+        (s, messages.render("student_report.txt", **ctx))
+        for s, ctx in _group_report_contexts(db, group_id=group_id, class_id=class_id)
+    ]
+
+
+def generate_group_messages(db: Session, group_id: int = None, class_id: int = None, merge_siblings: bool = False):
+    """
+    Report messages for a group/class as dicts {to_phone, content, student_id}.
+    With merge_siblings, students sharing a parent_phone get one family message
+    (attached to the first child); students without a phone are never merged.
+    """
+    rows = _group_report_contexts(db, group_id=group_id, class_id=class_id)
+    if not merge_siblings:
+        return [{
+            "to_phone": (s.parent_phone or '').strip(),
+            "content": messages.render("student_report.txt", **ctx),
+            "student_id": s.id,
+        } for s, ctx in rows]
+
+    families = {}
+    for s, ctx in rows:
+        phone = (s.parent_phone or '').strip()
+        key = phone or ('student', s.id)
+        families.setdefault(key, (phone, s.id, []))[2].append(ctx)
+    return [{
+        "to_phone": phone,
+        "content": format_family_report(contexts),
+        "student_id": first_student_id,
+    } for phone, first_student_id, contexts in families.values()]
+
+
+# ---------------------- Duplicate suppression for outgoing messages ----------------------
+# same content to the same phone within this many hours is skipped by bulk sends (0 = off)
+DEDUPE_WINDOW_HOURS = float(os.environ.get("WA_DEDUPE_HOURS", "24"))
+
+
+def content_hash(content: str) -> str:
+    return hashlib.sha1((content or '').encode('utf-8')).hexdigest()
+
+
+def drop_recent_duplicates(db: Session, batch: list, window_hours: float = None):
+    """
+    Removes messages whose (to_phone, content) was already sent, or is queued for an automatic
+    channel, within the window, or appears earlier in the same batch. Failed sends and manual
+    rows (channel NULL, still pending: nobody has sent them) don't count.
+    Returns (kept, skipped_count); kept messages carry their content_hash.
+    """
+    window_hours = DEDUPE_WINDOW_HOURS if window_hours is None else window_hours
+    for m in batch:
+        m["content_hash"] = content_hash(m["content"])
+    seen = set()
+    if window_hours > 0 and batch:
+        since = datetime.now() - timedelta(hours=window_hours)
+        hashes = list({m["content_hash"] for m in batch})
+        ml = models.MessageLog
+        for i in range(0, len(hashes), 500):
+            seen.update(db.query(ml.to_phone, ml.content_hash)
+                        .filter(ml.content_hash.in_(hashes[i:i + 500]),
+                                ml.created_at >= since,
+                                or_(ml.status == 'sent',
+                                    and_(ml.channel.isnot(None), ml.status != 'failed')))
+                        .all())
+    kept = []
+    for m in batch:
+        key = (m["to_phone"], m["content_hash"])
+        if key in seen:
+            continue
+        seen.add(key)
+        kept.append(m)
+    return kept, len(batch) - len(kept)
+
 
 # WhatsApp sessions and logs
 def create_wa_session(db: Session, name: str = None, session_data: str = None):
@@ -258,7 +1271,8 @@ def list_wa_sessions(db: Session):
     return db.query(models.WhatsAppSession).order_by(models.WhatsAppSession.created_at.desc()).all()
 
 def log_message(db: Session, to_phone: str, content: str, student_id: int = None, status: str = 'pending', error: str = None):
-    m = models.MessageLog(to_phone=to_phone, content=content, student_id=student_id, status=status, error=error)
+    m = models.MessageLog(to_phone=to_phone, content=content, student_id=student_id, status=status, error=error,
+                          content_hash=content_hash(content))
     db.add(m)
     db.commit()
     db.refresh(m)
@@ -268,10 +1282,10 @@ def list_message_logs(db: Session, limit: int = 200):
     return db.query(models.MessageLog).order_by(models.MessageLog.sent_at.desc()).limit(limit).all()
 
 
-def create_wa_account(db: Session, name: str = None, phone_number: str = None, phone_number_id: str = None, access_token: str = None, use_cloud_api: int = 0):
+def create_wa_account(db: Session, name: str = None, phone_number: str = None, phone_number_id: str = None, access_token: str = None, use_cloud_api: int = 0, daily_limit: int = None):
     a = models.WhatsAppAccount(name=name, phone_number=phone_number, connected=0,
                               phone_number_id=phone_number_id, access_token=access_token,
-                              use_cloud_api=use_cloud_api)
+                              use_cloud_api=use_cloud_api, daily_limit=daily_limit)
     db.add(a)
     db.commit()
     db.refresh(a)
@@ -285,50 +1299,290 @@ def delete_wa_account(db: Session, account_id: int):
     if not a: return False
     db.delete(a)
     db.commit()
+    wa_cloud.clients.forget(account_id)
     return True
 
 
-def send_via_whatsapp_cloud(db: Session, account_id: int, to_phone: str, message: str, student_id: int = None):
-    """Send a text message via WhatsApp Cloud API using stored credentials.
-    This is a best-effort helper; network errors are caught and logged in MessageLog.
+def _post_cloud_message(db: Session, account_id: int, to_phone: str, message: str):
+    """Send one text message through the account's pooled Cloud API client. Returns {ok, error, attempts, account_failure}."""
+    sender = wa_cloud.clients.for_account(db, account_id) if account_id else None
+    if sender is None:
+        return {"ok": False, "error": 'missing_credentials', "attempts": 0, "account_failure": True}
+    return sender.send(to_phone, message)
+
+
+# ---------------------- Cloud account dispatch (spreads bulk sends over every account) ----------------------
+# entry messaging tier; used as the weight of accounts without their own daily_limit
+DEFAULT_DAILY_LIMIT = 1000
+# a message bounced between failing accounts gives up after this many HTTP attempts
+REROUTE_ATTEMPT_LIMIT = 12
+
+
+def _cloud_accounts(db: Session):
+    return db.query(models.WhatsAppAccount)\
+        .filter(models.WhatsAppAccount.use_cloud_api == 1,
+                models.WhatsAppAccount.phone_number_id.isnot(None),
+                models.WhatsAppAccount.access_token.isnot(None))\
+        .order_by(models.WhatsAppAccount.id.asc())\
+        .all()
+
+
+def _cloud_usage_24h(db: Session) -> dict:
+    """account id -> messages sent in the last 24h plus those still queued on it."""
+    since = datetime.now() - timedelta(days=1)
+    m = models.MessageLog
+    rows = db.query(m.account_id, func.count(m.id))\
+        .filter(m.channel == 'cloud', m.account_id.isnot(None),
+                or_(m.status.in_(('pending', 'sending')), and_(m.status == 'sent', m.sent_at >= since)))\
+        .group_by(m.account_id)\
+        .all()
+    return dict(rows)
+
+
+def cloud_account_weights(db: Session, healthy_only: bool = False, exclude=()) -> dict:
     """
-    import requests
+    account id -> dispatch weight (remaining daily quota) for usable Cloud API accounts.
+    Unhealthy accounts (see wa_cloud.CloudSender.healthy) are left out; if every
+    account is unhealthy they are all used anyway unless healthy_only is set.
+    """
+    accounts = [a for a in _cloud_accounts(db) if a.id not in exclude]
+    if not accounts:
+        return {}
+    usage = _cloud_usage_24h(db)
+    weights, fallback = {}, {}
+    for a in accounts:
+        remaining = (a.daily_limit or DEFAULT_DAILY_LIMIT) - usage.get(a.id, 0)
+        weight = max(remaining, 1)
+        fallback[a.id] = weight
+        sender = wa_cloud.clients.for_account(db, a.id)
+        if sender is not None and sender.healthy():
+            weights[a.id] = weight
+    if weights or healthy_only:
+        return weights
+    return fallback
 
-    acc = db.query(models.WhatsAppAccount).filter(models.WhatsAppAccount.id == account_id).first()
-    if not acc or not acc.access_token or not acc.phone_number_id:
-        return log_message(db, to_phone=to_phone, content=message, student_id=student_id, status='failed', error='missing_credentials')
 
-    url = f"https://graph.facebook.com/v17.0/{acc.phone_number_id}/messages"
-    headers = {
-        'Authorization': f'Bearer {acc.access_token}',
-        'Content-Type': 'application/json'
-    }
-    payload = {
-        'messaging_product': 'whatsapp',
-        'to': to_phone,
-        'type': 'text',
-        'text': {'body': message}
-    }
+def assign_cloud_accounts(db: Session, n: int):
+    """Account id for each of n messages, spread by weight; None when no Cloud API account is configured."""
+    weights = cloud_account_weights(db)
+    if not weights:
+        return None
+    return wa_cloud.spread(weights, n)
+
+
+def pick_cloud_account(db: Session):
+    ids = assign_cloud_accounts(db, 1)
+    return ids[0] if ids else None
+
+
+def drain_cloud_account(db: Session, account_id: int) -> int:
+    """Moves the pending cloud messages of a failing account onto the healthy ones. Returns how many moved."""
+    m = models.MessageLog
+    ids = [mid for (mid,) in db.query(m.id)
+           .filter(m.status == 'pending', m.channel == 'cloud', m.account_id == account_id)
+           .order_by(m.id.asc())]
+    weights = cloud_account_weights(db, healthy_only=True, exclude={account_id}) if ids else {}
+    if not weights:
+        db.rollback()
+        return 0
+    by_account = {}
+    for mid, target in zip(ids, wa_cloud.spread(weights, len(ids))):
+        by_account.setdefault(target, []).append(mid)
+    moved = 0
+    for target, mids in by_account.items():
+        for i in range(0, len(mids), 500):
+            # status check: rows a worker claimed meanwhile stay where they are
+            moved += db.query(m)\
+                .filter(m.id.in_(mids[i:i + 500]), m.status == 'pending')\
+                .update({"account_id": target}, synchronize_session=False)
+    db.commit()
+    return moved
+
+
+def cloud_account_stats(db: Session) -> list:
+    usage = _cloud_usage_24h(db)
+    items = []
+    for a in _cloud_accounts(db):
+        sender = wa_cloud.clients.for_account(db, a.id)
+        limit = a.daily_limit or DEFAULT_DAILY_LIMIT
+        items.append({
+            "id": a.id,
+            "name": a.name,
+            "daily_limit": limit,
+            "used_24h": usage.get(a.id, 0),
+            "remaining": max(limit - usage.get(a.id, 0), 0),
+            **(sender.stats() if sender is not None else {}),
+        })
+    return items
+
+
+def _post_web_message(db: Session, to_phone: str, message: str):
+    """Send through WhatsApp Web automation (Playwright/pywhatkit). Returns (ok, error).
+
+    Uses the long-lived browser of the newest WhatsApp session (connected ones first);
+    the browser's storage state is written back to session_data so the login survives restarts.
+    """
     try:
-        r = requests.post(url, json=payload, headers=headers, timeout=15)
-        if r.status_code in (200, 201):
-            # mark as sent
-            return log_message(db, to_phone=to_phone, content=message, student_id=student_id, status='sent', error=None)
-        else:
-            return log_message(db, to_phone=to_phone, content=message, student_id=student_id, status='failed', error=r.text)
+        from . import wa_web
     except Exception as e:
-        return log_message(db, to_phone=to_phone, content=message, student_id=student_id, status='failed', error=str(e))
+        return False, f'wa_web_not_available:{e}'
+    session = db.query(models.WhatsAppSession)\
+        .order_by(models.WhatsAppSession.connected.desc(), models.WhatsAppSession.created_at.desc())\
+        .first()
+    storage_state = None
+    if session is not None and session.session_data:
+        try:
+            storage_state = json.loads(session.session_data)
+        except ValueError:
+            storage_state = None
+    sender = wa_web.get_sender(session.id if session else None, storage_state=storage_state)
+    res = wa_web.send_via_web_best_effort(to_phone, message, sender=sender)
+    if session is not None:
+        state = sender.take_storage_state()
+        if state is not None:
+            set_wa_session_connected(db, session.id, True, session_data=json.dumps(state))
+    return bool(res.get('ok')), res.get('error')
+
+
+def send_via_whatsapp_cloud(db: Session, account_id: int, to_phone: str, message: str, student_id: int = None):
+    """Send a text message via WhatsApp Cloud API using stored credentials.
+    This is a best-effort helper; network errors are caught and logged in MessageLog.
+    """
+    res = _post_cloud_message(db, account_id, to_phone, message)
+    m = models.MessageLog(to_phone=to_phone, content=message, student_id=student_id,
+                          content_hash=content_hash(message),
+                          status='sent' if res["ok"] else 'failed', error=res["error"],
+                          channel='cloud', account_id=account_id, attempts=res["attempts"],
+                          sent_at=datetime.now() if res["ok"] else None)
+    db.add(m)
+    db.commit()
+    db.refresh(m)
+    return m
 
 
 def send_via_whatsapp_web(db: Session, to_phone: str, message: str, student_id: int = None):
     """Attempt to send via WhatsApp Web automation (Playwright/pywhatkit)."""
-    try:
-        from .wa_web import send_via_web_best_effort
-    except Exception as e:
-        return log_message(db, to_phone=to_phone, content=message, student_id=student_id, status='failed', error=f'wa_web_not_available:{e}')
+    ok, error = _post_web_message(db, to_phone, message)
+    return log_message(db, to_phone=to_phone, content=message, student_id=student_id, status='sent' if ok else 'failed', error=error)
+
 
-    res = send_via_web_best_effort(to_phone, message)
-    if res.get('ok'):
-        return log_message(db, to_phone=to_phone, content=message, student_id=student_id, status='sent', error=None)
+# ---------------------- Outbound message queue (drained by app/outbox.py) ----------------------
+def create_message_job(db: Session, messages: list, kind: str = "group_report", target_id: int = None, send_mode: str = None):
+    """
+    Creates a MessageJob and its MessageLog rows (status 'pending') in one transaction.
+    `messages` is a list of dicts with to_phone, content, student_id, channel, account_id;
+    rows with a channel are picked up by the outbox workers, the rest stay manual.
+    """
+    job = models.MessageJob(kind=kind, target_id=target_id, send_mode=send_mode, total=len(messages))
+    db.add(job)
+    db.flush()
+    job_id = job.id
+    if messages:
+        db.execute(insert(models.MessageLog), [
+            dict(m, job_id=job_id, status='pending', attempts=0,
+                 content_hash=m.get("content_hash") or content_hash(m["content"]))
+            for m in messages
+        ])
+    db.commit()
+    return job_id
+
+
+def claim_next_message(db: Session):
+    """Atomically moves the oldest queued message from 'pending' to 'sending' and returns it (or None)."""
+    while True:
+        msg_id = db.query(models.MessageLog.id)\
+            .filter(models.MessageLog.status == 'pending', models.MessageLog.channel.isnot(None))\
+            .order_by(models.MessageLog.id.asc())\
+            .limit(1)\
+            .scalar()
+        if msg_id is None:
+            db.rollback()
+            return None
+        claimed = db.query(models.MessageLog)\
+            .filter(models.MessageLog.id == msg_id, models.MessageLog.status == 'pending')\
+            .update({"status": "sending"}, synchronize_session=False)
+        db.commit()
+        if claimed:
+            return db.get(models.MessageLog, msg_id)
+        # another worker took it first; try the next one
+
+
+def deliver_message(db: Session, msg: models.MessageLog):
+    """Sends a claimed message over its channel and records the outcome on the row."""
+    attempts = 1
+    if msg.channel == 'cloud':
+        res = _post_cloud_message(db, msg.account_id, msg.to_phone, msg.content)
+        ok, error, attempts = res["ok"], res["error"], res["attempts"]
+        if not ok and res.get("account_failure") and _reroute_cloud_message(db, msg, attempts, error):
+            return msg
+    elif msg.channel == 'web':
+        ok, error = _post_web_message(db, msg.to_phone, msg.content)
     else:
-        return log_message(db, to_phone=to_phone, content=message, student_id=student_id, status='failed', error=res.get('error'))
+        ok, error = False, f'unknown_channel:{msg.channel}'
+    # attempts counts HTTP tries, including the client's backoff retries
+    msg.attempts = (msg.attempts or 0) + attempts
+    msg.status = 'sent' if ok else 'failed'
+    msg.error = error
+    if ok:
+        msg.sent_at = datetime.now()
+    db.commit()
+    return msg
+
+
+def _reroute_cloud_message(db: Session, msg: models.MessageLog, attempts: int, error: str) -> bool:
+    """
+    Requeues msg on another healthy account after an account-level failure; once the
+    failing account is marked unhealthy its whole queued share moves as well.
+    """
+    failed_account = msg.account_id
+    if (msg.attempts or 0) + attempts >= REROUTE_ATTEMPT_LIMIT:
+        return False
+    weights = cloud_account_weights(db, healthy_only=True, exclude={failed_account})
+    if not weights:
+        return False
+    msg.account_id = wa_cloud.spread(weights, 1)[0]
+    msg.attempts = (msg.attempts or 0) + attempts
+    msg.status = 'pending'
+    msg.error = error
+    db.commit()
+    sender = wa_cloud.clients.for_account(db, failed_account) if failed_account else None
+    if sender is None or not sender.healthy():
+        drain_cloud_account(db, failed_account)
+    return True
+
+
+def requeue_interrupted_messages(db: Session) -> int:
+    """Puts messages left in 'sending' (process stopped mid-send) back to 'pending'."""
+    n = db.query(models.MessageLog)\
+        .filter(models.MessageLog.status == 'sending')\
+        .update({"status": "pending"}, synchronize_session=False)
+    db.commit()
+    return n
+
+
+def get_message_job_status(db: Session, job_id: int):
+    job = db.get(models.MessageJob, job_id)
+    if not job:
+        return None
+    queued = models.MessageLog.channel.isnot(None)
+    rows = db.query(models.MessageLog.status, queued, func.count(models.MessageLog.id))\
+        .filter(models.MessageLog.job_id == job_id)\
+        .group_by(models.MessageLog.status, queued)\
+        .all()
+    counts = {"pending": 0, "sending": 0, "sent": 0, "failed": 0}
+    manual = 0
+    for status, is_queued, n in rows:
+        if is_queued:
+            counts[status] = counts.get(status, 0) + n
+        else:
+            manual += n
+    return {
+        "job_id": job.id,
+        "kind": job.kind,
+        "target_id": job.target_id,
+        "total": job.total,
+        "counts": counts,
+        "manual": manual,
+        "done": counts["pending"] == 0 and counts["sending"] == 0,
+        "created_at": str(job.created_at),
+    }
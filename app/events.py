@@ -0,0 +1,133 @@
+"""Server-push channel for dashboards: one in-memory hub, Server-Sent Events out.
+
+Writers (crud functions, running in FastAPI's threadpool or the outbox workers)
+call hub.publish() right after their commit. The event is serialized once,
+kept in a short replay buffer and handed to the event loop with
+call_soon_threadsafe; the loop copies the same bytes into every connected
+screen's queue. Dashboards therefore get check-ins, payments and treasury
+deltas without polling, and fifty screens cost fifty queue puts, not fifty
+queries.
+
+A screen that stops reading (its queue fills up) is disconnected rather than
+allowed to hold memory; EventSource reconnects by itself with Last-Event-ID and
+the replay buffer fills the gap.
+
+The hub lives in this process: with several server processes each one only
+sees its own writes. Open streams never finish on their own, so uvicorn's
+graceful shutdown would wait on them forever; run.py calls hub.close() when the
+exit signal arrives (with a bare `uvicorn app.main:app`, press CTRL+C twice).
+"""
+import asyncio
+import json
+import threading
+from collections import deque
+
+KEEPALIVE_SECONDS = 15
+REPLAY_SIZE = 500
+QUEUE_SIZE = 256
+
+
+class _Subscriber:
+    def __init__(self):
+        self.queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self.dropped = False
+
+
+class EventHub:
+    def __init__(self, replay_size: int = REPLAY_SIZE):
+        self._loop = None
+        self._closed = False
+        self._subscribers = set()  # only touched on the event loop
+        self._replay = deque(maxlen=replay_size)
+        self._lock = threading.Lock()
+        self._next_id = 1
+        self.published = 0
+        self.dropped = 0
+
+    def bind(self, loop):
+        """Called once at startup with the server's event loop."""
+        self._loop = loop
+
+    # ---- writers (any thread) ----
+    def publish(self, event: str, data: dict):
+        with self._lock:
+            event_id = self._next_id
+            self._next_id += 1
+            self.published += 1
+            frame = f"id: {event_id}\nevent: {event}\ndata: {json.dumps(data, default=str)}\n\n".encode()
+            self._replay.append((event_id, frame))
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return  # no server running (scripts, seed_data)
+        try:
+            loop.call_soon_threadsafe(self._fanout, event_id, frame)
+        except RuntimeError:
+            pass  # loop shutting down
+
+    def close(self):
+        """Ends every open stream (server shutting down); safe to call from any thread."""
+        self._closed = True
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            try:
+                loop.call_soon_threadsafe(self._close_all)
+            except RuntimeError:
+                pass
+
+    def _close_all(self):
+        for sub in list(self._subscribers):
+            sub.dropped = True
+            try:
+                sub.queue.put_nowait((0, b""))  # wakes the stream so it sees `dropped`
+            except asyncio.QueueFull:
+                pass
+        self._subscribers.clear()
+
+    def _fanout(self, event_id: int, frame: bytes):
+        for sub in list(self._subscribers):
+            try:
+                sub.queue.put_nowait((event_id, frame))
+            except asyncio.QueueFull:
+                # slow screen: cut it off, it reconnects and replays from Last-Event-ID
+                sub.dropped = True
+                self._subscribers.discard(sub)
+                self.dropped += 1
+
+    # ---- readers (event loop) ----
+    async def stream(self, last_event_id: int = None):
+        """Async generator of SSE frames for one screen (use as a StreamingResponse body)."""
+        if self._closed:
+            return
+        sub = _Subscriber()
+        self._subscribers.add(sub)
+        try:
+            yield b"retry: 3000\n\n"
+            seen = 0
+            if last_event_id is not None:
+                with self._lock:
+                    missed = [(i, frame) for i, frame in self._replay if i > last_event_id]
+                for seen, frame in missed:
+                    yield frame
+            while not sub.dropped:
+                try:
+                    event_id, frame = await asyncio.wait_for(sub.queue.get(), KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield b": ping\n\n"  # keeps proxies from closing an idle stream
+                    continue
+                if event_id > seen:  # already sent from the replay buffer
+                    yield frame
+        finally:
+            self._subscribers.discard(sub)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "subscribers": len(self._subscribers),
+                "published": self.published,
+                "dropped": self.dropped,
+                "replay_buffer": len(self._replay),
+            }
+
+
+# the process-wide hub (bound to the server loop in main.py)
+hub = EventHub()
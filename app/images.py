@@ -0,0 +1,170 @@
+"""Barcode / QR PNGs for student cards, rendered off the request path.
+
+Encoding a Code128 and a QR image is CPU-bound, so it runs in a process pool:
+- create_student only schedules its card (submit) and returns.
+- /static/barcodes/<file> is served from a memory LRU, then BARCODES_DIR; a
+  missing file of a known student is rendered on demand (get).
+- render_batch queues every card of a class/group as one job, chunked per worker.
+
+run.py calls multiprocessing.freeze_support() so the pool also works in the
+PyInstaller build.
+"""
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import count
+
+from . import utils
+from .cache import ImageBytesCache
+
+log = logging.getLogger(__name__)
+
+WORKERS = int(os.environ.get("CARD_IMAGE_WORKERS", str(min(4, os.cpu_count() or 1))))
+ON_DEMAND_TIMEOUT = 30
+
+
+def parse_image_name(filename: str):
+    """'<uuid>.png' -> ('barcode', uuid), 'qr_<uuid>.png' -> ('qr', uuid); None for anything else."""
+    if os.path.basename(filename) != filename or not filename.endswith(".png"):
+        return None
+    code = filename[:-len(".png")]
+    if code.startswith("qr_"):
+        return ("qr", code[len("qr_"):]) if len(code) > 3 else None
+    return ("barcode", code) if code else None
+
+
+class CardImageRenderer:
+    def __init__(self, workers: int = WORKERS, cache_bytes: int = 32 * 1024 * 1024):
+        self.workers = workers
+        self.cache = ImageBytesCache(cache_bytes)
+        self._executor = None
+        self._lock = threading.Lock()
+        self._inflight = {}   # uuid -> Future
+        self._jobs = {}       # job id -> progress dict
+        self._job_ids = count(1)
+        self.rendered_on_demand = 0
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                try:
+                    # spawn, not fork: the server process already runs threads (outbox, web sender)
+                    self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                         mp_context=multiprocessing.get_context("spawn"))
+                except (OSError, NotImplementedError) as e:
+                    # no multiprocessing support here: threads still keep it off the request path
+                    log.warning("card images: process pool unavailable (%s), using threads", e)
+                    self._executor = ThreadPoolExecutor(max_workers=self.workers)
+            return self._executor
+
+    def _submit(self, fn, *args):
+        try:
+            return self._pool().submit(fn, *args)
+        except BrokenProcessPool:
+            with self._lock:
+                self._executor = None
+            return self._pool().submit(fn, *args)
+
+    def submit(self, uuid_code: str):
+        """Schedules both images of a card unless already queued. Returns the Future."""
+        with self._lock:
+            future = self._inflight.get(uuid_code)
+        if future is not None and not future.done():
+            return future
+        future = self._submit(utils.render_card_images, uuid_code)
+        with self._lock:
+            self._inflight[uuid_code] = future
+        future.add_done_callback(lambda f: self._done(uuid_code, f))
+        return future
+
+    def _done(self, uuid_code, future):
+        with self._lock:
+            if self._inflight.get(uuid_code) is future:
+                del self._inflight[uuid_code]
+
+    def get(self, filename: str, student_exists) -> bytes:
+        """PNG bytes for a card image, rendering it if missing. None if not a card of a known student.
+        `student_exists(uuid)` is only called on a disk miss."""
+        parsed = parse_image_name(filename)
+        if parsed is None:
+            return None
+        data = self.cache.get(filename)
+        if data is not None:
+            return data
+        path = os.path.join(utils.BARCODES_DIR, filename)
+        if not os.path.exists(path):
+            uuid_code = parsed[1]
+            if not student_exists(uuid_code):
+                return None
+            try:
+                self.submit(uuid_code).result(timeout=ON_DEMAND_TIMEOUT)
+            except Exception:
+                log.exception("card images: background render failed for %s, rendering inline", uuid_code)
+                utils.render_card_images(uuid_code)
+            self.rendered_on_demand += 1
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        self.cache.put(filename, data)
+        return data
+
+    def render_batch(self, uuid_codes) -> dict:
+        """Queues every card that has a missing image as one job. Returns the job's progress dict."""
+        missing = [c for c in uuid_codes if not all(os.path.exists(p) for p in utils.card_image_paths(c))]
+        job = {
+            "id": next(self._job_ids),
+            "total": len(uuid_codes),
+            "skipped": len(uuid_codes) - len(missing),
+            "queued": len(missing),
+            "done": 0,
+            "failed": 0,
+            "created_at": time.time(),
+        }
+        with self._lock:
+            self._jobs[job["id"]] = job
+            for old_id in sorted(self._jobs)[:-50]:  # keep the last 50 jobs
+                del self._jobs[old_id]
+        if missing:
+            # a few chunks per worker: fewer round trips than one task per card, still balanced
+            size = max(1, min(200, -(-len(missing) // (self.workers * 4))))
+            for i in range(0, len(missing), size):
+                chunk = missing[i:i + size]
+                future = self._submit(utils.render_card_images_batch, chunk)
+                future.add_done_callback(lambda f, n=len(chunk): self._batch_done(job, f, n))
+        return self.job_status(job["id"])
+
+    def _batch_done(self, job, future, n):
+        try:
+            done, failed = future.result()
+        except Exception:
+            done, failed = 0, n
+        with self._lock:
+            job["done"] += done
+            job["failed"] += failed
+
+    def job_status(self, job_id: int):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            return dict(job, finished=job["done"] + job["failed"] >= job["queued"])
+
+    def stats(self) -> dict:
+        with self._lock:
+            inflight = len(self._inflight)
+        return dict(self.cache.stats(), inflight=inflight, rendered_on_demand=self.rendered_on_demand)
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+renderer = CardImageRenderer()
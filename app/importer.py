@@ -0,0 +1,107 @@
+"""Row readers for the bulk student import (POST /api/students/import).
+
+Both readers stream: CSV through csv.reader over the uploaded file (after one
+decoding pass over the whole file, see _check_utf8), Excel through openpyxl's
+read-only mode (optional dependency, only needed for .xlsx). They yield
+(row_number, {field: value}) with headers mapped to Student fields, and
+validation / inserts happen in crud.import_students.
+"""
+import codecs
+import csv
+
+# accepted header spellings -> field
+HEADER_ALIASES = {
+    "uuid": "uuid", "code": "uuid", "card": "uuid", "الكود": "uuid", "الكارت": "uuid",
+    "first_name": "first_name", "name": "first_name", "الاسم": "first_name", "الاسم الأول": "first_name",
+    "last_name": "last_name", "اسم العائلة": "last_name", "الاسم الأخير": "last_name",
+    "parent_name": "parent_name", "اسم ولي الأمر": "parent_name",
+    "parent_phone": "parent_phone", "phone": "parent_phone", "رقم ولي الأمر": "parent_phone", "الهاتف": "parent_phone",
+    "class": "class_name", "class_name": "class_name", "الصف": "class_name",
+    "class_id": "class_id",
+    "group": "group_name", "group_name": "group_name", "المجموعة": "group_name",
+    "group_id": "group_id",
+}
+
+
+class ImportFormatError(ValueError):
+    pass
+
+
+def _map_headers(headers):
+    fields = [HEADER_ALIASES.get(str(h or "").strip().lower()) for h in headers]
+    if "uuid" not in fields or "first_name" not in fields:
+        raise ImportFormatError("missing_columns: uuid, first_name")
+    return fields
+
+
+def _clean(fields, values):
+    row = {}
+    for field, value in zip(fields, values):
+        if field is None or value is None:
+            continue
+        value = str(value).strip()
+        if value:
+            row[field] = value
+    return row
+
+
+def _check_utf8(fileobj, chunk_size: int = 1 << 16):
+    """
+    Decodes the whole upload once and rewinds it. crud.import_students commits in
+    batches, so a bad byte near the end must fail the import before the first row.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    line = 1
+    while True:
+        chunk = fileobj.read(chunk_size)
+        try:
+            decoder.decode(chunk, final=not chunk)
+        except UnicodeDecodeError as e:
+            line += chunk[:max(e.start, 0)].count(b"\n")
+            raise ImportFormatError(f"invalid_encoding: line {line} is not UTF-8, save the file as CSV UTF-8")
+        if not chunk:
+            break
+        line += chunk.count(b"\n")
+    fileobj.seek(0)
+
+
+def iter_csv_rows(fileobj):
+    """fileobj is a binary, seekable file; UTF-8 with or without BOM (what Excel's 'CSV UTF-8' writes)."""
+    _check_utf8(fileobj)
+    reader = csv.reader(codecs.getreader("utf-8-sig")(fileobj))
+    headers = next(reader, None)
+    if headers is None:
+        raise ImportFormatError("empty_file")
+    fields = _map_headers(headers)
+    for values in reader:
+        if not any(v.strip() for v in values):
+            continue
+        yield reader.line_num, _clean(fields, values)
+
+
+def iter_xlsx_rows(fileobj):
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise ImportFormatError("xlsx_not_supported: pip install openpyxl")
+    wb = load_workbook(fileobj, read_only=True, data_only=True)
+    try:
+        rows = wb.active.iter_rows(values_only=True)
+        headers = next(rows, None)
+        if headers is None:
+            raise ImportFormatError("empty_file")
+        fields = _map_headers(headers)
+        for row_number, values in enumerate(rows, start=2):
+            if not any(v not in (None, "") for v in values):
+                continue
+            # numeric cells (card codes, phones) come back as int/float
+            values = [int(v) if isinstance(v, float) and v.is_integer() else v for v in values]
+            yield row_number, _clean(fields, values)
+    finally:
+        wb.close()
+
+
+def iter_rows(filename: str, fileobj):
+    if (filename or "").lower().endswith((".xlsx", ".xlsm")):
+        return iter_xlsx_rows(fileobj)
+    return iter_csv_rows(fileobj)
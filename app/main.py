@@ -1,30 +1,54 @@
+import asyncio
 import os
-from fastapi import FastAPI, Request, Form, Query, Depends, Response
-from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse
+from datetime import date
+from fastapi import FastAPI, Request, Form, Query, Depends, Response, UploadFile, File
+from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from sqlalchemy import create_engine, func
-from sqlalchemy.orm import sessionmaker
 
 # استبدال relative imports بـ absolute
-from .models import Base
-from . import crud, models
+from . import crud, events, images, migrations, models
+from .database import engine, SessionLocal
+from .outbox import Outbox
 
 print("LOADED main.py")
 
-DATABASE_URL = "sqlite:///./center.db"
+# engine / SessionLocal (DATABASE_URL, WAL + pragmas for SQLite) come from app/database.py
 
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+app = FastAPI()
 
-# create tables if not exists
-Base.metadata.create_all(bind=engine)
+# background WhatsApp delivery (group sends are queued, see app/outbox.py)
+outbox = Outbox(workers=8)
+
+# nothing that touches the database runs at import time: the card image workers
+# (spawn) re-import the entry module, and must not migrate or lock center.db
+@app.on_event("startup")
+def upgrade_schema():
+    # create missing tables and bring older databases up to date (columns, indexes)
+    migrations.upgrade(engine)
+
+@app.on_event("startup")
+def start_outbox():
+    outbox.start(SessionLocal)
+
+@app.on_event("startup")
+async def bind_events():
+    # crud publishes from worker threads; the hub hands events to this loop
+    events.hub.bind(asyncio.get_running_loop())
+
+@app.on_event("shutdown")
+def stop_outbox():
+    outbox.stop()
+    from . import wa_web
+    wa_web.stop_all()
+    images.renderer.shutdown()
 
-app = FastAPI()
 templates = Jinja2Templates(directory=os.path.join(os.path.dirname(__file__), "templates"))
-app.mount("/static", StaticFiles(directory=os.path.dirname(__file__) + "/static"), name="static")
 
 # Dependency to get the DB session
+# SessionLocal is synchronous, so every handler that takes `db` is a plain `def`:
+# FastAPI runs those in its threadpool and a slow query (treasury, admin) no
+# longer blocks the event loop for the scanner. Keep new DB handlers as `def` too.
 from sqlalchemy.orm import Session # Import Session for type hinting
 def get_db():
     db = SessionLocal()
@@ -33,6 +57,66 @@ def get_db():
     finally:
         db.close()
 
+# ---------------------- Card images (barcode / QR) ----------------------
+# registered before the /static mount so it takes /static/barcodes/*: served from
+# the memory cache or disk, and rendered on first request if the file is missing
+@app.get("/static/barcodes/{filename}")
+def card_image(filename: str, db: Session = Depends(get_db)):
+    def student_exists(uuid_code):
+        return db.query(models.Student.id).filter(models.Student.uuid == uuid_code).first() is not None
+    data = images.renderer.get(filename, student_exists)
+    if data is None:
+        return JSONResponse({"ok": False, "error": "not_found"}, status_code=404)
+    return Response(content=data, media_type="image/png", headers={"Cache-Control": "public, max-age=86400"})
+
+app.mount("/static", StaticFiles(directory=os.path.dirname(__file__) + "/static"), name="static")
+
+
+@app.post("/api/cards/render")
+def api_render_cards(class_id: int = Form(None), group_id: int = Form(None), db: Session = Depends(get_db)):
+    # bulk job: render the missing barcode/QR images of a whole class or group in the background
+    if class_id is None and group_id is None:
+        return JSONResponse({"ok": False, "error": "no_target"}, status_code=400)
+    job = images.renderer.render_batch(crud.list_student_uuids(db, class_id=class_id, group_id=group_id))
+    return {"ok": True, "job_id": job["id"], "job": job}
+
+
+@app.get("/api/cards/render/{job_id}")
+async def api_render_cards_status(job_id: int):
+    job = images.renderer.job_status(job_id)
+    if job is None:
+        return JSONResponse({"ok": False, "error": "not_found"}, status_code=404)
+    return job
+
+
+@app.get("/api/cards/sheet")
+def api_card_sheet(
+    class_id: int = Query(None),
+    group_id: int = Query(None),
+    format: str = Query("pdf"),
+    page: int = Query(1, ge=1),
+    db: Session = Depends(get_db)
+):
+    # printable ID cards of a class/group: streamed multi-page PDF, or one PNG page (?format=png&page=N)
+    from . import cards
+    if class_id is None and group_id is None:
+        return JSONResponse({"ok": False, "error": "no_target"}, status_code=400)
+    if format not in ("pdf", "png"):
+        return JSONResponse({"ok": False, "error": "invalid_format"}, status_code=400)
+    rows = crud.list_card_students(db, class_id=class_id, group_id=group_id)
+    if not rows:
+        return JSONResponse({"ok": False, "error": "no_students"}, status_code=404)
+    pages = cards.page_count(rows)
+    name = f"cards_{'class' if class_id is not None else 'group'}_{class_id if class_id is not None else group_id}"
+    if format == "png":
+        if page > pages:
+            return JSONResponse({"ok": False, "error": "page_out_of_range", "pages": pages}, status_code=404)
+        return Response(content=cards.png_page(rows, page), media_type="image/png",
+                        headers={"X-Total-Pages": str(pages), "Content-Disposition": f'inline; filename="{name}_{page}.png"'})
+    return StreamingResponse(cards.pdf_stream(rows), media_type="application/pdf",
+                             headers={"X-Total-Pages": str(pages), "Content-Disposition": f'attachment; filename="{name}.pdf"'})
+
+
 # Redirect root to dashboard
 @app.get("/")
 async def root():
@@ -40,7 +124,7 @@ async def root():
 
 # ---------------------- API: ADD CLASS ----------------------
 @app.post("/api/classes")
-async def api_add_class(name: str = Form(...), db: Session = Depends(get_db)):
+def api_add_class(name: str = Form(...), db: Session = Depends(get_db)):
     from .models import Class
     new_class = Class(name=name)
     db.add(new_class)
@@ -50,28 +134,27 @@ async def api_add_class(name: str = Form(...), db: Session = Depends(get_db)):
 
 # ---------------------- API: CHANGE STUDENT GROUP ----------------------
 @app.post("/api/student/change_group")
-async def api_change_student_group(student_id: int = Form(...), group_id: int = Form(...), db: Session = Depends(get_db)):
-    student = db.query(models.Student).filter(models.Student.id == student_id).first()
-    if not student:
+def api_change_student_group(student_id: int = Form(...), group_id: int = Form(...), db: Session = Depends(get_db)):
+    if not crud.change_student_group(db, student_id, group_id):
         return {"ok": False, "error": "الطالب غير موجود"}
-    student.group_id = group_id
-    db.commit()
     return {"ok": True}
 
 # ---------------------- API: UPDATE GROUP NAME ----------------------
 @app.post("/api/groups/update")
-async def api_update_group_name(group_id: int = Form(...), name: str = Form(...), db: Session = Depends(get_db)):
+def api_update_group_name(group_id: int = Form(...), name: str = Form(...), db: Session = Depends(get_db)):
     group = db.query(models.Group).filter(models.Group.id == group_id).first()
     if not group:
         return {"ok": False, "error": "المجموعة غير موجودة"}
     group.name = name
     db.commit()
+    # cached scanner cards carry the group name
+    crud.student_cards.clear()
     return {"ok": True}
 
 
 # ---------------------- API: ADD GROUP & GROUP STUDENTS ----------------------
 @app.post("/api/groups")
-async def api_add_group(
+def api_add_group(
     name: str = Form(...),
     class_id: int = Form(...),
     subscription_price: float = Form(...),
@@ -85,30 +168,36 @@ async def api_add_group(
     return {"ok": True, "id": group.id}
 
 @app.get("/api/group_students")
-async def api_group_students(group_id: int, db: Session = Depends(get_db)):
-    students = db.query(models.Student).filter(models.Student.group_id == group_id).all()
-    result = [{"id": s.id, "uuid": s.uuid, "first_name": s.first_name, "last_name": s.last_name} for s in students]
-    return result
+def api_group_students(group_id: int, db: Session = Depends(get_db)):
+    S = models.Student
+    rows = db.query(S.id, S.uuid, S.first_name, S.last_name).filter(S.group_id == group_id).order_by(S.id.asc())
+    return [{"id": sid, "uuid": uuid_code, "first_name": first_name, "last_name": last_name}
+            for sid, uuid_code, first_name, last_name in rows]
+
+@app.get("/api/groups/roster")
+def api_groups_roster(class_id: int = Query(None), members: bool = Query(False), db: Session = Depends(get_db)):
+    # every group with its member count (and members=1: its students) in one call, for groups.html
+    return crud.get_group_roster(db, class_id, include_members=members)
 
 # ---------------------- GROUPS PAGE ----------------------
 @app.get("/groups", response_class=HTMLResponse)
-async def groups_page(request: Request, db: Session = Depends(get_db)):
+def groups_page(request: Request, db: Session = Depends(get_db)):
     return templates.TemplateResponse("groups.html", {"request": request})
 
 # ---------------------- API: CLASSES & GROUPS ----------------------
 @app.get("/api/classes")
-async def api_get_classes(db: Session = Depends(get_db)):
+def api_get_classes(db: Session = Depends(get_db)):
     classes = crud.get_all_classes(db)
     return [{"id": c.id, "name": c.name} for c in classes]
 
 @app.get("/api/groups")
-async def api_get_groups(class_id: int = Query(None), db: Session = Depends(get_db)):
+def api_get_groups(class_id: int = Query(None), db: Session = Depends(get_db)):
     groups = crud.get_all_groups(db, class_id)
     return [{"id": g.id, "name": g.name, "class_id": g.class_id} for g in groups]
 
 # ---------------------- API: BOOKS ----------------------
 @app.post("/api/books")
-async def api_add_book(name: str = Form(...), price: float = Form(...), class_id: int = Form(...), type: str = Form("book"), db: Session = Depends(get_db)):
+def api_add_book(name: str = Form(...), price: float = Form(...), class_id: int = Form(...), type: str = Form("book"), db: Session = Depends(get_db)):
     from .models import Book
     book = Book(name=name, price=price, class_id=class_id, type=type)
     db.add(book)
@@ -118,7 +207,7 @@ async def api_add_book(name: str = Form(...), price: float = Form(...), class_id
 
 
 @app.get("/api/books")
-async def api_get_books(class_id: int = Query(None), db: Session = Depends(get_db)):
+def api_get_books(class_id: int = Query(None), db: Session = Depends(get_db)):
     from .models import Book
     q = db.query(Book)
     if class_id:
@@ -128,16 +217,13 @@ async def api_get_books(class_id: int = Query(None), db: Session = Depends(get_d
 
 
 @app.post("/api/student/buy_book")
-async def api_student_buy_book(student_id: int = Form(...), book_id: int = Form(...), db: Session = Depends(get_db)):
-    from .models import StudentBook
-    sb = StudentBook(student_id=student_id, book_id=book_id)
-    db.add(sb)
-    db.commit()
+def api_student_buy_book(student_id: int = Form(...), book_id: int = Form(...), db: Session = Depends(get_db)):
+    crud.buy_book(db, student_id, book_id)
     return {"ok": True}
 
 
 @app.get("/api/student/{student_id}/books")
-async def api_get_student_books(student_id: int, db: Session = Depends(get_db)):
+def api_get_student_books(student_id: int, db: Session = Depends(get_db)):
     # join student_books with books to return book info + buy date
     from .models import StudentBook, Book
     q = db.query(StudentBook, Book).join(Book, StudentBook.book_id == Book.id).filter(StudentBook.student_id == student_id).order_by(StudentBook.buy_date.desc()).all()
@@ -153,9 +239,23 @@ async def api_get_student_books(student_id: int, db: Session = Depends(get_db)):
     return result
 
 
+@app.get("/api/student/{student_id}/profile")
+def api_student_profile(student_id: int, request: Request, db: Session = Depends(get_db)):
+    # identity, group/price, last attendance, payment status, results and purchases in one call;
+    # clients revalidate with If-None-Match and an unchanged profile costs one query and a 304
+    res = crud.get_student_profile(db, student_id, if_none_match=request.headers.get("if-none-match"))
+    if res is None:
+        return JSONResponse({"ok": False, "error": "student_not_found"}, status_code=404)
+    etag, profile = res
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if profile is None:
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(profile, headers=headers)
+
+
 # ---------------------- API: TESTS & RESULTS ----------------------
 @app.post("/api/tests")
-async def api_add_test(name: str = Form(...), class_id: int = Form(None), max_score: float = Form(100.0), db: Session = Depends(get_db)):
+def api_add_test(name: str = Form(...), class_id: int = Form(None), max_score: float = Form(100.0), db: Session = Depends(get_db)):
     from .models import Test
     t = Test(name=name, class_id=class_id, max_score=max_score)
     db.add(t)
@@ -165,7 +265,7 @@ async def api_add_test(name: str = Form(...), class_id: int = Form(None), max_sc
 
 
 @app.get("/api/tests")
-async def api_get_tests(class_id: int = Query(None), db: Session = Depends(get_db)):
+def api_get_tests(class_id: int = Query(None), db: Session = Depends(get_db)):
     from .models import Test
     q = db.query(Test)
     if class_id:
@@ -175,7 +275,7 @@ async def api_get_tests(class_id: int = Query(None), db: Session = Depends(get_d
 
 
 @app.post("/api/student/add_result")
-async def api_add_student_result(student_id: int = Form(...), test_id: int = Form(...), score: float = Form(...), db: Session = Depends(get_db)):
+def api_add_student_result(student_id: int = Form(...), test_id: int = Form(...), score: float = Form(...), db: Session = Depends(get_db)):
     from .models import StudentTest
     st = StudentTest(student_id=student_id, test_id=test_id, score=score)
     db.add(st)
@@ -184,7 +284,7 @@ async def api_add_student_result(student_id: int = Form(...), test_id: int = For
 
 
 @app.get("/api/student/{student_id}/results")
-async def api_get_student_results(student_id: int, db: Session = Depends(get_db)):
+def api_get_student_results(student_id: int, db: Session = Depends(get_db)):
     from .models import StudentTest, Test
     q = db.query(StudentTest, Test).join(Test, StudentTest.test_id == Test.id).filter(StudentTest.student_id == student_id).order_by(StudentTest.recorded_at.desc()).all()
     res = []
@@ -195,7 +295,7 @@ async def api_get_student_results(student_id: int, db: Session = Depends(get_db)
 # ---------------------- API ENDPOINTS ----------------------
 
 @app.post("/api/students")
-async def api_create_student(
+def api_create_student(
     uuid: str = Form(...),
     first_name: str = Form(...),
     last_name: str = Form(None),
@@ -211,57 +311,77 @@ async def api_create_student(
         "uuid": student.uuid
     }
 
+
+@app.post("/api/students/import")
+def api_import_students(file: UploadFile = File(...), dry_run: bool = Form(False), db: Session = Depends(get_db)):
+    # bulk enrollment from CSV (UTF-8) or .xlsx: columns uuid, first_name, last_name, parent_name,
+    # parent_phone, class/class_id, group/group_id; returns the errors of every rejected row
+    from .importer import ImportFormatError, iter_rows
+    try:
+        report = crud.import_students(db, iter_rows(file.filename, file.file), dry_run=dry_run)
+    except ImportFormatError as e:
+        # raised before the first batch is committed (the CSV is decoded in full first)
+        db.rollback()
+        return JSONResponse({"ok": False, "error": str(e)}, status_code=400)
+    return {"ok": True, "dry_run": dry_run, **report}
+
+@app.get("/api/students")
+def api_list_students(
+    after: str = Query(None),
+    limit: int = Query(50, ge=1, le=500),
+    order: str = Query("id"),
+    class_id: int = Query(None),
+    group_id: int = Query(None),
+    db: Session = Depends(get_db)
+):
+    if order not in crud.STUDENT_PAGE_ORDERS:
+        return JSONResponse({"ok": False, "error": "invalid_order"}, status_code=400)
+    try:
+        students, next_cursor = crud.list_students_page(db, after=after, limit=limit, order=order, class_id=class_id, group_id=group_id)
+    except ValueError:
+        return JSONResponse({"ok": False, "error": "invalid_cursor"}, status_code=400)
+    return {
+        "items": [{
+            "id": s.id,
+            "uuid": s.uuid,
+            "first_name": s.first_name,
+            "last_name": s.last_name,
+            "class_id": s.class_id,
+            "group_id": s.group_id
+        } for s in students],
+        "next": next_cursor
+    }
+
 @app.post("/api/scan")
-async def api_scan(payload: dict, db: Session = Depends(get_db)):
+def api_scan(payload: dict, db: Session = Depends(get_db)):
     code = payload.get("code")
-    student = crud.get_student_by_uuid(db, code)
-    if not student:
+    # live tap: server time only (a desk clock set to the wrong day must not move it);
+    # buffered taps are replayed with their tap time through /api/scan/batch
+    result = crud.check_in_student(db, code, recorded_by="RFID_scan")
+    if result is None:
         return JSONResponse({"error": "student_not_found"}, status_code=404)
+    return result
 
-    # --- NEW: Automatically mark attendance if not already marked for today ---
-    from datetime import date # Import date for comparison
-    new_attendance_record = None
-    existing_attendance_today = db.query(models.SessionAttendance).filter(
-        models.SessionAttendance.student_id == student.id,
-        func.date(models.SessionAttendance.session_date) == date.today()
-    ).first()
-
-    if not existing_attendance_today:
-        new_attendance_record = crud.mark_attendance(db, student.id, status="present", recorded_by="RFID_scan")
-    # --- END NEW ---
 
-    last_att = crud.get_last_attendance(db, student.id)
-    pay_status = crud.get_payment_status(db, student.id)
-    return {
-        "student": {
-            "id": student.id,
-            "first_name": student.first_name,
-            "last_name": student.last_name,
-            "uuid": student.uuid,
-            "parent_phone": student.parent_phone,
-            "class_id": student.class_id,
-        },
-        "last_attendance": str(last_att.session_date) if last_att else None,
-        "payment_status": pay_status,
-        "auto_marked_attendance": str(new_attendance_record.session_date) if new_attendance_record else None
-    }
+@app.post("/api/scan/batch")
+def api_scan_batch(payload: dict, db: Session = Depends(get_db)):
+    # offline replay: {"scans": [{"id", "code", "scanned_at"}], "sent_at"}, at most 500 per call;
+    # sent_at (the sender's clock now) corrects scanned_at for a desk clock that is off
+    scans = payload.get("scans")
+    if not isinstance(scans, list) or len(scans) > 500:
+        return JSONResponse({"ok": False, "error": "invalid_scans"}, status_code=400)
+    results = crud.check_in_batch(db, scans, recorded_by=payload.get("recorded_by") or "RFID_scan",
+                                  sent_at=crud.parse_client_time(payload.get("sent_at")))
+    return {"ok": True, "results": results}
 
 
 @app.get('/api/students/search')
-async def api_search_students(q: str = Query(None), db: Session = Depends(get_db)):
+def api_search_students(q: str = Query(None), limit: int = Query(50, ge=1, le=200), db: Session = Depends(get_db)):
     if not q:
         return []
-    items = crud.search_students(db, q)
+    items = crud.search_students(db, q, limit=limit)
     res = []
-    for s in items:
-        class_name = None
-        group_name = None
-        if s.class_id:
-            c = db.query(models.Class).filter(models.Class.id == s.class_id).first()
-            if c: class_name = c.name
-        if s.group_id:
-            g = db.query(models.Group).filter(models.Group.id == s.group_id).first()
-            if g: group_name = g.name
+    for s, class_name, group_name in items:
         res.append({
             "id": s.id,
             "first_name": s.first_name,
@@ -275,19 +395,40 @@ async def api_search_students(q: str = Query(None), db: Session = Depends(get_db
     return res
 
 @app.post("/api/attendance")
-async def api_attendance(code: str = Form(...), status: str = Form("present"), score: float = Form(None), db: Session = Depends(get_db)):
-    student = crud.get_student_by_uuid(db, code)
+def api_attendance(code: str = Form(...), status: str = Form("present"), score: float = Form(None), db: Session = Depends(get_db)):
+    student = crud.get_student_card(db, code)
     if not student:
         return JSONResponse({"error": "student_not_found"}, status_code=404)
-    att = crud.mark_attendance(db, student.id, status=status, score=score)
+    att = crud.mark_attendance(db, student["id"], status=status, score=score)
     return {"ok": True, "attendance_id": att.id, "session_date": str(att.session_date)}
 
+@app.post("/api/attendance/bulk")
+def api_bulk_attendance(payload: dict, db: Session = Depends(get_db)):
+    # whole group at once: {group_id, entries: [{student_id, status}], session_date?: "YYYY-MM-DD",
+    # fill_absent?: bool}; fill_absent marks every member without a record as absent (session end)
+    group_id = payload.get("group_id")
+    if not db.query(models.Group.id).filter(models.Group.id == group_id).first():
+        return JSONResponse({"ok": False, "error": "group_not_found"}, status_code=404)
+    day = None
+    if payload.get("session_date"):
+        try:
+            day = date.fromisoformat(payload["session_date"])
+        except ValueError:
+            return JSONResponse({"ok": False, "error": "invalid_session_date"}, status_code=400)
+    entries = payload.get("entries") or []
+    if not isinstance(entries, list):
+        return JSONResponse({"ok": False, "error": "invalid_entries"}, status_code=400)
+    result = crud.mark_group_attendance(db, group_id, entries, day=day,
+                                        fill_absent=bool(payload.get("fill_absent")),
+                                        recorded_by=payload.get("recorded_by") or "manual")
+    return {"ok": True, "group_id": group_id, **result}
+
 @app.post("/api/payment")
-async def api_payment(code: str = Form(...), amount: float = Form(...), method: str = Form("cash"), note: str = Form(None), db: Session = Depends(get_db)):
-    student = crud.get_student_by_uuid(db, code)
+def api_payment(code: str = Form(...), amount: float = Form(...), method: str = Form("cash"), note: str = Form(None), db: Session = Depends(get_db)):
+    student = crud.get_student_card(db, code)
     if not student:
         return JSONResponse({"error": "student_not_found"}, status_code=404)
-    p = crud.add_payment(db, student.id, amount, method=method, note=note)
+    p = crud.add_payment(db, student["id"], amount, method=method, note=note)
     return {"ok": True, "payment_id": p.id}
 
 # ---------------------- PAGES ----------------------
@@ -297,18 +438,14 @@ async def scanner_page(request: Request):
     return templates.TemplateResponse("scanner.html", {"request": request})
 
 @app.get("/student/{code}", response_class=HTMLResponse)
-async def student_card(request: Request, code: str, db: Session = Depends(get_db)):
-    student = crud.get_student_by_uuid(db, code)
+def student_card(request: Request, code: str, db: Session = Depends(get_db)):
+    # the card dict has every field the template reads (jinja falls back to item access)
+    student = crud.get_student_card(db, code)
     if not student:
         return Response("Student not found", status_code=404)
-    last_att = crud.get_last_attendance(db, student.id)
-    pay_status = crud.get_payment_status(db, student.id)
-    group = None
-    group_price = None
-    if student.group_id:
-        group = db.query(models.Group).filter(models.Group.id == student.group_id).first()
-        if group:
-            group_price = group.subscription_price
+    last_att = crud.get_last_attendance(db, student["id"])
+    pay_status = crud.payment_status_from_date(student["last_paid_date"])
+    group_price = student["group_price"]
     return templates.TemplateResponse("student_card.html", {
         "request": request,
         "student": student,
@@ -318,7 +455,7 @@ async def student_card(request: Request, code: str, db: Session = Depends(get_db
     })
 
 @app.post("/api/student/{student_id}/delete")
-async def api_delete_student(student_id: int, db: Session = Depends(get_db)):
+def api_delete_student(student_id: int, db: Session = Depends(get_db)):
     try:
         success = crud.delete_student(db, student_id)
         if not success:
@@ -329,15 +466,40 @@ async def api_delete_student(student_id: int, db: Session = Depends(get_db)):
         return JSONResponse({"ok": False, "error": f"database_error: {str(e)}"}, status_code=500)
 
 
+@app.get("/api/cache/stats")
+async def api_cache_stats():
+    return {
+        "student_cards": crud.student_cards.stats(),
+        "treasury": crud.treasury_cache.stats(),
+        "treasury_rollups": crud.treasury_rollups.stats(),
+        "shared_versions": crud.cache_versions.stats(),
+        "card_images": images.renderer.stats(),
+    }
+
+
+# ---------------------- LIVE EVENTS (SSE) ----------------------
+@app.get("/api/events")
+async def api_events(request: Request):
+    # check-ins, payments and treasury deltas pushed to every open dashboard (see app/events.py)
+    last_id = request.headers.get("last-event-id") or request.query_params.get("last_event_id")
+    return StreamingResponse(
+        events.hub.stream(int(last_id) if last_id and last_id.isdigit() else None),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/api/events/stats")
+async def api_events_stats():
+    return events.hub.stats()
+
+
 # ---------------------- ADMIN DASHBOARD ----------------------
 
 @app.get("/admin", response_class=HTMLResponse)
-async def admin_dashboard(request: Request, db: Session = Depends(get_db)):
-    students = crud.get_all_students(db)   # لازم تكون عامل دالة في crud ترجع كل الطلاب
-    return templates.TemplateResponse("admin.html", {
-        "request": request,
-        "students": students
-    })
+async def admin_dashboard(request: Request):
+    # the page pulls students page by page from /api/students
+    return templates.TemplateResponse("admin.html", {"request": request})
 
 # ---------------------- CENTER DASHBOARD ----------------------
 @app.get("/dashboard", response_class=HTMLResponse)
@@ -347,39 +509,58 @@ async def dashboard_page(request: Request):
 
 # ---------------------- TREASURY (الخزنة) ----------------------
 @app.get('/api/treasury/summary')
-async def api_treasury_summary(db: Session = Depends(get_db)):
+def api_treasury_summary(db: Session = Depends(get_db)):
     summary = crud.get_treasury_summary(db)
     return summary
 
 
+@app.get('/api/treasury/report')
+def api_treasury_report(
+    date_from: date = Query(None, alias="from"),
+    date_to: date = Query(None, alias="to"),
+    bucket: str = Query("day"),
+    db: Session = Depends(get_db)
+):
+    if bucket not in crud.REPORT_BUCKETS:
+        return JSONResponse({"ok": False, "error": "invalid_bucket"}, status_code=400)
+    date_to = date_to or date.today()
+    date_from = date_from or date_to.replace(day=1)
+    if date_from > date_to:
+        return JSONResponse({"ok": False, "error": "invalid_range"}, status_code=400)
+    max_days = crud.REPORT_MAX_DAYS[bucket]
+    if (date_to - date_from).days >= max_days:
+        return JSONResponse({"ok": False, "error": "range_too_long", "max_days": max_days}, status_code=400)
+    return crud.get_treasury_report(db, date_from, date_to, bucket)
+
+
 @app.post('/api/treasury/expense')
-async def api_add_expense(title: str = Form(...), amount: float = Form(...), note: str = Form(None), db: Session = Depends(get_db)):
+def api_add_expense(title: str = Form(...), amount: float = Form(...), note: str = Form(None), db: Session = Depends(get_db)):
     e = crud.add_expense(db, title, amount, note=note)
     return {"ok": True, "id": e.id}
 
 
 @app.get('/api/treasury/expenses')
-async def api_list_expenses(limit: int = Query(100), db: Session = Depends(get_db)):
+def api_list_expenses(limit: int = Query(100), db: Session = Depends(get_db)):
     items = crud.list_expenses(db, limit=limit)
     return [{"id": i.id, "title": i.title, "amount": i.amount, "date": str(i.expense_date), "note": i.note} for i in items]
 
 
 # ---------------------- WhatsApp Integration (lightweight) ----------------------
 @app.post('/api/wa/session')
-async def api_create_wa_session(name: str = Form(None), db: Session = Depends(get_db)):
+def api_create_wa_session(name: str = Form(None), db: Session = Depends(get_db)):
     s = crud.create_wa_session(db, name=name)
     # For now return session id; front-end will call /api/wa/session/{id}/qr to get QR
     return {"ok": True, "id": s.id}
 
 
 @app.get('/api/wa/sessions')
-async def api_list_wa_sessions(db: Session = Depends(get_db)):
+def api_list_wa_sessions(db: Session = Depends(get_db)):
     items = crud.list_wa_sessions(db)
     return [{"id": i.id, "name": i.name, "connected": bool(i.connected), "created_at": str(i.created_at)} for i in items]
 
 
 @app.get('/api/wa/session/{session_id}/qr')
-async def api_get_wa_qr(session_id: int, db: Session = Depends(get_db)):
+def api_get_wa_qr(session_id: int, db: Session = Depends(get_db)):
     s = db.query(models.WhatsAppSession).filter(models.WhatsAppSession.id == session_id).first()
     if not s:
         return JSONResponse({'error':'not_found'}, status_code=404)
@@ -388,7 +569,14 @@ async def api_get_wa_qr(session_id: int, db: Session = Depends(get_db)):
 
 
 @app.post('/api/wa/send_report')
-async def api_send_report(student_id: int = Form(None), group_id: int = Form(None), send_mode: str = Form(None), db: Session = Depends(get_db)):
+def api_send_report(
+    student_id: int = Form(None),
+    group_id: int = Form(None),
+    send_mode: str = Form(None),
+    merge_siblings: bool = Form(False),
+    dedupe_hours: float = Form(None),
+    db: Session = Depends(get_db)
+):
     # If student_id provided, send to that student's parent phone
     sent = []
     if student_id:
@@ -402,12 +590,13 @@ async def api_send_report(student_id: int = Form(None), group_id: int = Form(Non
 
         # determine mode: explicit send_mode='auto' forces auto, otherwise try auto if account enabled
         use_auto = (send_mode == 'auto')
-        acc = db.query(models.WhatsAppAccount).filter(models.WhatsAppAccount.use_cloud_api == 1).first()
+        # the healthy cloud account with the most quota left (spread over accounts by weight)
+        acc = crud.pick_cloud_account(db)
         if use_auto and not acc:
             return JSONResponse({"ok": False, "error": "no_auto_account_configured"}, status_code=400)
         if acc and (use_auto or acc):
             # if acc exists and either user asked for auto or it's available, use it
-            log = crud.send_via_whatsapp_cloud(db, acc.id, phone, report_message, student_id=student.id)
+            log = crud.send_via_whatsapp_cloud(db, acc, phone, report_message, student_id=student.id)
             return {"ok": True, "log_id": log.id, "to": phone, "auto_sent": log.status == 'sent'}
         # if user requested web automation explicitly or cloud not configured, try web automation
         if send_mode == 'web' or (send_mode == 'auto' and not acc):
@@ -417,61 +606,95 @@ async def api_send_report(student_id: int = Form(None), group_id: int = Form(Non
             log = crud.log_message(db, phone, report_message, student_id=student.id)
             return {"ok": True, "log_id": log.id, "to": phone, "auto_sent": False}
 
-    # if group_id provided, send to members of that group
+    # if group_id provided, queue a report for every member; the outbox workers send them
     if group_id:
-        students = db.query(models.Student).filter(models.Student.group_id == group_id).all()
-        # try to find a cloud-enabled account
-        acc = db.query(models.WhatsAppAccount).filter(models.WhatsAppAccount.use_cloud_api == 1).first()
+        # all reports for the group are built up front in a handful of queries;
+        # merge_siblings sends one family message per parent phone
+        messages = crud.generate_group_messages(db, group_id=group_id, merge_siblings=merge_siblings)
+        # skip texts already sent to the same phone recently (window: dedupe_hours, 0 = off)
+        messages, skipped = crud.drop_recent_duplicates(db, messages, window_hours=dedupe_hours)
+        # spread the messages over every usable cloud account (weighted by remaining daily quota)
+        account_ids = crud.assign_cloud_accounts(db, len(messages))
+        acc = account_ids is not None
         use_auto = (send_mode == 'auto')
-        count = 0
-        for s in students:
-            phone = (s.parent_phone or '').strip()
-            
-            # Generate the report message for each student
-            report_message = crud.generate_student_report(db, s.id)
-
-            if acc and (use_auto or acc):
-                crud.send_via_whatsapp_cloud(db, acc.id, phone, report_message, student_id=s.id)
-            else:
-                # if user asked explicitly for web automation, attempt it
-                if send_mode == 'web' or (send_mode == 'auto' and not acc):
-                    crud.send_via_whatsapp_web(db, phone, report_message, student_id=s.id)
-                else:
-                    crud.log_message(db, phone, report_message, student_id=s.id)
-            count += 1
-        return {"ok": True, "sent": count, "auto_sent": bool(acc and use_auto)}
+        if acc:
+            channel = 'cloud'
+        elif send_mode == 'web' or send_mode == 'auto':
+            # if user asked explicitly for web automation, attempt it
+            channel = 'web'
+        else:
+            channel = None  # manual: only logged
+        for i, m in enumerate(messages):
+            m["channel"] = channel
+            m["account_id"] = account_ids[i] if channel == 'cloud' else None
+        job_id = crud.create_message_job(db, messages, kind="group_report", target_id=group_id, send_mode=send_mode)
+        if channel:
+            outbox.notify()
+        # nothing is sent during this request: queued rows go out from the outbox
+        # (progress at /api/wa/jobs/{id}), manual rows are only logged for staff to send
+        return {
+            "ok": True,
+            "job_id": job_id,
+            "sent": 0,
+            "queued": len(messages) if channel else 0,
+            "logged": 0 if channel else len(messages),
+            "skipped_duplicates": skipped,
+            "auto_sent": bool(acc and use_auto)
+        }
 
     return JSONResponse({"ok": False, "error": "no_target"}, status_code=400)
 
 
+@app.get('/api/wa/jobs/{job_id}')
+def api_wa_job_status(job_id: int, db: Session = Depends(get_db)):
+    status = crud.get_message_job_status(db, job_id)
+    if not status:
+        return JSONResponse({"ok": False, "error": "not_found"}, status_code=404)
+    return status
+
+
+@app.get('/api/wa/cloud/stats')
+def api_wa_cloud_stats(db: Session = Depends(get_db)):
+    # per account: quota used/remaining, throughput, failure rate and health
+    return crud.cloud_account_stats(db)
+
+
+@app.get('/api/wa/web/metrics')
+async def api_wa_web_metrics():
+    # per-session browser sender: sent/failed counts and send latency percentiles
+    from . import wa_web
+    return wa_web.sender_metrics()
+
+
 @app.get('/api/wa/logs')
-async def api_wa_logs(limit: int = Query(200), db: Session = Depends(get_db)):
+def api_wa_logs(limit: int = Query(200), db: Session = Depends(get_db)):
     items = crud.list_message_logs(db, limit=limit)
     return [{"id": i.id, "to": i.to_phone, "student_id": i.student_id, "content": i.content, "status": i.status, "error": i.error, "sent_at": str(i.sent_at) if i.sent_at else None} for i in items]
 
 
 # WA accounts CRUD
 @app.post('/api/wa/accounts')
-async def api_create_wa_account(
+def api_create_wa_account(
     name: str = Form(None),
     phone_number: str = Form(None),
     phone_number_id: str = Form(None),
     access_token: str = Form(None),
     use_cloud_api: int = Form(0),
+    daily_limit: int = Form(None),
     db: Session = Depends(get_db)
 ):
-    a = crud.create_wa_account(db, name=name, phone_number=phone_number, phone_number_id=phone_number_id, access_token=access_token, use_cloud_api=use_cloud_api)
+    a = crud.create_wa_account(db, name=name, phone_number=phone_number, phone_number_id=phone_number_id, access_token=access_token, use_cloud_api=use_cloud_api, daily_limit=daily_limit)
     return {"ok": True, "id": a.id}
 
 
 @app.get('/api/wa/accounts')
-async def api_list_wa_accounts(db: Session = Depends(get_db)):
+def api_list_wa_accounts(db: Session = Depends(get_db)):
     items = crud.list_wa_accounts(db)
-    return [{"id": i.id, "name": i.name, "phone_number": i.phone_number, "connected": bool(i.connected), "created_at": str(i.created_at), "phone_number_id": i.phone_number_id, "use_cloud_api": bool(i.use_cloud_api)} for i in items]
+    return [{"id": i.id, "name": i.name, "phone_number": i.phone_number, "connected": bool(i.connected), "created_at": str(i.created_at), "phone_number_id": i.phone_number_id, "use_cloud_api": bool(i.use_cloud_api), "daily_limit": i.daily_limit} for i in items]
 
 
 @app.post('/api/wa/accounts/{account_id}/delete')
-async def api_delete_wa_account(account_id: int, db: Session = Depends(get_db)):
+def api_delete_wa_account(account_id: int, db: Session = Depends(get_db)):
     ok = crud.delete_wa_account(db, account_id)
     return {"ok": bool(ok)}
 
@@ -482,7 +705,7 @@ async def wa_page(request: Request):
 
 
 @app.post('/api/wa/send_via_web')
-async def api_wa_send_via_web(phone: str = Form(...), message: str = Form(...), db: Session = Depends(get_db)):
+def api_wa_send_via_web(phone: str = Form(...), message: str = Form(...), db: Session = Depends(get_db)):
     # use web automation helper
     log = crud.send_via_whatsapp_web(db, phone, message)
     return {"ok": True, "log_id": log.id, "status": log.status, "error": log.error}
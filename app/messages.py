@@ -0,0 +1,37 @@
+"""Outgoing WhatsApp texts rendered from Jinja2 templates in app/templates/messages/.
+
+Templates are compiled once and kept in the Environment's own cache (no
+auto_reload, so no file checks per render), so a bulk send only pays for
+rendering. The texts are plain WhatsApp messages, so autoescaping is off and
+the trailing newline of the files is kept.
+"""
+import os
+
+from jinja2 import Environment, FileSystemLoader, StrictUndefined
+
+MESSAGES_DIR = os.path.join(os.path.dirname(__file__), "templates", "messages")
+
+
+class MessageTemplates:
+    def __init__(self, directory: str = MESSAGES_DIR):
+        self.env = Environment(
+            loader=FileSystemLoader(directory),
+            autoescape=False,
+            keep_trailing_newline=True,
+            undefined=StrictUndefined,
+            auto_reload=False,
+        )
+
+    def render(self, template_name: str, /, **context) -> str:
+        return self.env.get_template(template_name).render(**context)
+
+    def clear(self):
+        """Forget compiled templates (after editing the .txt files)."""
+        self.env.cache.clear()
+
+
+templates = MessageTemplates()
+
+
+def render(template_name: str, /, **context) -> str:
+    return templates.render(template_name, **context)
@@ -0,0 +1,156 @@
+"""Schema upgrades for databases created by an older version of the models.
+
+Base.metadata.create_all() only creates missing tables, so a column or index
+added to an existing table never reaches a center.db (or Postgres database)
+that was created before it. upgrade() runs create_all for new tables and then
+every migration newer than the version recorded in the schema_version table,
+each in its own transaction together with its version row.
+
+Migrations look at the live schema before changing it: on a database that
+create_all has just built (fresh install) they change nothing and are only
+recorded. Existing rows are kept; new columns are added as nullable (or with
+a constant default) and backfilled where the code relies on them.
+
+To change the schema: edit the model, then append (next version, description,
+function) to MIGRATIONS using add_column / create_indexes, in the same commit.
+`python checks.py migrate_legacy_database` upgrades a pre-outbox database and
+fails on any model column or index that no migration creates.
+
+    python -m app.migrations            # upgrade DATABASE_URL and print the version
+    python -m app.migrations --status   # only show applied / pending versions
+"""
+import argparse
+import logging
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, func, inspect, select, text
+
+from .models import Base, CacheVersion
+
+log = logging.getLogger(__name__)
+
+_meta = MetaData()
+schema_version = Table(
+    "schema_version", _meta,
+    Column("version", Integer, primary_key=True),
+    Column("description", String(200)),
+    Column("applied_at", DateTime),
+)
+
+
+# ---------------------- helpers ----------------------
+def add_column(conn, table_name: str, column_name: str, default: str = None) -> bool:
+    """ALTER TABLE ... ADD COLUMN from the model's definition, unless the column exists."""
+    if column_name in {c["name"] for c in inspect(conn).get_columns(table_name)}:
+        return False
+    column = Base.metadata.tables[table_name].c[column_name]
+    ddl = f"ALTER TABLE {table_name} ADD COLUMN {column.name} {column.type.compile(dialect=conn.dialect)}"
+    for fk in column.foreign_keys:
+        ddl += f" REFERENCES {fk.column.table.name} ({fk.column.name})"
+    if default is not None:
+        ddl += f" DEFAULT {default}"  # SQLite only accepts constants here
+    conn.execute(text(ddl))
+    return True
+
+
+def create_indexes(conn, table_name: str, *names: str):
+    """Creates the model's indexes on a table (all, or the named ones) that don't exist yet."""
+    table = Base.metadata.tables[table_name]
+    wanted = set(names)
+    for index in table.indexes:
+        if not wanted or index.name in wanted:
+            index.create(conn, checkfirst=True)
+
+
+# ---------------------- migrations ----------------------
+def _outbox_columns(conn):
+    for name in ("job_id", "channel", "account_id", "created_at"):
+        add_column(conn, "message_logs", name)
+    add_column(conn, "message_logs", "attempts", default="0")
+    # the dedupe window and job status read created_at
+    conn.execute(text("UPDATE message_logs SET created_at = COALESCE(sent_at, CURRENT_TIMESTAMP) WHERE created_at IS NULL"))
+    create_indexes(conn, "message_logs", "ix_message_logs_job_id", "ix_message_logs_status_channel")
+
+
+def _message_hash(conn):
+    add_column(conn, "message_logs", "content_hash")
+    create_indexes(conn, "message_logs", "ix_message_logs_hash_created")
+
+
+def _account_daily_limit(conn):
+    add_column(conn, "wa_accounts", "daily_limit")
+
+
+def _lookup_indexes(conn):
+    for table_name in ("students", "attendance", "payments", "student_books", "student_tests", "expenses"):
+        create_indexes(conn, table_name)
+
+
+def _cache_versions(conn):
+    # create_all made the table; SharedVersions only bumps rows that exist
+    table = CacheVersion.__table__
+    existing = set(conn.execute(select(table.c.name)).scalars())
+    for name in CacheVersion.KINDS:
+        if name not in existing:
+            conn.execute(table.insert().values(name=name, version=0))
+
+
+MIGRATIONS = [
+    (1, "message_logs: outbox columns (job_id, channel, account_id, attempts, created_at)", _outbox_columns),
+    (2, "message_logs: content_hash for duplicate suppression", _message_hash),
+    (3, "wa_accounts: daily_limit", _account_daily_limit),
+    (4, "indexes: students, attendance, payments, student_books, student_tests, expenses", _lookup_indexes),
+    (5, "cache_versions: one row per cache kind (cross-process invalidation)", _cache_versions),
+]
+
+
+# ---------------------- runner ----------------------
+def current_version(conn) -> int:
+    if not inspect(conn).has_table("schema_version"):
+        return 0
+    return conn.execute(select(func.coalesce(func.max(schema_version.c.version), 0))).scalar()
+
+
+def pending(engine) -> list:
+    with engine.connect() as conn:
+        version = current_version(conn)
+    return [(v, description) for v, description, _ in MIGRATIONS if v > version]
+
+
+def upgrade(engine) -> list:
+    """Brings the database to the latest schema; returns the versions applied."""
+    Base.metadata.create_all(bind=engine)
+    _meta.create_all(bind=engine)
+    applied = []
+    for version, description, migrate in MIGRATIONS:
+        with engine.begin() as conn:
+            if version <= current_version(conn):
+                continue
+            migrate(conn)
+            conn.execute(schema_version.insert().values(
+                version=version, description=description, applied_at=datetime.now()))
+        log.info("schema migration %d applied: %s", version, description)
+        applied.append(version)
+    return applied
+
+
+def main(argv=None):
+    from .database import engine
+
+    parser = argparse.ArgumentParser(description="Upgrade the database schema")
+    parser.add_argument("--status", action="store_true", help="show pending migrations without applying them")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    print("database:", engine.url.render_as_string(hide_password=True))
+    if args.status:
+        for version, description in pending(engine):
+            print(f"pending {version}: {description}")
+    else:
+        applied = upgrade(engine)
+        print("applied:", applied or "nothing")
+    with engine.connect() as conn:
+        print("schema version:", current_version(conn))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,4 @@
-from sqlalchemy import Table, Column, Integer, String, DateTime, ForeignKey, Text, Date, Float
+from sqlalchemy import Table, Column, Integer, String, DateTime, ForeignKey, Text, Date, Float, Index
 from sqlalchemy.sql import func
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
@@ -32,8 +32,13 @@ class Student(Base):
     parent_phone = Column(String(30), nullable=True)
     email = Column(String(120), nullable=True)
     created_at = Column(DateTime, server_default=func.now())
-    class_id = Column(Integer, ForeignKey("classes.id"), nullable=True)
-    group_id = Column(Integer, ForeignKey("groups.id"), nullable=True)
+    class_id = Column(Integer, ForeignKey("classes.id"), nullable=True, index=True)
+    group_id = Column(Integer, ForeignKey("groups.id"), nullable=True, index=True)
+
+    # keyset pagination by name (see crud.list_students_page)
+    __table_args__ = (
+        Index("ix_students_first_name_id", "first_name", "id"),
+    )
 
 
 class SessionAttendance(Base):
@@ -45,6 +50,11 @@ class SessionAttendance(Base):
     score = Column(Float, nullable=True)
     recorded_by = Column(String(50), default="system")  # system/device/manual
 
+    # check-in dedupe and "last attendance" are range/max lookups per student
+    __table_args__ = (
+        Index("ix_attendance_student_date", "student_id", "session_date"),
+    )
+
 
 class Payment(Base):
     __tablename__ = "payments"
@@ -52,9 +62,14 @@ class Payment(Base):
     student_id = Column(Integer, ForeignKey("students.id"))
     amount = Column(Float, default=0.0)
     method = Column(String(50), default="cash")
-    payment_date = Column(Date, server_default=func.current_date())
+    payment_date = Column(Date, server_default=func.current_date(), index=True)
     note = Column(Text, nullable=True)
 
+    # payment status = latest payment_date per student
+    __table_args__ = (
+        Index("ix_payments_student_date", "student_id", "payment_date"),
+    )
+
 
 # جدول الكتب/المذكرات
 class Book(Base):
@@ -72,7 +87,12 @@ class StudentBook(Base):
     id = Column(Integer, primary_key=True, index=True)
     student_id = Column(Integer, ForeignKey("students.id"))
     book_id = Column(Integer, ForeignKey("books.id"))
-    buy_date = Column(DateTime, server_default=func.now())
+    buy_date = Column(DateTime, server_default=func.now(), index=True)
+
+    # a student's purchases, newest first (profile)
+    __table_args__ = (
+        Index("ix_student_books_student_date", "student_id", "buy_date"),
+    )
 
 
 # جدول الاختبارات/التسميع
@@ -94,6 +114,11 @@ class StudentTest(Base):
     score = Column(Float, nullable=True)
     recorded_at = Column(DateTime, server_default=func.now())
 
+    # a student's results, newest first (profile, reports)
+    __table_args__ = (
+        Index("ix_student_tests_student_date", "student_id", "recorded_at"),
+    )
+
 
 # نفقات/فواتير الخزنة
 class Expense(Base):
@@ -101,7 +126,7 @@ class Expense(Base):
     id = Column(Integer, primary_key=True, index=True)
     title = Column(String(200), nullable=False)
     amount = Column(Float, default=0.0)
-    expense_date = Column(Date, server_default=func.current_date())
+    expense_date = Column(Date, server_default=func.current_date(), index=True)
     note = Column(Text, nullable=True)
 
 
@@ -115,15 +140,40 @@ class WhatsAppSession(Base):
     created_at = Column(DateTime, server_default=func.now())
 
 
+# مهمة إرسال جماعي (تقارير مجموعة) — الرسائل نفسها في message_logs
+class MessageJob(Base):
+    __tablename__ = "message_jobs"
+    id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String(50), default="group_report")
+    target_id = Column(Integer, nullable=True)  # group id for group_report
+    send_mode = Column(String(20), nullable=True)
+    total = Column(Integer, default=0)
+    created_at = Column(DateTime, server_default=func.now())
+
+
 class MessageLog(Base):
     __tablename__ = "message_logs"
     id = Column(Integer, primary_key=True, index=True)
     to_phone = Column(String(50))
     student_id = Column(Integer, ForeignKey("students.id"), nullable=True)
     content = Column(Text)
+    # queued rows: pending -> sending -> sent/failed (see app/outbox.py); rows without a channel are manual
     status = Column(String(50), default="pending")
     error = Column(Text, nullable=True)
     sent_at = Column(DateTime, nullable=True)
+    job_id = Column(Integer, ForeignKey("message_jobs.id"), nullable=True, index=True)
+    channel = Column(String(20), nullable=True)  # cloud/web, None = not sent automatically
+    account_id = Column(Integer, ForeignKey("wa_accounts.id"), nullable=True)
+    attempts = Column(Integer, default=0)
+    # default= as well: on databases upgraded by app/migrations.py the column has no DB default
+    created_at = Column(DateTime, server_default=func.now(), default=func.now())
+    # sha1 of content, for skipping re-sends of the same text to the same phone
+    content_hash = Column(String(40), nullable=True)
+
+    __table_args__ = (
+        Index("ix_message_logs_status_channel", "status", "channel"),
+        Index("ix_message_logs_hash_created", "content_hash", "created_at"),
+    )
 
 
 # Accounts to send from (represent WhatsApp accounts / sessions)
@@ -138,3 +188,13 @@ class WhatsAppAccount(Base):
     phone_number_id = Column(String(120), nullable=True)
     access_token = Column(String(500), nullable=True)
     use_cloud_api = Column(Integer, default=0)
+    # messages per 24h this number may send (Cloud API messaging tier); NULL = DEFAULT_DAILY_LIMIT
+    daily_limit = Column(Integer, nullable=True)
+
+
+# one counter per kind of cached data, bumped by every commit that changes it (see app/cache.py SharedVersions)
+class CacheVersion(Base):
+    __tablename__ = "cache_versions"
+    KINDS = ("students", "money")  # rows created by app/migrations.py
+    name = Column(String(32), primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
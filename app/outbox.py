@@ -0,0 +1,71 @@
+"""Background delivery of queued WhatsApp messages.
+
+MessageLog rows are the durable queue: a row with a channel (cloud/web) and
+status 'pending' waits for a worker, which claims it (pending -> sending),
+delivers it and marks it 'sent' or 'failed'. Rows found in 'sending' at start
+were interrupted by a restart and go back to 'pending' (at-least-once delivery).
+
+Workers are plain threads because delivery (requests / Playwright sync API) is
+blocking; each one uses its own DB session.
+"""
+import logging
+import threading
+
+from . import crud
+
+log = logging.getLogger(__name__)
+
+
+class Outbox:
+    def __init__(self, workers: int = 4, poll_interval: float = 5.0):
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._session_factory = None
+        self._threads = []
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+
+    def start(self, session_factory):
+        if self._threads:
+            return
+        self._session_factory = session_factory
+        self._stop.clear()
+        db = session_factory()
+        try:
+            requeued = crud.requeue_interrupted_messages(db)
+            if requeued:
+                log.info("outbox: requeued %d interrupted messages", requeued)
+        finally:
+            db.close()
+        for i in range(self.workers):
+            t = threading.Thread(target=self._run, name=f"outbox-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self, timeout: float = 5.0):
+        self._stop.set()
+        self._wake.set()
+        for t in self._threads:
+            t.join(timeout)
+        self._threads = []
+
+    def notify(self):
+        """Wake idle workers after new messages were queued."""
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            db = self._session_factory()
+            try:
+                msg = crud.claim_next_message(db)
+                if msg is not None:
+                    crud.deliver_message(db, msg)
+                    continue
+            except Exception:
+                log.exception("outbox: delivery failed")
+                db.rollback()
+            finally:
+                db.close()
+            # queue empty (or DB error): sleep until notified or the next poll
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
@@ -0,0 +1,252 @@
+"""Headless RFID reader service: serial card readers -> POST /api/scan/batch.
+
+Replaces the keyboard-wedge setup (reader typing into scanner.html) for desks
+without a browser:
+- one thread per serial device reads card codes (one per line; STX/ETX framing
+  used by EM4100 readers is stripped),
+- repeated taps of the same card within --debounce seconds are dropped,
+- every tap is appended to a local journal (JSON lines, fsync'd) with its tap
+  time before anything is sent, so restarts of either side lose nothing,
+- one uploader sends the journal in batches over a keep-alive HTTP session and
+  removes the scans the server answered. Replays are idempotent server side.
+
+Run:
+    python -m app.rfid_reader --port COM3 --server http://127.0.0.1:8000
+    python -m app.rfid_reader --port /dev/ttyUSB0 --port /dev/ttyUSB1 --debounce 5
+
+--port accepts anything pyserial's serial_for_url does, so a pseudo-terminal
+(e.g. one end of `socat -d -d pty,raw,echo=0 pty,raw,echo=0`) or loop:// can
+stand in for a device.
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+import requests
+import serial
+
+log = logging.getLogger("rfid_reader")
+
+DEFAULT_SERVER = os.environ.get("RFID_SERVER", "http://127.0.0.1:8000")
+DEFAULT_JOURNAL = os.environ.get("RFID_JOURNAL", "rfid_journal.jsonl")
+BATCH_SIZE = 200
+
+
+def parse_card(raw: bytes) -> str:
+    """Card code from one reader line: framing/control characters and whitespace removed."""
+    text = raw.decode("ascii", errors="ignore")
+    return "".join(ch for ch in text if ch.isprintable()).strip()
+
+
+class ScanJournal:
+    """Pending scans, kept in memory and mirrored to an append-only JSON-lines file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._pending = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        scan = json.loads(line)
+                    except ValueError:
+                        continue  # torn last line after a crash
+                    self._pending[scan["id"]] = scan
+        self._file = open(path, "a", encoding="utf-8")
+
+    def append(self, scan: dict):
+        with self._lock:
+            self._pending[scan["id"]] = scan
+            self._file.write(json.dumps(scan) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def pending(self, limit: int = None) -> list:
+        with self._lock:
+            scans = list(self._pending.values())
+        return scans[:limit] if limit else scans
+
+    def ack(self, ids):
+        """Forget answered scans and compact the file to what is still pending."""
+        with self._lock:
+            for scan_id in ids:
+                self._pending.pop(scan_id, None)
+            tmp = self.path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                for scan in self._pending.values():
+                    f.write(json.dumps(scan) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self._file.close()
+            os.replace(tmp, self.path)
+            self._file = open(self.path, "a", encoding="utf-8")
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class Debouncer:
+    """Drops a card seen again within `window` seconds (on any reader)."""
+
+    def __init__(self, window: float):
+        self.window = window
+        self._last = {}
+        self._lock = threading.Lock()
+
+    def accept(self, code: str) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            last = self._last.get(code)
+            if last is not None and now - last < self.window:
+                return False
+            self._last[code] = now
+            if len(self._last) > 10000:
+                self._last = {c: t for c, t in self._last.items() if now - t < self.window}
+            return True
+
+
+class SerialReader(threading.Thread):
+    def __init__(self, port: str, baudrate: int, on_card, stop: threading.Event):
+        super().__init__(name=f"reader-{port}", daemon=True)
+        self.port = port
+        self.baudrate = baudrate
+        self.on_card = on_card
+        self.stop = stop
+
+    def run(self):
+        delay = 1
+        while not self.stop.is_set():
+            try:
+                with serial.serial_for_url(self.port, baudrate=self.baudrate, timeout=0.5) as dev:
+                    log.info("reading %s", self.port)
+                    delay = 1
+                    buf = b""
+                    while not self.stop.is_set():
+                        chunk = dev.read_until(b"\n")  # returns at a newline or after the timeout
+                        if not chunk:
+                            continue
+                        # CR, LF and ETX all end a card code; an unterminated tail waits for the next read
+                        buf += chunk.replace(b"\r", b"\n").replace(b"\x03", b"\n")
+                        *lines, buf = buf.split(b"\n")
+                        for part in lines:
+                            code = parse_card(part)
+                            if code:
+                                self.on_card(code, self.port)
+            except (serial.SerialException, OSError) as e:
+                log.warning("%s: %s (retrying in %ss)", self.port, e, delay)
+                self.stop.wait(delay)
+                delay = min(delay * 2, 30)
+
+
+class ScanUploader(threading.Thread):
+    def __init__(self, server: str, journal: ScanJournal, stop: threading.Event, interval: float = 5.0):
+        super().__init__(name="uploader", daemon=True)
+        self.url = server.rstrip("/") + "/api/scan/batch"
+        self.journal = journal
+        self.stop = stop
+        self.interval = interval
+        self.wake = threading.Event()
+        self.session = requests.Session()  # keep-alive connection to the server
+
+    def run(self):
+        delay = self.interval
+        while not self.stop.is_set():
+            try:
+                while True:
+                    batch = self.journal.pending(BATCH_SIZE)
+                    if not batch:
+                        break
+                    # sent_at lets the server correct the tap times if this PC's clock is off
+                    res = self.session.post(self.url, json={
+                        "scans": batch, "recorded_by": "RFID_reader",
+                        "sent_at": datetime.now(timezone.utc).isoformat(),
+                    }, timeout=15)
+                    res.raise_for_status()
+                    results = res.json()["results"]
+                    if not results:
+                        break
+                    self.journal.ack([r["id"] for r in results])
+                    for r in results:
+                        log.info("scan %s: %s", r["id"], r["status"])
+                delay = self.interval
+            except (requests.RequestException, ValueError, KeyError) as e:
+                log.warning("upload failed (%s), %d scans kept", e, len(self.journal.pending()))
+                delay = min(delay * 2, 60)
+            self.wake.wait(delay)
+            self.wake.clear()
+
+
+class ReaderService:
+    """The readers, debouncer, journal and uploader wired together (what main() runs)."""
+
+    def __init__(self, ports: list, baudrate: int, server: str, journal_path: str, debounce: float,
+                 upload_interval: float = 5.0):
+        self.stop = threading.Event()
+        self.journal = ScanJournal(journal_path)
+        self.debouncer = Debouncer(debounce)
+        self.uploader = ScanUploader(server, self.journal, self.stop, interval=upload_interval)
+        self.readers = [SerialReader(port, baudrate, self.on_card, self.stop) for port in ports]
+
+    def on_card(self, code: str, port: str):
+        if not self.debouncer.accept(code):
+            return
+        # journaled (fsync'd) before the uploader is woken
+        self.journal.append({
+            "id": uuid.uuid4().hex,
+            "code": code,
+            "scanned_at": datetime.now(timezone.utc).isoformat(),
+            "port": port,
+        })
+        self.uploader.wake.set()
+
+    def start(self):
+        for t in self.readers + [self.uploader]:
+            t.start()
+
+    def close(self):
+        self.stop.set()
+        self.uploader.wake.set()
+        for t in self.readers + [self.uploader]:
+            t.join(2)
+        self.journal.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Serial RFID reader -> ECMS scan API")
+    parser.add_argument("--port", action="append", default=None,
+                        help="serial device or pyserial URL (repeat for several readers; "
+                             "replaces RFID_PORTS, a comma-separated list used when no --port is given)")
+    parser.add_argument("--baud", type=int, default=int(os.environ.get("RFID_BAUD", "9600")))
+    parser.add_argument("--server", default=DEFAULT_SERVER)
+    parser.add_argument("--journal", default=DEFAULT_JOURNAL)
+    parser.add_argument("--debounce", type=float, default=3.0, help="seconds to ignore repeated taps of a card")
+    args = parser.parse_args(argv)
+    args.port = args.port or [p for p in os.environ.get("RFID_PORTS", "").split(",") if p]
+    if not args.port:
+        parser.error("at least one --port (or RFID_PORTS) is required")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(threadName)s %(message)s")
+    service = ReaderService(args.port, args.baud, args.server, args.journal, args.debounce)
+    service.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+
+
+if __name__ == "__main__":
+    main()
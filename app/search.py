@@ -0,0 +1,169 @@
+"""In-process student search index (prefix + trigram) with Arabic normalization.
+
+Staff type names inconsistently (أحمد / احمد, فاطمة / فاطمه, with or without
+tashkeel), so both the indexed names and the query go through the same
+normalize() before matching. The index is built from the students table on the
+first search and kept in sync by crud.create_student / crud.delete_student;
+crud.cache_versions resets it when another process changes the students.
+"""
+import bisect
+import re
+import threading
+
+# tashkeel (fathatan .. sukun), superscript alef and tatweel
+_DIACRITICS = re.compile("[\u064B-\u0652\u0670\u0640]")
+_CHAR_MAP = str.maketrans({
+    "أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا",
+    "ة": "ه",
+    "ى": "ي",
+    "ؤ": "و",
+    "ئ": "ي",
+    **{chr(0x0660 + i): str(i) for i in range(10)},  # Arabic-Indic digits
+    **{chr(0x06F0 + i): str(i) for i in range(10)},  # Extended (Persian) digits
+})
+_TOKEN = re.compile(r"\w+")
+
+EXACT, PREFIX, SUBSTRING = 3, 2, 1
+
+
+def normalize(text: str) -> str:
+    if not text:
+        return ""
+    return _DIACRITICS.sub("", text).translate(_CHAR_MAP).lower()
+
+
+def tokenize(*fields) -> list:
+    tokens = []
+    for field in fields:
+        tokens.extend(_TOKEN.findall(normalize(field)))
+    return tokens
+
+
+def _trigrams(token: str):
+    return {token[i:i + 3] for i in range(len(token) - 2)}
+
+
+class StudentSearchIndex:
+    """Token index over first_name, last_name and uuid.
+
+    - exact and prefix matches use a sorted token list (bisect)
+    - substring matches (3+ chars) use a trigram -> tokens map
+    Every query term must match; results rank by exact > prefix > substring, then id.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._doc_tokens = {}    # student id -> set of tokens
+        self._postings = {}      # token -> set of student ids
+        self._sorted_tokens = []
+        self._trigram_tokens = {}  # trigram -> set of tokens
+
+    def ensure_loaded(self, db):
+        if self._loaded:
+            return
+        from . import models
+        # query under the lock so an add() racing the first load is applied after it, not lost
+        with self._lock:
+            if self._loaded:
+                return
+            rows = db.query(models.Student.id, models.Student.first_name, models.Student.last_name, models.Student.uuid).all()
+            for sid, first_name, last_name, uuid_code in rows:
+                self._add(sid, first_name, last_name, uuid_code)
+            self._loaded = True
+
+    def add(self, student_id: int, first_name: str = None, last_name: str = None, uuid_code: str = None):
+        with self._lock:
+            # before the first load the student is picked up by ensure_loaded anyway
+            if self._loaded:
+                self._remove(student_id)
+                self._add(student_id, first_name, last_name, uuid_code)
+
+    def remove(self, student_id: int):
+        with self._lock:
+            if self._loaded:
+                self._remove(student_id)
+
+    def reset(self):
+        with self._lock:
+            self._loaded = False
+            self._doc_tokens.clear()
+            self._postings.clear()
+            self._sorted_tokens = []
+            self._trigram_tokens.clear()
+
+    def _add(self, student_id, first_name, last_name, uuid_code):
+        tokens = set(tokenize(first_name, last_name, uuid_code))
+        self._doc_tokens[student_id] = tokens
+        for token in tokens:
+            ids = self._postings.get(token)
+            if ids is None:
+                self._postings[token] = ids = set()
+                bisect.insort(self._sorted_tokens, token)
+                for tri in _trigrams(token):
+                    self._trigram_tokens.setdefault(tri, set()).add(token)
+            ids.add(student_id)
+
+    def _remove(self, student_id):
+        for token in self._doc_tokens.pop(student_id, ()):
+            ids = self._postings.get(token)
+            if ids is None:
+                continue
+            ids.discard(student_id)
+            if not ids:
+                del self._postings[token]
+                pos = bisect.bisect_left(self._sorted_tokens, token)
+                if pos < len(self._sorted_tokens) and self._sorted_tokens[pos] == token:
+                    self._sorted_tokens.pop(pos)
+                for tri in _trigrams(token):
+                    toks = self._trigram_tokens.get(tri)
+                    if toks is not None:
+                        toks.discard(token)
+                        if not toks:
+                            del self._trigram_tokens[tri]
+
+    def _term_scores(self, term: str) -> dict:
+        """student id -> best match score for one query term."""
+        scores = {}
+
+        def mark(token, score):
+            for sid in self._postings.get(token, ()):
+                if scores.get(sid, 0) < score:
+                    scores[sid] = score
+
+        if len(term) >= 3:
+            candidates = None
+            for tri in _trigrams(term):
+                toks = self._trigram_tokens.get(tri)
+                if not toks:
+                    return scores
+                candidates = set(toks) if candidates is None else candidates & toks
+            for token in candidates:
+                if term in token:
+                    mark(token, SUBSTRING)
+
+        pos = bisect.bisect_left(self._sorted_tokens, term)
+        while pos < len(self._sorted_tokens) and self._sorted_tokens[pos].startswith(term):
+            token = self._sorted_tokens[pos]
+            mark(token, EXACT if token == term else PREFIX)
+            pos += 1
+        return scores
+
+    def search(self, db, q: str, limit: int = 50) -> list:
+        """Ranked student ids matching every term of q."""
+        terms = tokenize(q)
+        if not terms:
+            return []
+        self.ensure_loaded(db)
+        with self._lock:
+            total = None
+            for term in terms:
+                scores = self._term_scores(term)
+                if total is None:
+                    total = scores
+                else:
+                    total = {sid: total[sid] + score for sid, score in scores.items() if sid in total}
+                if not total:
+                    return []
+        ranked = sorted(total.items(), key=lambda item: (-item[1], item[0]))
+        return [sid for sid, _ in ranked[:limit]]
@@ -12,6 +12,13 @@ os.makedirs(BARCODES_DIR, exist_ok=True)
 def generate_uuid():
     return str(uuid.uuid4())
 
+def _write_atomic(path, write):
+    # write to a temp file first so a reader never sees a half-written PNG
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        write(f)
+    os.replace(tmp, path)
+
 def generate_code128_image(code_str, filename=None):
     """يرجع path للصورة المولدة (PNG)."""
     if filename is None:
@@ -19,7 +26,7 @@ def generate_code128_image(code_str, filename=None):
     path = os.path.join(BARCODES_DIR, filename)
     # Use ImageWriter to create PNG
     writer_options = {'write_text': False}
-    Code128(code_str, writer=ImageWriter()).write(open(path, "wb"), writer_options)
+    _write_atomic(path, lambda f: Code128(code_str, writer=ImageWriter()).write(f, writer_options))
     return path
 
 def generate_qr_image(code_str, filename=None):
@@ -27,5 +34,28 @@ def generate_qr_image(code_str, filename=None):
         filename = f"qr_{code_str}.png"
     path = os.path.join(BARCODES_DIR, filename)
     img = qrcode.make(code_str)
-    img.save(path)
+    _write_atomic(path, lambda f: img.save(f, format="PNG"))
     return path
+
+def card_image_paths(code_str):
+    return os.path.join(BARCODES_DIR, f"{code_str}.png"), os.path.join(BARCODES_DIR, f"qr_{code_str}.png")
+
+def render_card_images(code_str):
+    """يولد صور الباركود والـ QR للكارت لو مش موجودة (بيتنفذ في process منفصل)."""
+    barcode_path, qr_path = card_image_paths(code_str)
+    if not os.path.exists(barcode_path):
+        generate_code128_image(code_str)
+    if not os.path.exists(qr_path):
+        generate_qr_image(code_str)
+    return code_str
+
+def render_card_images_batch(codes):
+    """Renders a chunk of cards in one worker call. Returns (done, failed) counts."""
+    done = failed = 0
+    for code_str in codes:
+        try:
+            render_card_images(code_str)
+            done += 1
+        except Exception:
+            failed += 1
+    return done, failed
@@ -0,0 +1,225 @@
+"""WhatsApp Cloud API client shared by every sender (single sends and the outbox workers).
+
+One CloudSender per account keeps a keep-alive connection pool, caps in-flight
+requests, paces sends with a token bucket and retries 429/5xx/network errors
+with exponential backoff (honouring Retry-After). Account credentials are cached
+in `clients`, so sending doesn't re-read the wa_accounts row per message.
+
+Each sender also keeps a short history of outcomes: an account whose sends keep
+failing at the account level (auth, rate limit, server or network errors) is
+marked unhealthy for a cooldown, and crud stops assigning messages to it and
+moves its queued share to the healthy accounts (see spread()).
+
+Set WA_GRAPH_API_URL to point the client at a local mock Graph API.
+"""
+import os
+import random
+import threading
+import time
+from collections import deque
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+GRAPH_API_URL = os.environ.get("WA_GRAPH_API_URL", "https://graph.facebook.com/v17.0")
+# Cloud API default throughput is 80 messages/second per business phone number
+DEFAULT_RATE = float(os.environ.get("WA_CLOUD_RATE", "80"))
+DEFAULT_CONCURRENCY = int(os.environ.get("WA_CLOUD_CONCURRENCY", "8"))
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# failures caused by the account rather than the recipient (reroutable to another account)
+ACCOUNT_FAILURE_STATUSES = RETRY_STATUSES | {401, 403}
+UNHEALTHY_AFTER = 3          # consecutive account-level failures
+UNHEALTHY_FAILURE_RATE = 0.5  # or this failure rate over the recent window...
+MIN_SAMPLES = 10              # ...once it has at least this many sends
+HEALTH_WINDOW = 300           # seconds of history used for rates
+COOLDOWN = 60                 # seconds an unhealthy account gets no new messages
+
+
+class TokenBucket:
+    """Allows `rate` acquisitions per second with bursts up to `burst`; acquire() blocks."""
+
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class CloudSender:
+    def __init__(self, phone_number_id: str, access_token: str, rate: float = DEFAULT_RATE,
+                 max_concurrency: int = DEFAULT_CONCURRENCY, max_retries: int = 3,
+                 backoff: float = 0.5, max_backoff: float = 30.0, timeout: float = 15):
+        self.phone_number_id = phone_number_id
+        self.access_token = access_token
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.url = f"{GRAPH_API_URL}/{phone_number_id}/messages"
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency))
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency))
+        self.session.headers.update({
+            'Authorization': f'Bearer {access_token}',
+            'Content-Type': 'application/json'
+        })
+        self.bucket = TokenBucket(rate)
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._stats_lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self._recent = deque(maxlen=1000)  # (monotonic time, ok)
+        self._consecutive_failures = 0
+        self._down_until = 0.0
+
+    def _delay(self, attempt: int, response=None) -> float:
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after:
+            try:
+                return min(float(retry_after), self.max_backoff)
+            except ValueError:
+                pass
+        return min(self.backoff * (2 ** (attempt - 1)), self.max_backoff) * random.uniform(0.8, 1.2)
+
+    def send(self, to_phone: str, message: str) -> dict:
+        """Returns {ok, error, attempts, status_code}."""
+        payload = {
+            'messaging_product': 'whatsapp',
+            'to': to_phone,
+            'type': 'text',
+            'text': {'body': message}
+        }
+        attempt = 0
+        while True:
+            attempt += 1
+            self.bucket.acquire()
+            response = None
+            with self._slots:
+                try:
+                    response = self.session.post(self.url, json=payload, timeout=self.timeout)
+                except requests.RequestException as e:
+                    result = {"ok": False, "error": str(e), "attempts": attempt, "status_code": None}
+                else:
+                    ok = response.status_code in (200, 201)
+                    result = {"ok": ok, "error": None if ok else response.text, "attempts": attempt, "status_code": response.status_code}
+
+            retryable = not result["ok"] and (response is None or response.status_code in RETRY_STATUSES)
+            if not retryable or attempt > self.max_retries:
+                result["account_failure"] = not result["ok"] and (
+                    response is None or response.status_code in ACCOUNT_FAILURE_STATUSES)
+                self._record(result)
+                return result
+            with self._stats_lock:
+                self.retries += 1
+            time.sleep(self._delay(attempt, response))
+
+    def _record(self, result: dict):
+        now = time.monotonic()
+        with self._stats_lock:
+            if result["ok"]:
+                self.sent += 1
+            else:
+                self.failed += 1
+            self._recent.append((now, result["ok"]))
+            if result["account_failure"]:
+                self._consecutive_failures += 1
+            elif result["ok"]:
+                self._consecutive_failures = 0
+            recent = [ok for t, ok in self._recent if now - t <= HEALTH_WINDOW]
+            failure_rate = recent.count(False) / len(recent) if recent else 0.0
+            if result["account_failure"] and (
+                    self._consecutive_failures >= UNHEALTHY_AFTER
+                    or (len(recent) >= MIN_SAMPLES and failure_rate >= UNHEALTHY_FAILURE_RATE)):
+                self._down_until = now + COOLDOWN
+
+    def healthy(self) -> bool:
+        return time.monotonic() >= self._down_until
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._stats_lock:
+            recent = [(t, ok) for t, ok in self._recent if now - t <= HEALTH_WINDOW]
+            last_minute = sum(1 for t, ok in recent if ok and now - t <= 60)
+            failures = sum(1 for _, ok in recent if not ok)
+            return {
+                "sent": self.sent,
+                "failed": self.failed,
+                "retries": self.retries,
+                "sent_last_minute": last_minute,
+                "failure_rate": round(failures / len(recent), 3) if recent else 0.0,
+                "consecutive_failures": self._consecutive_failures,
+                "healthy": now >= self._down_until,
+                "cooldown_left": round(max(0.0, self._down_until - now), 1),
+            }
+
+    def close(self):
+        self.session.close()
+
+
+class CloudClientRegistry:
+    """CloudSender per WhatsAppAccount id, built from the account row on first use."""
+
+    def __init__(self):
+        self._senders = {}
+        self._lock = threading.Lock()
+
+    def for_account(self, db, account_id: int) -> Optional[CloudSender]:
+        with self._lock:
+            sender = self._senders.get(account_id)
+        if sender is not None:
+            return sender
+        from . import models
+        acc = db.query(models.WhatsAppAccount).filter(models.WhatsAppAccount.id == account_id).first()
+        if not acc or not acc.access_token or not acc.phone_number_id:
+            return None
+        with self._lock:
+            sender = self._senders.get(account_id)
+            if sender is None:
+                sender = self._senders[account_id] = CloudSender(acc.phone_number_id, acc.access_token)
+            return sender
+
+    def forget(self, account_id: int):
+        with self._lock:
+            sender = self._senders.pop(account_id, None)
+        if sender is not None:
+            sender.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            senders = dict(self._senders)
+        return {account_id: sender.stats() for account_id, sender in senders.items()}
+
+
+def spread(weights: dict, n: int) -> list:
+    """Smooth weighted round-robin: n account ids, interleaved in proportion to their weights."""
+    weights = {k: w for k, w in weights.items() if w > 0}
+    if not weights:
+        return []
+    total = sum(weights.values())
+    current = dict.fromkeys(weights, 0)
+    picks = []
+    for _ in range(n):
+        for k, w in weights.items():
+            current[k] += w
+        best = max(current, key=current.get)
+        current[best] -= total
+        picks.append(best)
+    return picks
+
+
+clients = CloudClientRegistry()
@@ -5,48 +5,245 @@ This module provides best-effort functions. To use Playwright you must install
 module can use `pywhatkit.sendwhatmsg_instantly` for simple send (which opens
 the default browser and relies on logged-in WhatsApp Web session).
 
+Playwright sends go through a long-lived WebSender: one browser, one context
+(restored from and saved back to a WhatsAppSession's storage state, so the
+WhatsApp Web login survives) and one page reused for every message. The sync
+Playwright API is bound to the thread that started it, so each WebSender owns
+a worker thread and send() hands messages to it.
+
+Set WA_WEB_URL to point the sender at a local page standing in for WhatsApp Web;
+bench/fixtures/wa_web.html is one (checks.py wa_web_sender_fixture serves it
+and sends through it).
+
 Note: Running Playwright or Selenium from a server requires a persistent
 graphical session or running in headless mode and ensuring cookies/session
 auth is handled. For production integrations prefer WhatsApp Business API.
 """
 from typing import Optional
-import time
+from collections import deque
+from concurrent.futures import Future
+from urllib.parse import quote
 import logging
+import os
+import queue
+import threading
+import time
 
 log = logging.getLogger(__name__)
 
-def send_with_playwright(phone: str, message: str, headless: bool = True, timeout: int = 30) -> dict:
-    try:
-        from playwright.sync_api import sync_playwright
-    except Exception as e:
-        return {"ok": False, "error": f"playwright_not_available: {e}"}
+WA_WEB_URL = os.environ.get("WA_WEB_URL", "https://web.whatsapp.com")
+# DOM signals (WhatsApp Web changes these from time to time)
+COMPOSE_SELECTOR = 'footer div[contenteditable="true"]'
+SEND_BUTTON_SELECTOR = 'footer button[aria-label="Send"], footer span[data-icon="send"]'
+LOGIN_QR_SELECTOR = 'canvas[aria-label="Scan me!"], div[data-ref] canvas'
+INVALID_PHONE_SELECTOR = 'div[data-animate-modal-popup="true"]'
+OUTGOING_SELECTOR = 'div.message-out'
+PENDING_ICON_SELECTOR = 'span[data-icon="msg-time"]'
 
-    phone = phone.lstrip('+')
-    url = f"https://web.whatsapp.com/send?phone={phone}&text={message}"
 
-    try:
-        with sync_playwright() as pw:
-            browser = pw.chromium.launch(headless=headless)
-            context = browser.new_context()
-            page = context.new_page()
-            page.goto(url, timeout=timeout*1000)
-            # wait for the send button or for chat to load
-            # Try clicking the send button if available
-            try:
-                page.wait_for_selector('div[data-testid="conversation-compose-box-input"]', timeout=8000)
-            except Exception:
-                pass
-            # press Enter to send
+class WebSender:
+    def __init__(self, storage_state: Optional[dict] = None, headless: bool = True, timeout: int = 30, base_url: str = None):
+        self.headless = headless
+        self.timeout = timeout
+        self.base_url = (base_url or WA_WEB_URL).rstrip('/')
+        self._storage_state = storage_state
+        self._state_dirty = False
+        self._jobs = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._closing = False  # the worker is draining the queue and exiting: new jobs are refused
+        self._error = None
+        self._latencies = deque(maxlen=500)
+        self.sent = 0
+        self.failed = 0
+
+    # ---- caller side ----
+    def start(self):
+        with self._lock:
+            self._start_locked()
+
+    def _start_locked(self):
+        if self._thread is None or not self._thread.is_alive():
+            # the old queue was drained by the exiting worker (only a stop() sentinel can be left)
+            self._jobs = queue.Queue()
+            self._closing = False
+            self._error = None
+            self._thread = threading.Thread(target=self._run, args=(self._jobs,), name="wa-web-sender", daemon=True)
+            self._thread.start()
+
+    def send(self, phone: str, message: str) -> dict:
+        """Blocks until the worker has sent (or failed) the message. Returns {ok, error?, latency_ms}."""
+        job = Future()
+        with self._lock:
+            # a worker on its way out won't read the queue again; once it has exited a new one is started
+            if self._closing and self._thread.is_alive():
+                return {"ok": False, "error": self._error or "sender_stopped"}
+            self._start_locked()
+            # queued under the lock: a worker that fails to launch still answers this job
+            self._jobs.put((phone, message, job, time.perf_counter()))
+        try:
+            return job.result(timeout=self.timeout * 2)
+        except Exception as e:
+            return {"ok": False, "error": f"timeout: {e}"}
+
+    def stop(self):
+        with self._lock:
+            thread = self._thread
+            if thread is None or not thread.is_alive():
+                return
+            self._jobs.put(None)
+        thread.join(10)
+
+    def take_storage_state(self) -> Optional[dict]:
+        """Latest storage state if it changed since the last call (to persist in WhatsAppSession.session_data)."""
+        with self._lock:
+            if not self._state_dirty:
+                return None
+            self._state_dirty = False
+            return self._storage_state
+
+    def metrics(self) -> dict:
+        with self._lock:
+            samples = sorted(self._latencies)
+            sent, failed, error = self.sent, self.failed, self._error
+
+        def pct(p):
+            return round(samples[min(len(samples) - 1, int(p * len(samples)))], 1) if samples else None
+
+        return {
+            "running": bool(self._thread and self._thread.is_alive()),
+            "sent": sent,
+            "failed": failed,
+            "error": error,
+            "samples": len(samples),
+            "avg_ms": round(sum(samples) / len(samples), 1) if samples else None,
+            "p50_ms": pct(0.5),
+            "p95_ms": pct(0.95),
+            "max_ms": round(samples[-1], 1) if samples else None,
+        }
+
+    # ---- worker thread ----
+    def _run(self, jobs: queue.Queue):
+        try:
+            from playwright.sync_api import sync_playwright
+        except Exception as e:
+            self._fail_all(jobs, f"playwright_not_available: {e}")
+            return
+        error = None
+        try:
+            with sync_playwright() as pw:
+                browser = pw.chromium.launch(headless=self.headless)
+                context = browser.new_context(storage_state=self._storage_state)
+                page = context.new_page()
+                while True:
+                    item = jobs.get()
+                    if item is None:
+                        break
+                    phone, message, job, queued_at = item
+                    res = self._deliver(page, phone, message)
+                    latency_ms = (time.perf_counter() - queued_at) * 1000
+                    res["latency_ms"] = round(latency_ms, 1)
+                    with self._lock:
+                        self._latencies.append(latency_ms)
+                        if res.get("ok"):
+                            self.sent += 1
+                        else:
+                            self.failed += 1
+                    if res.get("ok"):
+                        self._snapshot_state(context)
+                    job.set_result(res)
+                self._snapshot_state(context)
+                context.close()
+                browser.close()
+        except Exception as e:
+            log.exception("wa web sender stopped")
+            error = str(e)
+        # stop() or a crash: jobs queued behind the worker are answered, later ones refused
+        self._fail_all(jobs, error)
+
+    def _snapshot_state(self, context):
+        try:
+            state = context.storage_state()
+        except Exception:
+            return
+        with self._lock:
+            if state != self._storage_state:
+                self._storage_state = state
+                self._state_dirty = True
+
+    def _fail_all(self, jobs: queue.Queue, error: Optional[str]):
+        """Answers every queued job; called by the exiting worker (error None = stopped)."""
+        with self._lock:
+            # send() queues under the same lock: nothing can be added after this point
+            self._closing = True
+            self._error = error
+        while True:
             try:
-                page.keyboard.press('Enter')
-            except Exception:
-                pass
-            time.sleep(2)
-            context.close()
-            browser.close()
-        return {"ok": True}
-    except Exception as e:
-        return {"ok": False, "error": str(e)}
+                item = jobs.get_nowait()
+            except queue.Empty:
+                return
+            if item is not None:
+                item[2].set_result({"ok": False, "error": error or "sender_stopped"})
+
+    def _deliver(self, page, phone: str, message: str) -> dict:
+        phone = phone.lstrip('+')
+        url = f"{self.base_url}/send?phone={phone}&text={quote(message)}"
+        timeout_ms = self.timeout * 1000
+        try:
+            page.goto(url, timeout=timeout_ms)
+            # chat ready, login QR or "invalid number" popup: whichever shows up first
+            page.wait_for_selector(f"{COMPOSE_SELECTOR}, {LOGIN_QR_SELECTOR}, {INVALID_PHONE_SELECTOR}", timeout=timeout_ms)
+            if page.query_selector(LOGIN_QR_SELECTOR):
+                return {"ok": False, "error": "not_logged_in"}
+            if page.query_selector(INVALID_PHONE_SELECTOR) and not page.query_selector(COMPOSE_SELECTOR):
+                return {"ok": False, "error": "invalid_phone"}
+
+            before = page.locator(OUTGOING_SELECTOR).count()
+            button = page.wait_for_selector(SEND_BUTTON_SELECTOR, timeout=timeout_ms)
+            button.click()
+            # sent = a new outgoing bubble that no longer shows the pending clock
+            page.wait_for_function(
+                """([sel, pending, before]) => {
+                    const out = document.querySelectorAll(sel);
+                    return out.length > before && !out[out.length - 1].querySelector(pending);
+                }""",
+                arg=[OUTGOING_SELECTOR, PENDING_ICON_SELECTOR, before],
+                timeout=timeout_ms,
+            )
+            return {"ok": True}
+        except Exception as e:
+            return {"ok": False, "error": str(e)}
+
+
+_senders = {}
+_senders_lock = threading.Lock()
+
+
+def get_sender(session_id: Optional[int] = None, storage_state: Optional[dict] = None, headless: bool = True) -> WebSender:
+    """Shared WebSender per WhatsAppSession id (None = no saved session); created on first use."""
+    with _senders_lock:
+        sender = _senders.get(session_id)
+        if sender is None:
+            sender = _senders[session_id] = WebSender(storage_state=storage_state, headless=headless)
+        return sender
+
+
+def sender_metrics() -> dict:
+    with _senders_lock:
+        senders = dict(_senders)
+    return {str(k): s.metrics() for k, s in senders.items()}
+
+
+def stop_all():
+    with _senders_lock:
+        senders = list(_senders.values())
+        _senders.clear()
+    for s in senders:
+        s.stop()
+
+
+def send_with_playwright(phone: str, message: str, sender: Optional[WebSender] = None) -> dict:
+    return (sender or get_sender()).send(phone, message)
 
 
 def send_with_pywhatkit(phone: str, message: str) -> dict:
@@ -65,13 +262,10 @@ def send_with_pywhatkit(phone: str, message: str) -> dict:
         return {"ok": False, "error": str(e)}
 
 
-def send_via_web_best_effort(phone: str, message: str) -> dict:
+def send_via_web_best_effort(phone: str, message: str, sender: Optional[WebSender] = None) -> dict:
     """Try Playwright first, then pywhatkit. Returns dict {ok: bool, error?: str}."""
-    # URL-encode message minimally
-    from urllib.parse import quote_plus
-    encoded = quote_plus(message)
-    # try playwright
-    r = send_with_playwright(phone, encoded, headless=True)
+    # try playwright (the sender URL-encodes the message itself)
+    r = send_with_playwright(phone, message, sender=sender)
     if r.get('ok'):
         return r
     # fallback to pywhatkit
@@ -0,0 +1,12 @@
+"""Benchmarks, run from the repo root as modules (python -m bench.scan --help).
+
+- bench.db: SQLite settings under concurrent scanners and readers
+- bench.scan: /api/scan check-in latency against a long attendance history
+- bench.event_loop: scan latency over HTTP while a heavy report runs
+- bench.admin: the admin page with 50k students
+- bench.reports: group WhatsApp reports, per student vs set-based
+- bench.wa_cloud: Cloud API throughput against a mock Graph API
+
+Shared setup (throw-away databases, seeding, statement counting) is in
+bench/common.py, which checks.py uses as well.
+"""
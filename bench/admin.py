@@ -0,0 +1,132 @@
+# صفحة الإدارة مع 50 ألف طالب: الجدول كله في رد واحد مقابل الصفحات من /api/students
+"""Admin page render time with many students: whole table vs keyset pages.
+
+Seeds a throw-away SQLite database (default 50,000 students with Arabic names
+over 20 groups) and times, through the app in-process (TestClient):
+
+- baseline: the original /admin, every student loaded by get_all_students()
+  and rendered into the original admin.html table (template kept below),
+- current: the /admin page shell plus the first /api/students page, i.e. what
+  the browser waits for before the table shows, and the slowest page while
+  walking the whole list by id and by name (keyset cursors).
+
+Each timing is the median of --repeat runs.
+
+    python -m bench.admin --students 50000
+"""
+import argparse
+import statistics
+import time
+
+from bench.common import use_as_app_database
+
+use_as_app_database("admin")
+
+from fastapi import Depends  # noqa: E402
+from fastapi.responses import HTMLResponse  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+from jinja2 import Template  # noqa: E402
+from sqlalchemy import insert  # noqa: E402
+from sqlalchemy.orm import Session  # noqa: E402
+
+from app import models  # noqa: E402
+from app.main import app, get_db, engine, SessionLocal  # noqa: E402
+
+# app/templates/admin.html before the paginated page
+BASELINE_ADMIN = Template("""<!DOCTYPE html>
+<html lang="ar">
+<head>
+  <meta charset="UTF-8">
+  <title>لوحة التحكم</title>
+</head>
+<body>
+  <h1>📊 لوحة التحكم</h1>
+  <table border="1" cellpadding="5">
+    <tr>
+      <th>ID</th>
+      <th>الاسم</th>
+      <th>UUID</th>
+    </tr>
+    {% for s in students %}
+    <tr>
+      <td>{{ s.id }}</td>
+      <td>{{ s.first_name }} {{ s.last_name or "" }}</td>
+      <td>{{ s.uuid }}</td>
+    </tr>
+    {% endfor %}
+  </table>
+</body>
+</html>""")
+
+FIRST_NAMES = ["محمد", "أحمد", "مريم", "يوسف", "فاطمة", "عمر", "نور", "سارة", "علي", "هدى"]
+
+
+@app.get("/bench/admin_all", response_class=HTMLResponse)
+def bench_admin_all(db: Session = Depends(get_db)):
+    students = db.query(models.Student).order_by(models.Student.id.asc()).all()
+    return BASELINE_ADMIN.render(students=students)
+
+
+def seed(students: int):
+    db = SessionLocal()
+    db.add(models.Class(name="bench"))
+    db.commit()
+    db.execute(insert(models.Group), [
+        {"name": f"g{g}", "class_id": 1, "subscription_price": 200} for g in range(20)
+    ])
+    db.execute(insert(models.Student), [
+        {"uuid": f"A{i:07d}", "first_name": f"{FIRST_NAMES[i % 10]} {i % 997}", "last_name": "الطالب",
+         "class_id": 1, "group_id": i % 20 + 1}
+        for i in range(students)
+    ])
+    db.commit()
+    db.close()
+
+
+def timed(fn, repeat: int):
+    runs = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        runs.append(time.perf_counter() - t0)
+    return round(statistics.median(runs) * 1000, 1), result
+
+
+def walk(client, order: str, limit: int) -> dict:
+    pages, slowest, after = 0, 0.0, None
+    while True:
+        params = {"order": order, "limit": limit, **({"after": after} if after else {})}
+        t0 = time.perf_counter()
+        body = client.get("/api/students", params=params).json()
+        slowest = max(slowest, time.perf_counter() - t0)
+        pages += 1
+        after = body["next"]
+        if not after:
+            return {"pages": pages, "slowest_page_ms": round(slowest * 1000, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--students", type=int, default=50000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--page-size", type=int, default=50)
+    args = parser.parse_args()
+
+    with TestClient(app) as client:  # runs the startup hooks (schema upgrade, outbox)
+        seed(args.students)
+        ms, r = timed(lambda: client.get("/bench/admin_all"), args.repeat)
+        print(f"baseline /admin (all {args.students} rows): {ms} ms, {len(r.content) / 1e6:.1f} MB", flush=True)
+
+        def first_screen():
+            page = client.get("/admin")
+            rows = client.get("/api/students", params={"limit": args.page_size})
+            return len(page.content) + len(rows.content)
+        ms, size = timed(first_screen, args.repeat)
+        print(f"current /admin + first page of {args.page_size}: {ms} ms, {size / 1e3:.1f} kB", flush=True)
+        for order in ("id", "name"):
+            print(f"walk all pages by {order}: {walk(client, order, args.page_size)}", flush=True)
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""Setup shared by the benchmarks and checks.py.
+
+Every run works on throw-away SQLite files in one temporary directory, removed
+at exit. Scripts that go through app.main (which binds app.database.engine at
+import) call use_as_app_database() before importing it; the others get their
+own engine from new_database().
+"""
+import atexit
+import os
+import tempfile
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, insert
+from sqlalchemy.orm import sessionmaker
+
+_tmp = tempfile.TemporaryDirectory(prefix="ecms-bench-")
+atexit.register(_tmp.cleanup)
+
+
+def temp_path(filename: str) -> str:
+    return os.path.join(_tmp.name, filename)
+
+
+def sqlite_url(name: str) -> str:
+    return "sqlite:///" + temp_path(f"{name}.db")
+
+
+def use_as_app_database(name: str) -> str:
+    """Points DATABASE_URL at a throw-away file; call before anything imports app.database."""
+    os.environ["DATABASE_URL"] = url = sqlite_url(name)
+    return url
+
+
+def new_database(name: str, factory=None, create: bool = True):
+    """(engine, Session) on a fresh file; factory(url) defaults to app.database.make_engine."""
+    from app import models
+    from app.database import make_engine
+
+    engine = (factory or make_engine)(sqlite_url(name))
+    if create:
+        models.Base.metadata.create_all(bind=engine)
+    return engine, sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+def reset_caches():
+    """Module-level caches in crud outlive the database of a previous run."""
+    from app import crud
+
+    crud.student_cards.clear()
+    crud.treasury_cache.invalidate()
+    crud.treasury_rollups.clear()
+    crud.search_index.reset()
+    crud.cache_versions.reset()
+
+
+def seed_history(engine, students: int, history_days: int):
+    """One class and group, `students` members with one attendance row per day and monthly payments."""
+    from app import models
+
+    models.Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine)()
+    db.add(models.Class(name="bench"))
+    db.add(models.Group(name="bench", class_id=1, subscription_price=200))
+    db.commit()
+    db.execute(insert(models.Student), [
+        {"uuid": f"B{i:06d}", "first_name": f"s{i}", "class_id": 1, "group_id": 1}
+        for i in range(students)
+    ])
+    start = datetime.now().replace(hour=16, minute=0, second=0, microsecond=0) - timedelta(days=history_days)
+    for day in range(history_days):
+        db.execute(insert(models.SessionAttendance), [
+            {"student_id": sid, "session_date": start + timedelta(days=day), "status": "present"}
+            for sid in range(1, students + 1)
+        ])
+    db.execute(insert(models.Payment), [
+        {"student_id": sid, "amount": 200, "payment_date": (start + timedelta(days=m * 30)).date()}
+        for sid in range(1, students + 1) for m in range(history_days // 30 + 1)
+    ])
+    db.commit()
+    db.close()
+
+
+def percentile_ms(sorted_seconds: list, pct: float, digits: int = 1):
+    if not sorted_seconds:
+        return None
+    return round(sorted_seconds[min(len(sorted_seconds) - 1, int(len(sorted_seconds) * pct))] * 1000, digits)
+
+
+class count_statements:
+    """Counts the SQL statements sent through `engine` inside the with-block (.count)."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def _count(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        event.listen(self.engine, "before_cursor_execute", self._count)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, "before_cursor_execute", self._count)
@@ -0,0 +1,117 @@
+# مقارنة إعدادات SQLite: N أجهزة مسح + قارئ للخزنة في نفس الوقت
+"""Concurrency benchmark for the SQLite settings in app/database.py.
+
+Runs the same workload twice on a fresh database file, once with the old engine
+(default rollback journal, check_same_thread=False only) and once with
+make_engine() (WAL + pragmas): N scanner threads check students in and record
+payments through crud while one thread keeps recomputing the treasury totals,
+the monthly report and the group's WhatsApp reports from SQL. Prints
+throughput, scan latency and the number of "database is locked" errors per
+mode.
+
+    python -m bench.db --scanners 16 --seconds 15
+"""
+import argparse
+import random
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+
+from app import crud
+from app.database import make_engine
+from bench.common import new_database, percentile_ms, reset_caches, seed_history
+
+
+def run(Session, scanners: int, seconds: float, students: int) -> dict:
+    reset_caches()
+    stop = threading.Event()
+    lock = threading.Lock()
+    stats = {"scans": 0, "payments": 0, "reads": 0, "locked": 0, "other_errors": 0, "latencies": []}
+
+    def count_error(e):
+        with lock:
+            if "locked" in str(e):
+                stats["locked"] += 1
+            else:
+                stats["other_errors"] += 1
+
+    def scanner(seed_):
+        rnd = random.Random(seed_)
+        while not stop.is_set():
+            db = Session()
+            try:
+                sid = rnd.randint(0, students - 1)
+                t0 = time.perf_counter()
+                # each tap is for a different day so every scan writes
+                crud.check_in_student(db, f"B{sid:06d}", scanned_at=datetime.now() + timedelta(days=rnd.randint(1, 3650)))
+                latency = time.perf_counter() - t0
+                with lock:
+                    stats["scans"] += 1
+                    stats["latencies"].append(latency)
+                if rnd.random() < 0.1:
+                    crud.add_payment(db, sid + 1, 200)
+                    with lock:
+                        stats["payments"] += 1
+            except OperationalError as e:
+                db.rollback()
+                count_error(e)
+            finally:
+                db.close()
+
+    def reader():
+        while not stop.is_set():
+            db = Session()
+            try:
+                crud._load_treasury_totals(db)
+                today = date.today()
+                crud.get_treasury_report(db, today.replace(day=1) - timedelta(days=90), today, "day")
+                crud.treasury_rollups.clear()
+                crud.generate_group_reports(db, group_id=1)  # attendance/payment MAX over the whole group
+                with lock:
+                    stats["reads"] += 1
+            except OperationalError as e:
+                db.rollback()
+                count_error(e)
+            finally:
+                db.close()
+
+    threads = [threading.Thread(target=scanner, args=(i,)) for i in range(scanners)]
+    threads.append(threading.Thread(target=reader))
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+
+    lat = sorted(stats.pop("latencies"))
+    stats["scans_per_s"] = round(stats["scans"] / seconds, 1)
+    stats["scan_p50_ms"] = percentile_ms(lat, 0.5)
+    stats["scan_p95_ms"] = percentile_ms(lat, 0.95)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scanners", type=int, default=16)
+    parser.add_argument("--seconds", type=float, default=15)
+    parser.add_argument("--students", type=int, default=2000)
+    parser.add_argument("--history-days", type=int, default=60)
+    args = parser.parse_args()
+
+    modes = {
+        "default (rollback journal)": lambda url: create_engine(url, connect_args={"check_same_thread": False}),
+        "app.database (WAL + pragmas)": make_engine,
+    }
+    for i, (name, factory) in enumerate(modes.items()):
+        engine, Session = new_database(f"db{i}", factory)
+        seed_history(engine, args.students, args.history_days)
+        print(f"{name}: {run(Session, args.scanners, args.seconds, args.students)}", flush=True)
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
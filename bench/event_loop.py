@@ -0,0 +1,126 @@
+# هل التقرير التقيل بيوقف الماسح؟ async handlers القديمة مقابل def في الـ threadpool
+"""Scan latency over HTTP while a heavy report runs, async vs threadpool handlers.
+
+Starts the real app (uvicorn, in this process) on a seeded throw-away SQLite
+database and keeps /api/scan busy from several desk threads while one client
+keeps requesting a heavy report (the group's WhatsApp reports: every member's
+attendance, results and payments). Modes:
+
+- idle: scans only,
+- async handlers (baseline): scan and report are `async def` handlers calling
+  the synchronous session, as every handler in app/main.py used to be, so the
+  report blocks the event loop,
+- def handlers (current): the same work in plain `def` handlers, which FastAPI
+  runs in its threadpool.
+
+The baseline handlers are extra routes registered here (/bench/async/...); the
+current ones are /api/scan and an equivalent /bench/sync/report.
+
+    python -m bench.event_loop --desks 4 --seconds 10
+"""
+import argparse
+import random
+import threading
+import time
+
+import requests
+import uvicorn
+
+from bench.common import percentile_ms, reset_caches, seed_history, use_as_app_database
+
+use_as_app_database("event_loop")
+
+from fastapi import Depends  # noqa: E402
+from sqlalchemy.orm import Session  # noqa: E402
+
+from app import crud  # noqa: E402
+from app.main import app, get_db, engine  # noqa: E402
+
+
+@app.post("/bench/async/scan")
+async def bench_async_scan(payload: dict, db: Session = Depends(get_db)):
+    return crud.check_in_student(db, payload.get("code"))
+
+
+@app.get("/bench/async/report")
+async def bench_async_report(db: Session = Depends(get_db)):
+    return {"reports": len(crud.generate_group_reports(db, group_id=1))}
+
+
+@app.get("/bench/sync/report")
+def bench_sync_report(db: Session = Depends(get_db)):
+    return {"reports": len(crud.generate_group_reports(db, group_id=1))}
+
+
+def run(base: str, scan_path: str, report_path: str, desks: int, seconds: float, students: int) -> dict:
+    reset_caches()
+    stop = threading.Event()
+    lock = threading.Lock()
+    latencies, reports = [], [0]
+
+    def desk(seed_):
+        rnd = random.Random(seed_)
+        http = requests.Session()
+        while not stop.is_set():
+            t0 = time.perf_counter()
+            r = http.post(base + scan_path, json={"code": f"B{rnd.randrange(students):06d}"})
+            r.raise_for_status()
+            with lock:
+                latencies.append(time.perf_counter() - t0)
+
+    def reporter():
+        http = requests.Session()
+        while not stop.is_set():
+            http.get(base + report_path).raise_for_status()
+            reports[0] += 1
+
+    threads = [threading.Thread(target=desk, args=(i,)) for i in range(desks)]
+    if report_path:
+        threads.append(threading.Thread(target=reporter))
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    latencies.sort()
+    return {
+        "scans_per_s": round(len(latencies) / seconds, 1),
+        "scan_p50_ms": percentile_ms(latencies, 0.5),
+        "scan_p99_ms": percentile_ms(latencies, 0.99),
+        "scan_max_ms": percentile_ms(latencies, 1.0),
+        "reports": reports[0],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--desks", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--students", type=int, default=2000)
+    parser.add_argument("--history-days", type=int, default=60)
+    parser.add_argument("--port", type=int, default=8790)
+    args = parser.parse_args()
+
+    seed_history(engine, args.students, args.history_days)
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=args.port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    base = f"http://127.0.0.1:{args.port}"
+    t0 = time.perf_counter()
+    requests.get(base + "/bench/sync/report").raise_for_status()
+    print(f"one report: {(time.perf_counter() - t0) * 1000:.0f} ms", flush=True)
+
+    modes = {
+        "idle (no report)": ("/api/scan", None),
+        "async handlers (baseline)": ("/bench/async/scan", "/bench/async/report"),
+        "def handlers (current)": ("/api/scan", "/bench/sync/report"),
+    }
+    for name, (scan_path, report_path) in modes.items():
+        print(f"{name}: {run(base, scan_path, report_path, args.desks, args.seconds, args.students)}", flush=True)
+    server.should_exit = True
+
+
+if __name__ == "__main__":
+    main()
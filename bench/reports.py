@@ -0,0 +1,101 @@
+# تقارير واتساب لمجموعة 500 طالب: تقرير لكل طالب مقابل الاستعلامات المجمعة
+"""Group report generation: per-student queries vs the set-based builder.
+
+Seeds a throw-away SQLite database with one large group (default 500 students,
+60 days of attendance, 10 graded tests and monthly payments each) and builds
+the WhatsApp report of every member two ways:
+
+- per student (baseline): the group's students, then generate_student_report()
+  for each one, as /api/wa/send_report used to do (4 queries per student),
+- set-based: generate_group_reports(), a fixed handful of queries.
+
+Checks that both produce the same texts and prints the median time and the
+number of statements of each.
+
+    python -m bench.reports --students 500
+"""
+import argparse
+import random
+import statistics
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert
+
+from app import crud, models
+from bench.common import count_statements, new_database
+
+
+def seed(Session, students: int, history_days: int, tests: int):
+    db = Session()
+    rnd = random.Random(1)
+    db.add(models.Class(name="bench"))
+    db.add(models.Group(name="bench", class_id=1, subscription_price=200))
+    db.commit()
+    db.execute(insert(models.Student), [
+        {"uuid": f"R{i:06d}", "first_name": f"طالب {i}", "last_name": "الاختبار",
+         "parent_phone": f"010{i:08d}", "class_id": 1, "group_id": 1}
+        for i in range(students)
+    ])
+    db.execute(insert(models.Test), [{"name": f"اختبار {t}", "max_score": 20, "class_id": 1} for t in range(tests)])
+    start = datetime.now() - timedelta(days=history_days)
+    for day in range(history_days):
+        db.execute(insert(models.SessionAttendance), [
+            {"student_id": sid, "session_date": start + timedelta(days=day, minutes=sid), "status": "present"}
+            for sid in range(1, students + 1)
+        ])
+    db.execute(insert(models.StudentTest), [
+        {"student_id": sid, "test_id": t + 1, "score": rnd.randint(5, 20),
+         "recorded_at": start + timedelta(days=t * history_days // tests)}
+        for sid in range(1, students + 1) for t in range(tests)
+    ])
+    db.execute(insert(models.Payment), [
+        {"student_id": sid, "amount": 200, "payment_date": (start + timedelta(days=m * 30)).date()}
+        for sid in range(1, students + 1) for m in range(history_days // 30 + 1)
+    ])
+    db.commit()
+    db.close()
+
+
+def per_student(db):
+    students = db.query(models.Student).filter(models.Student.group_id == 1).all()
+    return [(s.id, crud.generate_student_report(db, s.id)) for s in students]
+
+
+def set_based(db):
+    return [(s.id, text) for s, text in crud.generate_group_reports(db, group_id=1)]
+
+
+def measure(engine, Session, build, repeat: int):
+    runs = []
+    for _ in range(repeat):
+        db = Session()
+        with count_statements(engine) as statements:
+            t0 = time.perf_counter()
+            reports = build(db)
+            runs.append(time.perf_counter() - t0)
+        db.close()
+    return reports, {"median_ms": round(statistics.median(runs) * 1000, 1), "statements": statements.count}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--students", type=int, default=500)
+    parser.add_argument("--history-days", type=int, default=60)
+    parser.add_argument("--tests", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    engine, Session = new_database("reports")
+    seed(Session, args.students, args.history_days, args.tests)
+    baseline, baseline_stats = measure(engine, Session, per_student, args.repeat)
+    current, current_stats = measure(engine, Session, set_based, args.repeat)
+    assert baseline == current, "the set-based builder changed the report text"
+    print(f"{args.students} students, identical report texts", flush=True)
+    print(f"per student (baseline): {baseline_stats}", flush=True)
+    print(f"generate_group_reports: {current_stats}", flush=True)
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+# زمن تسجيل الحضور بالكارت: المسار القديم (4 استعلامات) مقابل check_in_student
+"""Scan latency benchmark for /api/scan's check-in path.
+
+Seeds a database with a long attendance history (default 2,000 students x 60
+days = 120k attendance rows, plus monthly payments) and times one desk tapping
+cards back to back, each tap in its own session like a request:
+
+- baseline: the original handler (student by uuid, today's attendance through
+  func.date(), mark_attendance with commit + refresh, last attendance, last
+  payment), without the (student_id, date) indexes,
+- baseline + indexes: the same queries with ix_attendance_student_date and
+  ix_payments_student_date,
+- check_in_student: the single-transaction path with range predicates and the
+  student card cache (cleared before the run).
+
+Every mode uses make_engine() and a fresh database; a tap is a first check-in
+of the day or a repeat, as at the door. Prints p50/p99 latency and statements.
+
+    python -m bench.scan --students 2000 --history-days 60 --scans 3000
+"""
+import argparse
+import random
+import time
+from datetime import date, datetime
+
+from sqlalchemy import func, text
+
+from app import crud, models
+from bench.common import count_statements, new_database, percentile_ms, reset_caches, seed_history
+
+
+def baseline_scan(db, code: str):
+    # the /api/scan handler before the fast path, query for query
+    Att = models.SessionAttendance
+    student = db.query(models.Student).filter(models.Student.uuid == code).first()
+    if not student:
+        return None
+    new_att = None
+    if not db.query(Att).filter(Att.student_id == student.id, func.date(Att.session_date) == date.today()).first():
+        new_att = Att(student_id=student.id, session_date=datetime.now(), status="present", recorded_by="RFID_scan")
+        db.add(new_att)
+        db.commit()
+        db.refresh(new_att)
+    last_att = db.query(Att).filter(Att.student_id == student.id).order_by(Att.session_date.desc()).first()
+    last_pay = db.query(models.Payment).filter(models.Payment.student_id == student.id)\
+        .order_by(models.Payment.payment_date.desc()).first()
+    return {"student": student.id, "last_attendance": str(last_att.session_date) if last_att else None,
+            "last_paid": str(last_pay.payment_date) if last_pay else None,
+            "auto_marked_attendance": str(new_att.session_date) if new_att else None}
+
+
+def fast_scan(db, code: str):
+    return crud.check_in_student(db, code)
+
+
+def run(engine, Session, scan, scans: int, students: int) -> dict:
+    reset_caches()
+    rnd = random.Random(1)
+    latencies = []
+    with count_statements(engine) as statements:
+        for _ in range(scans):
+            db = Session()
+            try:
+                t0 = time.perf_counter()
+                assert scan(db, f"B{rnd.randrange(students):06d}") is not None
+                latencies.append(time.perf_counter() - t0)
+            finally:
+                db.close()
+    latencies.sort()
+    return {
+        "scan_p50_ms": percentile_ms(latencies, 0.5, 2),
+        "scan_p99_ms": percentile_ms(latencies, 0.99, 2),
+        "scans_per_s": round(len(latencies) / sum(latencies), 1),
+        "statements_per_scan": round(statements.count / scans, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--students", type=int, default=2000)
+    parser.add_argument("--history-days", type=int, default=60)
+    parser.add_argument("--scans", type=int, default=3000)
+    args = parser.parse_args()
+
+    modes = {
+        "baseline (4 queries, no composite indexes)": (baseline_scan, False),
+        "baseline + composite indexes": (baseline_scan, True),
+        "check_in_student": (fast_scan, True),
+    }
+    print(f"{args.students * args.history_days} attendance rows, {args.scans} scans", flush=True)
+    for i, (name, (scan, indexes)) in enumerate(modes.items()):
+        engine, Session = new_database(f"scan{i}")
+        seed_history(engine, args.students, args.history_days)
+        if not indexes:
+            with engine.begin() as conn:
+                conn.execute(text("DROP INDEX ix_attendance_student_date"))
+                conn.execute(text("DROP INDEX ix_payments_student_date"))
+        print(f"{name}: {run(engine, Session, scan, args.scans, args.students)}", flush=True)
+        engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+# إرسال 1000 رسالة لسيرفر Graph API وهمي: طلب لكل رسالة مقابل الـ outbox مع wa_cloud
+"""WhatsApp Cloud throughput against a local mock Graph API.
+
+Starts a mock /<phone_number_id>/messages endpoint in this process (default:
+30 ms per request, 2% of requests answered 429 with Retry-After: 1) and sends
+the same batch of messages (default 1,000) from one account two ways:
+
+- baseline: the original send_via_whatsapp_cloud loop, one requests.post on a
+  new connection per message and a MessageLog commit each, serially,
+- outbox: one queued job drained by the outbox workers through wa_cloud's
+  pooled, rate-limited sender with retries.
+
+Prints wall time, messages/second, sent/failed, retries and the number of TCP
+connections the mock server accepted.
+
+    python -m bench.wa_cloud --messages 1000 --latency-ms 30 --rate-limited 0.02
+"""
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+MOCK_PORT = 8791
+os.environ["WA_GRAPH_API_URL"] = f"http://127.0.0.1:{MOCK_PORT}"
+
+from sqlalchemy import func  # noqa: E402
+
+from app import crud, models  # noqa: E402
+from app.outbox import Outbox  # noqa: E402
+from bench.common import new_database  # noqa: E402
+
+
+class MockGraph(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like graph.facebook.com
+    latency = 0.03
+    rate_limited = 0.02
+    lock = threading.Lock()
+    counters = {"connections": 0, "requests": 0, "429": 0}
+
+    def setup(self):
+        super().setup()
+        with self.lock:
+            self.counters["connections"] += 1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.latency)
+        throttled = random.random() < self.rate_limited
+        with self.lock:
+            self.counters["requests"] += 1
+            self.counters["429"] += throttled
+        body = json.dumps({"error": {"code": 130429}} if throttled else {"messages": [{"id": "wamid.bench"}]}).encode()
+        self.send_response(429 if throttled else 200)
+        if throttled:
+            self.send_header("Retry-After", "1")
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def reset_counters():
+    with MockGraph.lock:
+        for k in MockGraph.counters:
+            MockGraph.counters[k] = 0
+
+
+def baseline_send(db, acc, to_phone: str, message: str):
+    # crud.send_via_whatsapp_cloud before wa_cloud: account row, new connection, one commit per message
+    acc = db.query(models.WhatsAppAccount).filter(models.WhatsAppAccount.id == acc).first()
+    try:
+        r = requests.post(f"{os.environ['WA_GRAPH_API_URL']}/{acc.phone_number_id}/messages",
+                          json={'messaging_product': 'whatsapp', 'to': to_phone, 'type': 'text', 'text': {'body': message}},
+                          headers={'Authorization': f'Bearer {acc.access_token}', 'Content-Type': 'application/json'},
+                          timeout=15)
+        ok, error = r.status_code in (200, 201), r.text
+    except Exception as e:
+        ok, error = False, str(e)
+    return crud.log_message(db, to_phone, message, status='sent' if ok else 'failed', error=None if ok else error)
+
+
+def batch(n: int) -> list:
+    return [{"to_phone": f"2010{i:08d}", "content": f"تقرير الطالب رقم {i}", "student_id": None} for i in range(n)]
+
+
+def summary(Session, seconds: float, n: int, job_id=None) -> dict:
+    db = Session()
+    ml = models.MessageLog
+    q = db.query(ml.status, func.count(ml.id), func.coalesce(func.sum(ml.attempts), 0))
+    if job_id is not None:
+        q = q.filter(ml.job_id == job_id)
+    rows = {status: (count, attempts) for status, count, attempts in q.group_by(ml.status)}
+    db.close()
+    sent, failed = rows.get("sent", (0, 0)), rows.get("failed", (0, 0))
+    return {
+        "seconds": round(seconds, 1),
+        "msgs_per_s": round(n / seconds, 1),
+        "sent": sent[0],
+        "failed": failed[0],
+        "retries": max(0, sent[1] + failed[1] - sent[0] - failed[0]) if job_id is not None else 0,
+        **MockGraph.counters,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--latency-ms", type=float, default=30)
+    parser.add_argument("--rate-limited", type=float, default=0.02, help="share of requests answered 429")
+    parser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args()
+    MockGraph.latency = args.latency_ms / 1000
+    MockGraph.rate_limited = args.rate_limited
+    random.seed(1)
+
+    server = ThreadingHTTPServer(("127.0.0.1", MOCK_PORT), MockGraph)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    for mode in ("baseline", "outbox"):
+        engine, Session = new_database(f"wa_{mode}")
+        db = Session()
+        acc = crud.create_wa_account(db, name="bench", phone_number_id="1000", access_token="t", use_cloud_api=1)
+        reset_counters()
+        t0 = time.perf_counter()
+        if mode == "baseline":
+            for m in batch(args.messages):
+                baseline_send(db, acc.id, m["to_phone"], m["content"])
+            job_id = None
+        else:
+            job_id = crud.create_message_job(db, [dict(m, channel="cloud", account_id=acc.id) for m in batch(args.messages)])
+            outbox = Outbox(workers=args.workers, poll_interval=0.5)
+            outbox.start(Session)
+            outbox.notify()
+            while not crud.get_message_job_status(db, job_id)["done"]:
+                db.rollback()  # end the read snapshot, see the workers' commits
+                time.sleep(0.05)
+            outbox.stop()
+        seconds = time.perf_counter() - t0
+        db.close()
+        print(f"{mode}: {summary(Session, seconds, args.messages, job_id)}", flush=True)
+        engine.dispose()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,543 @@
+# فحوصات سريعة لسلوك سهل يتكسر من غير ما حد ياخد باله
+"""Regression checks, runnable without a test framework.
+
+Each check gets its own throw-away SQLite database (bench.common.new_database)
+and goes through crud the way the API handlers do. Run all of them, or name
+some; the exit status is non-zero if one fails. A check that needs something
+this machine lacks (a browser for Playwright) reports "skip" with the reason.
+
+    python checks.py
+    python checks.py dedupe_manual_resend
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from sqlalchemy import event, insert, inspect, text
+from sqlalchemy.orm import sessionmaker
+
+from app import crud, models
+from bench.common import count_statements, new_database, reset_caches, temp_path
+
+CHECKS = {}
+ROOT = os.path.dirname(os.path.abspath(__file__))
+FIXTURES = os.path.join(ROOT, "bench", "fixtures")
+
+
+class SkipCheck(Exception):
+    pass
+
+
+def check(fn):
+    CHECKS[fn.__name__] = fn
+    return fn
+
+
+def add_group(db, students: int, group_name: str = "g", first_name: str = None) -> int:
+    """A class + group with `students` members, each with their own parent phone; returns the group id."""
+    cls = db.query(models.Class).filter(models.Class.name == "checks").first()
+    if not cls:
+        cls = models.Class(name="checks")
+        db.add(cls)
+        db.commit()
+    group = models.Group(name=group_name, class_id=cls.id, subscription_price=100)
+    db.add(group)
+    db.commit()
+    first = db.query(models.Student).count()
+    # a bulk insert (like bench.common.seed_history) instead of create_student, which also renders card images
+    db.execute(insert(models.Student), [
+        {"uuid": f"CHK{i:05d}", "first_name": first_name or f"s{i}", "last_name": "x",
+         "parent_phone": f"010{i:08d}", "class_id": cls.id, "group_id": group.id}
+        for i in range(first, first + students)
+    ])
+    db.commit()
+    crud.search_index.reset()  # reloaded from the table on the next search
+    return group.id
+
+
+def wait_for(predicate, what: str, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError(f"timed out waiting for {what}")
+        time.sleep(0.02)
+
+
+@contextlib.contextmanager
+def serve(handler_class):
+    """A local HTTP server for the with-block; yields its base URL."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler_class)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield f"http://127.0.0.1:{server.server_port}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+# ---------------------- checks ----------------------
+@check
+def dedupe_manual_resend(db):
+    """Manual-mode rows (pending, no channel) were never sent: an automatic resend must go out."""
+    group_id = add_group(db, 5)
+    batch, skipped = crud.drop_recent_duplicates(db, crud.generate_group_messages(db, group_id=group_id), 24)
+    assert (len(batch), skipped) == (5, 0), (len(batch), skipped)
+    crud.create_message_job(db, [dict(m, channel=None, account_id=None) for m in batch], target_id=group_id)
+
+    # a cloud account was added, the report is sent again with send_mode=auto
+    batch, skipped = crud.drop_recent_duplicates(db, crud.generate_group_messages(db, group_id=group_id), 24)
+    assert (len(batch), skipped) == (5, 0), f"manual rows counted as sent: kept {len(batch)}, skipped {skipped}"
+    crud.create_message_job(db, [dict(m, channel="cloud", account_id=None) for m in batch], target_id=group_id)
+
+    # queued for the cloud workers: a third send is a duplicate, and so is a sent row
+    batch, skipped = crud.drop_recent_duplicates(db, crud.generate_group_messages(db, group_id=group_id), 24)
+    assert (len(batch), skipped) == (0, 5), (len(batch), skipped)
+    ml = models.MessageLog
+    db.query(ml).filter(ml.channel.is_(None)).update({ml.status: "sent"})
+    db.query(ml).filter(ml.channel.isnot(None)).update({ml.status: "failed"})
+    db.commit()
+    batch, skipped = crud.drop_recent_duplicates(db, crud.generate_group_messages(db, group_id=group_id), 24)
+    assert (len(batch), skipped) == (0, 5), (len(batch), skipped)
+
+
+@check
+def send_report_manual_not_sent(db):
+    """A group send with no automatic channel only logs the rows and says so (nothing sent or queued)."""
+    from app.main import api_send_report
+
+    group_id = add_group(db, 3)
+    res = api_send_report(student_id=None, group_id=group_id, send_mode=None, merge_siblings=False,
+                          dedupe_hours=None, db=db)
+    assert (res["sent"], res["queued"], res["logged"]) == (0, 0, 3), res
+    ml = models.MessageLog
+    assert db.query(ml).filter(ml.channel.is_(None), ml.status == "pending").count() == 3
+
+
+@check
+def card_cache_write_during_load(db):
+    """A payment committed while a scan loads the card must not leave that scan's card in the cache."""
+    add_group(db, 1)
+    engine = db.get_bind()
+    writer = sessionmaker(bind=engine)()
+
+    def pay_during_select(conn, cursor, statement, parameters, context, executemany):
+        if "max(payments.payment_date)" in statement and not writer.info.get("paid"):
+            writer.info["paid"] = True
+            crud.add_payment(writer, 1, 100)
+
+    event.listen(engine, "before_cursor_execute", pay_during_select)
+    try:
+        crud.get_student_card(db, "CHK00000")
+    finally:
+        event.remove(engine, "before_cursor_execute", pay_during_select)
+        writer.close()
+    assert writer.info.get("paid")
+    assert crud.student_cards.get("CHK00000") is None, "card loaded before the payment was cached"
+    assert crud.get_student_card(db, "CHK00000")["last_paid_date"] == date.today()
+    assert crud.student_cards.get("CHK00000") is not None
+
+
+# a second server process on the same database: pays for student 2 and renames student 1
+OTHER_PROCESS_WRITES = """
+import sys
+from sqlalchemy.orm import sessionmaker
+from app import crud, models
+from app.database import make_engine
+
+db = sessionmaker(bind=make_engine(sys.argv[1]))()
+crud.add_payment(db, 2, 70)
+db.get(models.Student, 1).first_name = "renamed"
+db.commit()
+"""
+
+
+@check
+def cache_writes_from_another_process(db):
+    """Another process's commits reach this one's caches; raw SQL shows up after CACHE_TTL."""
+    from app import migrations
+
+    engine = db.get_bind()
+    migrations.upgrade(engine)  # the cache_versions rows
+    add_group(db, 2)
+    assert crud.get_student_card(db, "CHK00000")["first_name"] == "s0"
+    assert crud.search_students(db, "renamed") == []
+    crud.get_treasury_summary(db)
+    crud.add_payment(db, 1, 50)
+    # this process's own write keeps the delta-updated totals
+    misses = crud.treasury_cache.stats()["misses"]
+    assert crud.get_treasury_summary(db)["total_income"] == 50
+    assert crud.treasury_cache.stats()["misses"] == misses, "own payment dropped the treasury cache"
+
+    db.commit()  # end the read transaction, as a request does
+    subprocess.run([sys.executable, "-c", OTHER_PROCESS_WRITES, engine.url.render_as_string(hide_password=False)],
+                   cwd=ROOT, check=True)
+    assert crud.get_treasury_summary(db)["total_income"] == 120
+    assert crud.get_student_card(db, "CHK00000")["first_name"] == "renamed"
+    assert [row[0].id for row in crud.search_students(db, "renamed")] == [1]
+    assert crud.cache_versions.stats()["remote_changes"] == 2
+
+    ttl = crud.cache_versions.ttl
+    crud.cache_versions.ttl = 0.3
+    crud.cache_versions.reset()
+    try:
+        crud.get_student_card(db, "CHK00000")
+        db.commit()
+        with engine.begin() as conn:
+            conn.execute(text("UPDATE students SET first_name = 'raw' WHERE id = 1"))
+        assert crud.get_student_card(db, "CHK00000")["first_name"] == "renamed"  # no counter moved
+        time.sleep(0.4)
+        assert crud.get_student_card(db, "CHK00000")["first_name"] == "raw"
+    finally:
+        crud.cache_versions.ttl = ttl
+        crud.cache_versions.reset()
+
+
+@check
+def search_statement_count(db):
+    """/api/students/search runs the same number of statements for 5 or 200 results (no per-row lookups)."""
+    from app.main import api_search_students
+
+    counts = {}
+    for size, name in ((5, "alpha"), (50, "beta"), (200, "gamma")):
+        add_group(db, size, group_name=name, first_name=name)
+    api_search_students(q="alpha", limit=200, db=db)  # loads the search index
+    for size, name in ((5, "alpha"), (50, "beta"), (200, "gamma")):
+        with count_statements(db.get_bind()) as counter:
+            res = api_search_students(q=name, limit=200, db=db)
+        assert len(res) == size and all(r["class_name"] and r["group_name"] == name for r in res), (name, len(res))
+        counts[size] = counter.count
+    assert len(set(counts.values())) == 1, f"statements per search by result size: {counts}"
+
+
+@check
+def treasury_report_span(db):
+    """Over-long report ranges are refused before any work; the closed-month cache stays bounded."""
+    from app.main import api_treasury_report
+
+    res = api_treasury_report(date_from=date(1900, 1, 1), date_to=date(2100, 12, 31), bucket="day", db=db)
+    assert res.status_code == 400 and b"range_too_long" in res.body, res.body
+    assert crud.treasury_rollups.stats()["months"] == 0
+
+    to = date.today()
+    res = api_treasury_report(date_from=to - timedelta(days=365), date_to=to, bucket="day", db=db)
+    assert len(res["rows"]) == 366, len(res["rows"])
+    for start in range(2000, 2020, 5):
+        api_treasury_report(date_from=date(start, 1, 1), date_to=date(start + 4, 12, 31), bucket="month", db=db)
+    stats = crud.treasury_rollups.stats()
+    assert stats["months"] <= stats["maxsize"], stats
+
+
+@check
+def scan_replay_clock_skew(db):
+    """Buffered taps from a desk whose clock is a month behind are recorded today; stale ones are refused."""
+    add_group(db, 2)
+    desk_now = datetime.now() - timedelta(days=30)
+    tap = (desk_now - timedelta(minutes=10)).isoformat()
+    results = crud.check_in_batch(db, [{"id": "a", "code": "CHK00000", "scanned_at": tap}],
+                                  sent_at=crud.parse_client_time(desk_now.isoformat()))
+    assert results == [{"id": "a", "status": "marked"}], results
+    att = db.query(models.SessionAttendance).filter(models.SessionAttendance.student_id == 1).one()
+    assert att.session_date.date() == date.today(), att.session_date
+
+    # without sent_at the tap time can't be corrected: past SCAN_MAX_AGE it is not recorded
+    results = crud.check_in_batch(db, [{"id": "b", "code": "CHK00001", "scanned_at": tap}])
+    assert results == [{"id": "b", "status": "too_old"}], results
+    assert db.query(models.SessionAttendance).filter(models.SessionAttendance.student_id == 2).count() == 0
+
+
+@check
+def scan_replay_during_live_post(db):
+    """A replay of a tap that commits between the live scan's read and its insert leaves one row."""
+    add_group(db, 1)
+    engine = db.get_bind()
+    replay = sessionmaker(bind=engine)()
+    tap = datetime.now()
+
+    def replay_before_insert(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith("INSERT INTO attendance") and not replay.info.get("done"):
+            replay.info["done"] = True
+            replay.info["results"] = crud.check_in_batch(replay, [{"id": "t", "code": "CHK00000",
+                                                                   "scanned_at": tap.isoformat()}])
+
+    event.listen(engine, "before_cursor_execute", replay_before_insert)
+    try:
+        live = crud.check_in_student(db, "CHK00000", scanned_at=tap)
+    finally:
+        event.remove(engine, "before_cursor_execute", replay_before_insert)
+        replay.close()
+    assert replay.info.get("results") == [{"id": "t", "status": "marked"}], replay.info.get("results")
+    rows = db.query(models.SessionAttendance).filter(models.SessionAttendance.student_id == 1).count()
+    assert rows == 1, f"{rows} attendance rows for one tap"
+    assert live["auto_marked_attendance"] is None, live
+
+
+@check
+def import_bad_byte_commits_nothing(db):
+    """A CSV with a non-UTF-8 byte after the first batches is rejected before any row is inserted."""
+    from app.importer import ImportFormatError, iter_rows
+
+    lines = ["uuid,first_name,last_name,parent_phone"]
+    lines += [f"IMP{i:05d},طالب {i},الاختبار,010{i:08d}" for i in range(3000)]  # > 64 KiB: several chunks
+    data = "\n".join(lines).encode("utf-8")
+    bad = data.replace(b"IMP02500", b"IMP\xff2500")
+    try:
+        crud.import_students(db, iter_rows("students.csv", io.BytesIO(bad)))
+    except ImportFormatError as e:
+        assert "line 2502" in str(e), e
+    else:
+        raise AssertionError("bad byte accepted")
+    db.rollback()
+    assert db.query(models.Student).count() == 0, "rows committed before the decoding error"
+
+    # the same file without the bad byte goes through (dry run: no card images rendered)
+    report = crud.import_students(db, iter_rows("students.csv", io.BytesIO(data)), dry_run=True)
+    assert report["inserted"] == 3000 and not report["errors"], report["errors"][:3]
+
+
+@check
+def rfid_reader_pty(db):
+    """Framed taps on a pseudo-terminal: debounced, journaled before upload, kept while the server is down."""
+    import logging
+    import termios
+
+    from app import rfid_reader
+
+    os.environ["RFID_PORTS"] = "/dev/ttyS8,/dev/ttyS9"
+    try:
+        assert rfid_reader.parse_args(["--port", "/dev/ttyUSB0"]).port == ["/dev/ttyUSB0"]
+        assert rfid_reader.parse_args([]).port == ["/dev/ttyS8", "/dev/ttyS9"]
+    finally:
+        del os.environ["RFID_PORTS"]
+
+    journal_path = temp_path("rfid_journal.jsonl")
+    server_up = threading.Event()
+    received = []  # (scan, was it in the journal file when it arrived)
+
+    class ScanBatch(BaseHTTPRequestHandler):
+        def do_POST(self):
+            scans = json.loads(self.rfile.read(int(self.headers["Content-Length"])))["scans"]
+            if not server_up.is_set():
+                self.send_response(503)
+                self.end_headers()
+                return
+            with open(journal_path, encoding="utf-8") as f:
+                journaled = {json.loads(line)["id"] for line in f}
+            received.extend((scan, scan["id"] in journaled) for scan in scans)
+            body = json.dumps({"results": [{"id": scan["id"], "status": "marked"} for scan in scans]}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    master, slave = os.openpty()
+    rfid_reader.log.setLevel(logging.ERROR)  # the failed uploads below are expected
+    try:
+        with serve(ScanBatch) as url:
+            service = rfid_reader.ReaderService([os.ttyname(slave)], 9600, url, journal_path,
+                                                debounce=5, upload_interval=0.1)
+            try:
+                service.start()
+                # pyserial switches the tty to raw mode when it opens it
+                wait_for(lambda: not termios.tcgetattr(slave)[3] & termios.ICANON, "the reader to open the pty")
+                for frame in (b"\x02CARD1\x03", b"\x02CARD1\x03", b"CARD2\r\n", b"\x02CA", b"RD3\x03"):
+                    os.write(master, frame)
+                    time.sleep(0.05)
+                wait_for(lambda: len(service.journal.pending()) == 3, "three journaled taps")
+                time.sleep(0.5)  # a few failed uploads
+                assert sorted(s["code"] for s in service.journal.pending()) == ["CARD1", "CARD2", "CARD3"]
+                with open(journal_path, encoding="utf-8") as f:
+                    assert len(f.readlines()) == 3
+
+                server_up.set()
+                service.uploader.wake.set()
+                wait_for(lambda: not service.journal.pending(), "the journal to drain")
+            finally:
+                service.close()
+        assert sorted(scan["code"] for scan, _ in received) == ["CARD1", "CARD2", "CARD3"], received
+        assert all(journaled for _, journaled in received), "a scan was uploaded before it was journaled"
+        assert os.path.getsize(journal_path) == 0
+    finally:
+        os.close(master)
+        os.close(slave)
+        rfid_reader.log.setLevel(logging.NOTSET)
+
+
+@check
+def wa_web_sender_fixture(db):
+    """One WebSender against bench/fixtures/wa_web.html: sent, invalid number, logged out, stuck pending."""
+    from app import wa_web
+
+    with open(os.path.join(FIXTURES, "wa_web.html"), "rb") as f:
+        page = f.read()
+    delivered = []
+
+    class FakeWhatsApp(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(page)))
+            self.end_headers()
+            self.wfile.write(page)
+
+        def do_POST(self):
+            delivered.append(json.loads(self.rfile.read(int(self.headers["Content-Length"]))))
+            self.send_response(204)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    message = "تقرير الطالب: حضور 100% & غياب 0\nالسطر الثاني #1"
+    wa_web.log.disabled = True  # a browser that can't launch is a skip, not a traceback
+    with serve(FakeWhatsApp) as url:
+        sender = wa_web.WebSender(timeout=3, base_url=url)
+        try:
+            res = sender.send("+201000000001", message)
+            error = sender.metrics()["error"] or ""
+            if "playwright_not_available" in error or "BrowserType.launch" in error:
+                raise SkipCheck(error.splitlines()[0])
+            assert res["ok"], res
+            assert delivered == [{"phone": "201000000001", "text": message}], delivered
+            assert sender.send("0000", "x")["error"] == "invalid_phone"
+            assert sender.send("9000", "x")["error"] == "not_logged_in"
+            assert not sender.send("5000", "x")["ok"]  # clock never cleared: times out
+            metrics = sender.metrics()
+            assert (metrics["sent"], metrics["failed"]) == (1, 3), metrics
+        finally:
+            sender.stop()
+            wa_web.log.disabled = False
+
+
+@check
+def wa_web_dead_worker_answers(db):
+    """Sends racing a worker that dies (no browser, bad session file) are answered at once, never left to time out."""
+    from app import wa_web
+
+    class SlowExit(wa_web.WebSender):
+        def _fail_all(self, *args):
+            super()._fail_all(*args)
+            time.sleep(0.3)  # queue drained, thread not gone yet: where late sends used to get stuck
+
+    sender = SlowExit(storage_state=temp_path("missing-state.json"), timeout=2)
+
+    def send_repeatedly(i):
+        results = []
+        deadline = time.monotonic() + 3
+        while time.monotonic() < deadline:
+            results.append(sender.send(f"2010{i:08d}", "x"))
+        return results
+
+    wa_web.log.disabled = True  # one "sender stopped" traceback per dead worker
+    try:
+        with ThreadPoolExecutor(16) as pool:
+            results = [r for batch in pool.map(send_repeatedly, range(16)) for r in batch]
+        sender.stop()
+    finally:
+        wa_web.log.disabled = False
+    assert results and not any(r["ok"] for r in results)
+    stuck = [r for r in results if r["error"].startswith("timeout")]
+    assert not stuck, f"{len(stuck)} of {len(results)} sends waited for the timeout"
+
+
+# message_logs / wa_accounts as the first release created them (before the outbox)
+LEGACY_TABLES = {
+    "message_logs": ["""CREATE TABLE message_logs (
+        id INTEGER NOT NULL, to_phone VARCHAR(50), student_id INTEGER, content TEXT,
+        status VARCHAR(50), error TEXT, sent_at DATETIME,
+        PRIMARY KEY (id), FOREIGN KEY(student_id) REFERENCES students (id))""",
+        "CREATE INDEX ix_message_logs_id ON message_logs (id)"],
+    "wa_accounts": ["""CREATE TABLE wa_accounts (
+        id INTEGER NOT NULL, name VARCHAR(120), phone_number VARCHAR(50), connected INTEGER,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP, phone_number_id VARCHAR(120),
+        access_token VARCHAR(500), use_cloud_api INTEGER, PRIMARY KEY (id))""",
+        "CREATE INDEX ix_wa_accounts_id ON wa_accounts (id)"],
+}
+
+
+@check
+def migrate_legacy_database(db):
+    """A center.db from before the outbox (old tables, no new indexes) upgrades in place and keeps its rows."""
+    from app import migrations
+
+    engine = db.get_bind()
+    with engine.begin() as conn:
+        for table in models.Base.metadata.sorted_tables:
+            for index in table.indexes:
+                if index.name != f"ix_{table.name}_id":
+                    conn.execute(text(f"DROP INDEX {index.name}"))
+        for name, ddl in LEGACY_TABLES.items():
+            conn.execute(text(f"DROP TABLE {name}"))
+            for statement in ddl:
+                conn.execute(text(statement))
+        conn.execute(text("DROP TABLE message_jobs"))
+        conn.execute(text("INSERT INTO message_logs (to_phone, content, status, sent_at) "
+                          "VALUES ('01000000000', 'old', 'sent', '2024-01-01 10:00:00')"))
+        conn.execute(text("INSERT INTO wa_accounts (name, use_cloud_api) VALUES ('old', 0)"))
+
+    applied = migrations.upgrade(engine)
+    assert applied == [v for v, _, _ in migrations.MIGRATIONS], applied
+    live = inspect(engine)
+    for table in models.Base.metadata.sorted_tables:
+        missing = {c.name for c in table.columns} - {c["name"] for c in live.get_columns(table.name)}
+        assert not missing, f"{table.name}: columns without a migration: {missing}"
+        missing = {i.name for i in table.indexes} - {i["name"] for i in live.get_indexes(table.name)}
+        assert not missing, f"{table.name}: indexes without a migration: {missing}"
+
+    old = db.query(models.MessageLog).one()
+    assert (old.attempts, old.created_at) == (0, datetime(2024, 1, 1, 10)), (old.attempts, old.created_at)
+    assert db.query(models.WhatsAppAccount).one().daily_limit is None
+    group_id = add_group(db, 2)
+    batch, _ = crud.drop_recent_duplicates(db, crud.generate_group_messages(db, group_id=group_id), 24)
+    crud.create_message_job(db, [dict(m, channel="cloud", account_id=None) for m in batch], target_id=group_id)
+    assert crud.get_message_job_status(db, 1)["total"] == 2
+    assert migrations.upgrade(engine) == []
+
+
+# ---------------------- runner ----------------------
+def run_check(name: str) -> bool:
+    engine, Session = new_database(name)
+    reset_caches()
+    db = Session()
+    try:
+        CHECKS[name](db)
+        print(f"ok    {name}")
+        return True
+    except SkipCheck as e:
+        print(f"skip  {name}: {e}")
+        return True
+    except Exception:
+        print(f"FAIL  {name}\n{traceback.format_exc()}")
+        return False
+    finally:
+        db.close()
+        engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("names", nargs="*", help="checks to run (default: all): " + ", ".join(CHECKS))
+    args = parser.parse_args()
+    unknown = [n for n in args.names if n not in CHECKS]
+    if unknown:
+        parser.error("unknown check: " + ", ".join(unknown))
+    results = [run_check(name) for name in (args.names or CHECKS)]
+    sys.exit(0 if all(results) else 1)
+
+
+if __name__ == "__main__":
+    main()
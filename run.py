@@ -1,8 +1,20 @@
+import multiprocessing
 import uvicorn
-# Import the main app object directly
-import app.main
+
+
+class Server(uvicorn.Server):
+    def handle_exit(self, sig, frame):
+        # open dashboards keep /api/events streaming; end them so shutdown doesn't wait on them
+        app.main.events.hub.close()
+        super().handle_exit(sig, frame)
+
 
 if __name__ == "__main__":
+    # needed by the card image process pool (app/images.py) in the PyInstaller build
+    multiprocessing.freeze_support()
+    # Import the main app object directly, and only here: the pool's spawned workers
+    # re-run this file as __mp_main__ and must not load the app (engine, outbox, schema upgrade)
+    import app.main
     # Now, instead of passing a string, we pass the actual app object.
     # This makes the dependency clear to PyInstaller.
-    uvicorn.run(app.main.app, host="127.0.0.1", port=8000, reload=False)
\ No newline at end of file
+    Server(uvicorn.Config(app.main.app, host="127.0.0.1", port=8000, reload=False)).run()
@@ -1,13 +1,9 @@
 # إضافة بعض الصفوف والمجموعات الافتراضية عند أول تشغيل
-from app.models import Base, Class, Group
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from app.models import Class, Group
+from app.database import engine, SessionLocal
+from app import migrations
 
-DATABASE_URL = "sqlite:///./center.db"
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-
-Base.metadata.create_all(bind=engine)
+migrations.upgrade(engine)
 
 def seed():
     db = SessionLocal()